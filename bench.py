@@ -0,0 +1,1449 @@
+"""
+Бенчмарки helpers.py против локального stub-сервера Rocket.Chat.
+
+Запуск: python bench.py [-n 500] [--threads 8] [--output results.json] [--compare old.json]
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import re
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(ROCKETCHAT_URL='http://127.0.0.1:0',
+                       ROCKETCHAT_USERNAME='admin',
+                       ROCKETCHAT_PASSWORD='admin')
+
+import requests  # noqa: E402
+
+from pytils import translit  # noqa: E402
+
+import helpers  # noqa: E402
+
+
+class StubState(object):
+    """
+    Данные stub-сервера: пользователи, комнаты с участниками и подписки.
+    Задержка ответа, размер данных и лимиты запросов настраиваются.
+    """
+
+    def __init__(self, latency=0.0, rooms=1000, members=20, users=200, messages=200, payload=0, rate_limit=None,
+                 rate_window=1.0):
+        """
+        :param latency: задержка каждого ответа, сек
+        :param rooms: сколько комнат создать (и подписок у каждого пользователя)
+        :param members: участников в каждой комнате
+        :param users: сколько пользователей создать
+        :param messages: сообщений в истории каждой комнаты
+        :param payload: байт дополнительных данных в каждом элементе списков
+        :param rate_limit: запросов к одному методу за окно (None - без лимита)
+        :param rate_window: длина окна лимита, сек
+        """
+        self.latency = latency
+        # True - ответы без Content-Length (Transfer-Encoding: chunked)
+        self.chunked = False
+        self.padding = 'x' * payload
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.users = {}
+        self.usernames = set()
+        self.emails = set()
+        # userId -> действующие токены (users.createToken)
+        self.tokens = {}
+        # действующие токены администратора (login)
+        self.admin_tokens = set()
+        self.logins = 0
+        # пароль администратора для login, None - любой
+        self.admin_password = None
+        # последние запросы: (метод, путь, тело или query-параметры)
+        self.requests = deque(maxlen=1000)
+        self.rooms = {}
+        self.names = {}
+        self.windows = {}
+        self.subscriptions_count = rooms
+        # удаленные подписки для ответа updatedSince: {'_id', '_deletedAt'}
+        self.removed = []
+        self._subscriptions = None
+        self.messages = messages
+        self._history = {}
+        for i in range(users):
+            self.add_user({'username': 'user%s' % i, 'name': 'User %s' % i, 'email': 'user%s@example.com' % i},
+                          'user%s' % i)
+        user_ids = sorted(self.users)
+        for i in range(rooms):
+            self.add_room('room%s' % i, 'c' if i % 2 == 0 else 'p',
+                          [user_ids[(i + k) % len(user_ids)] for k in range(min(members, len(user_ids)))],
+                          'room%s' % i)
+
+    def new_id(self):
+        return 'id%s' % next(self.ids)
+
+    def stamp(self, item):
+        now = datetime.now(timezone.utc)
+        item['_updatedAt'] = now.strftime('%Y-%m-%dT%H:%M:%S.') + '%03dZ' % (now.microsecond // 1000)
+        item['_updatedAt_ms'] = int(now.timestamp() * 1000)
+
+    def add_user(self, data, userId=None):
+        user = {'_id': userId or self.new_id(), 'username': data['username'], 'name': data.get('name'),
+                'emails': [{'address': data.get('email'), 'verified': False}], 'active': True}
+        self.stamp(user)
+        self.users[user['_id']] = user
+        self.usernames.add(user['username'])
+        self.emails.add(data.get('email'))
+        return user
+
+    def add_room(self, name, t, members, roomId=None):
+        room = {'_id': roomId or self.new_id(), 'name': name, 't': t, 'ro': False, 'archived': False,
+                'topic': '', 'description': '', 'members': set(members), 'owners': set()}
+        self.stamp(room)
+        self.rooms[room['_id']] = room
+        self.names[name] = room['_id']
+        return room
+
+    def item(self, item):
+        """
+        Элемент для ответа: без внутренних полей, с дополнительными данными
+        """
+        result = dict((k, v) for k, v in item.items() if k not in ('members', 'owners', '_updatedAt_ms'))
+        if self.padding:
+            result['customFields'] = {'padding': self.padding}
+        return result
+
+    def subscriptions(self):
+        if self._subscriptions is None:
+            update = [{'_id': 'sub%s' % i, 'rid': 'room%s' % i, 'alert': i % 10 == 0, 'unread': i % 7,
+                       'name': 'room%s' % i, 't': 'c', '_updatedAt': '2020-01-01T00:00:00.000Z'}
+                      for i in range(self.subscriptions_count)]
+            if self.padding:
+                for subscription in update:
+                    subscription['customFields'] = {'padding': self.padding}
+            self._subscriptions = json.dumps({'update': update, 'remove': [], 'success': True}).encode()
+        return self._subscriptions
+
+    def history(self, roomId):
+        """
+        Сообщения комнаты от новых к старым, по одному в минуту с 2020-01-01
+        """
+        history = self._history.get(roomId)
+        if history is None:
+            room = self.rooms[roomId]
+            members = sorted(room['members']) or ['user0']
+            history = []
+            for i in range(self.messages - 1, -1, -1):
+                userId = members[i % len(members)]
+                message = {'_id': '%s-m%s' % (roomId, i), 'rid': roomId, 'msg': 'Сообщение %s %s' % (i, self.padding),
+                           'ts': '2020-01-%02dT%02d:%02d:00.000Z' % (1 + i // 1440, i // 60 % 24, i % 60),
+                           'u': {'_id': userId, 'username': userId}, '_updatedAt': '2020-01-01T00:00:00.000Z'}
+                history.append(message)
+            self._history[roomId] = history
+        return history
+
+    def rate(self, path):
+        """
+        Учесть запрос в окне лимита
+        :return: (разрешен ли запрос, заголовки X-RateLimit-*)
+        """
+        if self.rate_limit is None:
+            return True, {}
+        with self.lock:
+            now = time.time()
+            window = self.windows.get(path)
+            if window is None or now >= window[0] + self.rate_window:
+                window = self.windows[path] = [now, 0]
+            window[1] += 1
+            count = window[1]
+            reset = window[0] + self.rate_window
+        headers = {
+            'X-RateLimit-Limit': str(self.rate_limit),
+            'X-RateLimit-Remaining': str(max(self.rate_limit - count, 0)),
+            'X-RateLimit-Reset': str(int(reset * 1000)),
+        }
+        if count > self.rate_limit:
+            headers['Retry-After'] = str(max(int(reset - now + 0.999), 1))
+            return False, headers
+        return True, headers
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Методы REST API Rocket.Chat, которые использует helpers.py
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def _send(self, status, payload, headers=None):
+        body = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if self.state.chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+            body = b''.join(b'%x\r\n%s\r\n' % (len(chunk), chunk)
+                            for chunk in (body[i:i + 16384] for i in range(0, len(body), 16384))) + b'0\r\n\r\n'
+        else:
+            self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # клиент не дождался ответа (таймаут)
+            self.close_connection = True
+
+    def _read(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def _dispatch(self, routes, data):
+        url = urlsplit(self.path)
+        self.state.requests.append((self.command, url.path, data))
+        if self.state.latency:
+            time.sleep(self.state.latency)
+        allowed, headers = self.state.rate(url.path)
+        if not allowed:
+            self._send(429, {'success': False, 'error': 'Error, too many requests.'}, headers)
+            return
+        if self.headers.get('X-User-Id') == 'admin' and self.headers.get('X-Auth-Token') not in self.state.admin_tokens:
+            self._send(401, {'status': 'error', 'message': 'You must be logged in to do this.'}, headers)
+            return
+        prefix, _, method = url.path[len('/api/v1/'):].rpartition('.')
+        handler = routes.get(url.path) or routes.get('.' + method)
+        if handler is None:
+            self._send(404, {'success': False, 'error': 'Unknown method %s' % url.path}, headers)
+            return
+        try:
+            status, payload = handler(self, prefix, data)
+        except KeyError as e:
+            status, payload = 400, {'success': False, 'error': 'Missing or unknown %s' % e}
+        self._send(status, payload, headers)
+
+    def do_GET(self):
+        query = dict((k, v[0]) for k, v in parse_qs(urlsplit(self.path).query).items())
+        self._dispatch(self.GET, query)
+
+    def do_POST(self):
+        self._dispatch(self.POST, self._read())
+
+    def room(self, data, prefix=None):
+        """
+        Комната по roomId; как и Rocket.Chat, channels.* не находит приватные
+        комнаты, а groups.* - публичные
+        """
+        room = self.state.rooms[data['roomId']]
+        if prefix is not None and room['t'] != ('p' if prefix == 'groups' else 'c'):
+            raise KeyError('roomId')
+        return room
+
+    def page(self, items, data, key):
+        fields = json.loads(data.get('fields', '{}'))
+        if fields:
+            items = [dict((k, v) for k, v in item.items() if k in fields or k == '_id') for item in items]
+        offset = int(data.get('offset', 0))
+        count = int(data.get('count', 50))
+        items = list(items)
+        return 200, {key: items[offset:offset + count], 'count': len(items[offset:offset + count]),
+                     'offset': offset, 'total': len(items), 'success': True}
+
+    def rooms_list(self, prefix, data):
+        t = 'c' if prefix == 'channels' else 'p'
+        query = json.loads(data.get('query', '{}'))
+        since = query.get('_updatedAt', {}).get('$gt', {}).get('$date')
+        with self.state.lock:
+            rooms = [self.state.item(room) for room in self.state.rooms.values()
+                     if room['t'] == t and name_matches(room['name'], query.get('name')) and
+                     (since is None or room['_updatedAt_ms'] > since)]
+        return self.page(rooms, data, prefix)
+
+    def delete_room(self, prefix, data):
+        with self.state.lock:
+            room = self.room(data, prefix)
+            del self.state.rooms[room['_id']]
+            self.state.names.pop(room['name'], None)
+        return 200, {'success': True}
+
+    def members(self, prefix, data):
+        with self.state.lock:
+            members = [{'_id': userId, 'username': self.state.users[userId]['username'], 'status': 'online'}
+                       for userId in sorted(self.room(data, prefix)['members'])]
+        return self.page(members, data, 'members')
+
+    def users_list(self, prefix, data):
+        with self.state.lock:
+            users = [self.state.item(user) for user in self.state.users.values()]
+        return self.page(users, data, 'users')
+
+    def me(self, prefix, data):
+        userId = self.headers.get('X-User-Id')
+        user = self.state.users.get(userId)
+        if user is None or self.headers.get('X-Auth-Token') not in self.state.tokens.get(userId, ()):
+            return 401, {'status': 'error', 'message': 'You must be logged in to do this.'}
+        return 200, dict(self.state.item(user), success=True)
+
+    def history(self, prefix, data):
+        with self.state.lock:
+            messages = self.state.history(self.room(data, prefix)['_id'])
+        inclusive = data.get('inclusive') == 'true'
+        if 'latest' in data:
+            messages = [m for m in messages if m['ts'] < data['latest'] or inclusive and m['ts'] == data['latest']]
+        if 'oldest' in data:
+            messages = [m for m in messages if m['ts'] > data['oldest'] or inclusive and m['ts'] == data['oldest']]
+        offset = int(data.get('offset', 0))
+        count = int(data.get('count', 20))
+        return 200, {'messages': messages[offset:offset + count], 'success': True}
+
+    def info(self, prefix, data):
+        key = 'channel' if prefix == 'channels' else 'group'
+        return 200, {key: self.state.item(self.room(data, prefix)), 'success': True}
+
+    def user_info(self, prefix, data):
+        with self.state.lock:
+            user = self.state.users.get(data['userId'])
+            if user is None:
+                return 400, {'success': False, 'error': 'User not found. [error-invalid-user]'}
+            return 200, {'user': self.state.item(user), 'success': True}
+
+    def room_info(self, prefix, data):
+        return 200, {'room': self.state.item(self.room(data)), 'success': True}
+
+    def subscriptions_get(self, prefix, data):
+        if 'updatedSince' in data:
+            update = [{'_id': 'sub0', 'rid': 'room0', 'alert': True, 'unread': 1,
+                       '_updatedAt': '2020-01-01T00:00:01.000Z'}]
+            with self.state.lock:
+                remove = list(self.state.removed)
+            removed = set(obj['_id'] for obj in remove)
+            update = [obj for obj in update if obj['_id'] not in removed]
+            return 200, {'update': update, 'remove': remove, 'success': True}
+        return 200, self.state.subscriptions()
+
+    def login(self, prefix, data):
+        if self.state.admin_password is not None and data.get('password') != self.state.admin_password:
+            return 401, {'status': 'error', 'error': 'Unauthorized', 'message': 'Unauthorized'}
+        with self.state.lock:
+            self.state.logins += 1
+            token = 'admin-token-%s' % self.state.logins
+            self.state.admin_tokens.add(token)
+        return 200, {'status': 'success', 'data': {'userId': 'admin', 'authToken': token}}
+
+    def logout(self, prefix, data):
+        return 200, {'status': 'success', 'data': {'message': "You've been logged out!"}}
+
+    def create_token(self, prefix, data):
+        with self.state.lock:
+            if data['userId'] not in self.state.users:
+                return 400, {'success': False, 'error': 'User not found. [error-invalid-user]'}
+            token = 'token-%s-%s' % (data['userId'], next(self.state.ids))
+            self.state.tokens.setdefault(data['userId'], set()).add(token)
+        return 200, {'success': True, 'data': {'userId': data['userId'], 'authToken': token}}
+
+    def create_user(self, prefix, data):
+        with self.state.lock:
+            for field, taken in (('username', self.state.usernames), ('email', self.state.emails)):
+                if data[field] in taken:
+                    return 400, {'success': False, 'error': '%s is already in use :( [error-field-unavailable]'
+                                                            % data[field]}
+            user = self.state.add_user(data)
+        return 200, {'user': self.state.item(user), 'success': True}
+
+    def update_user(self, prefix, data):
+        with self.state.lock:
+            user = self.state.users[data['userId']]
+            user.update((k, v) for k, v in data['data'].items() if k in ('name', 'username', 'active'))
+            self.state.stamp(user)
+        return 200, {'user': self.state.item(user), 'success': True}
+
+    def create_room(self, prefix, data):
+        key = 'channel' if prefix == 'channels' else 'group'
+        with self.state.lock:
+            if data['name'] in self.state.names:
+                return 400, {'success': False, 'error': 'A channel with name \'%s\' exists '
+                                                        '[error-duplicate-channel-name]' % data['name']}
+            room = self.state.add_room(data['name'], 'c' if prefix == 'channels' else 'p', data.get('members') or ())
+        return 200, {key: self.state.item(room), 'success': True}
+
+    def update_room(self, prefix, data):
+        fields = {
+            'setTopic': 'topic',
+            'setDescription': 'description',
+            'setType': 't',
+            'rename': 'name',
+        }
+        method = urlsplit(self.path).path.rpartition('.')[2]
+        with self.state.lock:
+            room = self.room(data, prefix)
+            if method in fields:
+                field = fields[method]
+                value = data['type' if field == 't' else field]
+                if not isinstance(value, str):
+                    return 400, {'success': False, 'error': 'Match error: Expected string, got %r' % value}
+                if field == 'name':
+                    self.state.names.pop(room['name'], None)
+                    self.state.names[value] = room['_id']
+                room[field] = value
+            elif method in ('archive', 'unarchive'):
+                room['archived'] = method == 'archive'
+            elif method == 'invite':
+                if data['userId'] not in self.state.users:
+                    return 400, {'success': False, 'error': 'Invalid user [error-invalid-user]'}
+                room['members'].add(data['userId'])
+            elif method == 'kick':
+                room['members'].discard(data['userId'])
+            elif method == 'addOwner':
+                room['owners'].add(data['userId'])
+            self.state.stamp(room)
+        return 200, {'success': True}
+
+    GET = {
+        '/api/v1/subscriptions.get': subscriptions_get,
+        '/api/v1/me': me,
+        '/api/v1/users.list': users_list,
+        '/api/v1/users.info': user_info,
+        '/api/v1/channels.list': rooms_list,
+        '/api/v1/groups.list': rooms_list,
+        '/api/v1/groups.listAll': rooms_list,
+        '/api/v1/rooms.info': room_info,
+        '.members': members,
+        '.history': history,
+        '.info': info,
+    }
+
+    POST = {
+        '/api/v1/login': login,
+        '/api/v1/logout': logout,
+        '/api/v1/users.createToken': create_token,
+        '/api/v1/users.create': create_user,
+        '/api/v1/users.update': update_user,
+        '.create': create_room,
+        '.addOwner': update_room,
+        '.setTopic': update_room,
+        '.setDescription': update_room,
+        '.setType': update_room,
+        '.rename': update_room,
+        '.archive': update_room,
+        '.unarchive': update_room,
+        '.close': update_room,
+        '.invite': update_room,
+        '.kick': update_room,
+        '.delete': delete_room,
+    }
+
+
+def name_matches(name, condition):
+    """
+    Фильтр по имени из query списочных методов: строка или {'$regex', '$options'}
+    """
+    if condition is None:
+        return True
+    if isinstance(condition, dict):
+        flags = re.IGNORECASE if 'i' in condition.get('$options', '') else 0
+        return re.search(condition['$regex'], name, flags) is not None
+    return name == condition
+
+
+class StubHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class StubServer(object):
+    """
+    Stub-сервер в отдельном потоке
+    """
+
+    def __init__(self, handler=StubHandler, state=None, **options):
+        """
+        :param handler: класс обработчика запросов
+        :param state: StubState (по умолчанию создается из options)
+        """
+        self.state = state or StubState(**options)
+        self.httpd = StubHTTPServer(('127.0.0.1', 0), handler)
+        self.httpd.state = self.state
+        self.url = 'http://127.0.0.1:%s' % self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FakeDDPServer(object):
+    """
+    Минимальный DDP-сервер Rocket.Chat: connect, login (resume) по токенам
+    stub-сервера, sub на <userId>/subscriptions-changed только своего
+    пользователя и рассылка изменений через push().
+    silent = True - сервер перестает отвечать, не закрывая соединение
+    """
+
+    def __init__(self, state, refuse=()):
+        """
+        :param state: StubState, токены которого принимает login
+        :param refuse: userId, для которых подписка запрещена (nosub)
+        """
+        from websockets.sync.server import serve
+
+        self.state = state
+        self.refuse = set(refuse)
+        self.silent = False
+        self.connections = []
+        # соединение -> userId, вошедший в нем
+        self.logins = {}
+        self.login_attempts = 0
+        self.pongs = 0
+        self.server = serve(self._handle, '127.0.0.1', 0)
+        self.url = 'ws://127.0.0.1:%s/websocket' % self.server.socket.getsockname()[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+
+    def _handle(self, conn):
+        from websockets.exceptions import ConnectionClosed
+
+        self.connections.append(conn)
+        try:
+            for raw in conn:
+                message = json.loads(raw)
+                msg = message.get('msg')
+                if self.silent:
+                    continue
+                if msg == 'connect':
+                    conn.send(json.dumps({'msg': 'connected', 'session': 'session'}))
+                elif msg == 'ping':
+                    conn.send(json.dumps({'msg': 'pong'}))
+                elif msg == 'pong':
+                    self.pongs += 1
+                elif msg == 'method' and message['method'] == 'login':
+                    self.login_attempts += 1
+                    token = message['params'][0].get('resume')
+                    with self.state.lock:
+                        userId = next((userId for userId, tokens in self.state.tokens.items() if token in tokens),
+                                      None)
+                    if userId is None:
+                        conn.send(json.dumps({'msg': 'result', 'id': message['id'], 'error': {
+                            'error': 403, 'reason': "You've been logged out by the server. Please log in again."}}))
+                    else:
+                        self.logins[conn] = userId
+                        conn.send(json.dumps({'msg': 'result', 'id': message['id'],
+                                              'result': {'id': userId, 'token': token}}))
+                elif msg == 'sub':
+                    userId = message['params'][0].split('/')[0]
+                    if userId in self.refuse or self.logins.get(conn) != userId:
+                        conn.send(json.dumps({'msg': 'nosub', 'id': message['id'], 'error': {'error': 'not-allowed'}}))
+                    else:
+                        conn.send(json.dumps({'msg': 'ready', 'subs': [message['id']]}))
+        except ConnectionClosed:
+            pass
+        finally:
+            self.connections.remove(conn)
+            self.logins.pop(conn, None)
+
+    def push(self, userId, action, subscription):
+        from websockets.exceptions import ConnectionClosed
+
+        payload = json.dumps({'msg': 'changed', 'collection': 'stream-notify-user', 'id': 'id',
+                              'fields': {'eventName': '%s/subscriptions-changed' % userId,
+                                         'args': [action, subscription]}})
+        for conn in list(self.connections):
+            if self.logins.get(conn) != userId:
+                continue
+            try:
+                conn.send(payload)
+            except ConnectionClosed:
+                pass
+
+    def ping(self):
+        from websockets.exceptions import ConnectionClosed
+
+        for conn in list(self.connections):
+            try:
+                conn.send(json.dumps({'msg': 'ping'}))
+            except ConnectionClosed:
+                pass
+
+    def drop(self):
+        """
+        Оборвать соединения без закрывающего рукопожатия, как при сбое сети
+        """
+        for conn in list(self.connections):
+            conn.socket.shutdown(socket.SHUT_RDWR)
+
+
+def measure(name, fn, n, threads=1):
+    """
+    Выполнить fn() n раз в threads потоков
+    :return: dict с результатами
+    """
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(count):
+        local = []
+        for _ in range(count):
+            start = time.perf_counter()
+            fn()
+            local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+
+    per_thread = max(n // threads, 1)
+    workers = [threading.Thread(target=worker, args=(per_thread,)) for _ in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    result = {
+        'name': name,
+        'calls': len(latencies),
+        'threads': threads,
+        'rps': len(latencies) / elapsed,
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p99_ms': latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)] * 1000,
+    }
+    print('%(name)-40s threads=%(threads)-3s %(rps)9.1f req/s  '
+          'p50=%(p50_ms)7.2fms  p99=%(p99_ms)7.2fms' % result)
+    return result
+
+
+def bench_transport(server, n, threads):
+    url = server.url + '/api/v1/channels.setTopic'
+    data = {'roomId': 'room', 'topic': 'topic'}
+    transport = helpers.Transport(base_url=server.url, pool_maxsize=threads)
+    results = []
+    for count in (1, threads):
+        results.append(measure('per-call connection', lambda: requests.post(url, json=data), n, count))
+        results.append(measure('pooled transport',
+                               lambda: transport.post('/api/v1/channels.setTopic', json=data), n, count))
+    transport.close()
+    return results
+
+
+def report(workflow, client, latencies, elapsed, errors, concurrency):
+    latencies = sorted(latencies)
+    count = len(latencies)
+    result = {
+        'name': '%s %s' % (workflow, client),
+        'workflow': workflow,
+        'client': client,
+        'concurrency': concurrency,
+        'units': count,
+        'errors': errors,
+        'seconds': elapsed,
+        'per_second': count / elapsed if elapsed else 0.0,
+        'p50_ms': latencies[count // 2] * 1000 if count else None,
+        'p99_ms': latencies[min(int(count * 0.99), count - 1)] * 1000 if count else None,
+    }
+    print('%(name)-40s x%(concurrency)-3s %(per_second)9.1f units/s  p50=%(p50_ms)7.2fms  '
+          'p99=%(p99_ms)7.2fms  errors=%(errors)s' % result)
+    return result
+
+
+def failed(result):
+    return result is False or result is None or (isinstance(result, tuple) and result[0] is False)
+
+
+def run_sync(workflow, client, fn, units, concurrency=1, warmup=()):
+    """
+    Выполнить fn(unit) для каждого unit: последовательно (concurrency=1) или в пуле потоков
+    :return: dict с результатами
+    """
+    latencies = []
+    errors = [0]
+
+    def unit(item):
+        start = time.perf_counter()
+        try:
+            result = fn(item)
+        except Exception:
+            result = False
+        latencies.append(time.perf_counter() - start)
+        if failed(result):
+            errors[0] += 1
+
+    for item in warmup:
+        fn(item)
+    start = time.perf_counter()
+    if concurrency == 1:
+        for item in units:
+            unit(item)
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(unit, units))
+    return report(workflow, client, latencies, time.perf_counter() - start, errors[0], concurrency)
+
+
+def run_async(workflow, make_client, fn, units, concurrency, warmup=()):
+    """
+    То же для асинхронного клиента: не больше concurrency единиц работы одновременно
+    :param make_client: функция без аргументов -> AsyncRocketChat (создается внутри event loop)
+    :param fn: корутина fn(client, unit)
+    """
+    latencies = []
+    errors = [0]
+
+    async def main():
+        client = make_client()
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def unit(item):
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    result = await fn(client, item)
+                except Exception:
+                    result = False
+                latencies.append(time.perf_counter() - start)
+                if failed(result):
+                    errors[0] += 1
+
+        try:
+            for item in warmup:
+                await fn(client, item)
+            start = time.perf_counter()
+            await asyncio.gather(*[unit(item) for item in units])
+            return time.perf_counter() - start
+        finally:
+            await client.aclose()
+
+    elapsed = asyncio.run(main())
+    return report(workflow, 'async', latencies, elapsed, errors[0], concurrency)
+
+
+def sync_client(server, concurrency):
+    return helpers.RocketChat(transport=helpers.Transport(base_url=server.url, pool_maxsize=concurrency),
+                              token_cache=helpers.TokenCache(), subscription_store=helpers.SubscriptionStore(),
+                              room_index=helpers.RoomNameIndex(), info_cache=helpers.InfoCache(),
+                              single_flight=helpers.SingleFlight(window=0))
+
+
+def async_client(server, concurrency):
+    return lambda: helpers.AsyncRocketChat(
+        transport=helpers.AsyncTransport(base_url=server.url, max_connections=concurrency,
+                                         max_keepalive_connections=concurrency),
+        token_cache=helpers.TokenCache(), subscription_store=helpers.SubscriptionStore(),
+        room_index=helpers.RoomNameIndex(), info_cache=helpers.InfoCache(), single_flight=helpers.SingleFlight(window=0))
+
+
+def clients(server, concurrency):
+    """
+    Клиенты для сравнения: (название, sync-клиент или None для async, параллелизм)
+    """
+    return (('sequential', sync_client(server, 1), 1),
+            ('threaded', sync_client(server, concurrency), concurrency),
+            ('async', None, concurrency))
+
+
+def room_specs(prefix, count):
+    return [{'name': '%s %s' % (prefix, i), 'members': ['user1', 'user2'], 'owner': 'user1',
+             'description': 'описание', 'topic': 'тема', 'private': i % 2 == 1} for i in range(count)]
+
+
+def bench_workflow_provisioning(server, units, concurrency):
+    """
+    Создание комнат: create (приватные - сразу группой) + владелец, описание и тема (provision_rooms на одну комнату)
+    """
+    results = []
+    for name, client, workers in clients(server, concurrency):
+        specs = room_specs('Проект %s' % name, units)
+        if client is None:
+            async def provision(client, spec):
+                return (await client.provision_rooms([spec]))[0]['success']
+            results.append(run_async('provisioning', async_client(server, workers), provision, specs, workers))
+        else:
+            results.append(run_sync('provisioning', name, lambda spec: client.provision_rooms([spec])[0]['success'],
+                                    specs, workers))
+    return results
+
+
+def roster_targets(server, rooms):
+    """
+    Новый состав для каждой комнаты: половина участников остается, столько же новых
+    """
+    users = sorted(server.state.users)
+    targets = []
+    for offset, room in enumerate(rooms):
+        members = sorted(room['members'])
+        keep = members[:len(members) // 2]
+        fresh = [users[(offset * 7 + k) % len(users)] for k in range(len(members) - len(keep))]
+        targets.append((room['_id'], room['t'] == 'p', keep + fresh))
+    return targets
+
+
+def bench_workflow_roster(server, units, concurrency):
+    """
+    Синхронизация составов комнат (sync_members) без ограничения скорости приглашений
+    """
+    rooms = list(server.state.rooms.values())
+    results = []
+    for number, (name, client, workers) in enumerate(clients(server, concurrency)):
+        targets = roster_targets(server, rooms[number * units:(number + 1) * units])
+        if client is None:
+            async def sync(client, target):
+                return await client.sync_members(target[0], target[2], group=target[1], rate=1e6)
+            results.append(run_async('roster sync', async_client(server, workers), sync, targets, workers))
+        else:
+            results.append(run_sync('roster sync', name,
+                                    lambda target: client.sync_members(target[0], target[2], group=target[1],
+                                                                       rate=1e6),
+                                    targets, workers))
+    return results
+
+
+def bench_workflow_notifications(server, units, users, concurrency):
+    """
+    Опрос счетчиков непрочитанного; первая полная синхронизация каждого пользователя не учитывается
+    """
+    user_ids = ['user%s' % i for i in range(users)]
+    polls = [user_ids[i % users] for i in range(units)]
+    results = []
+    for name, client, workers in clients(server, concurrency):
+        if client is None:
+            async def poll(client, userId):
+                return await client.notifications(userId)
+            results.append(run_async('notification polling', async_client(server, workers), poll, polls, workers,
+                                     warmup=user_ids))
+        else:
+            results.append(run_sync('notification polling', name, client.notifications, polls, workers,
+                                    warmup=user_ids))
+    return results
+
+
+def bench_workflow_users(server, units, concurrency):
+    """
+    Создание пользователей
+    """
+    results = []
+    for name, client, workers in clients(server, concurrency):
+        records = [('%s%s@example.com' % (name, i), 'Новый Пользователь %s' % i, 'secret') for i in range(units)]
+        if client is None:
+            async def create(client, record):
+                return await client.create_user(*record)
+            results.append(run_async('user creation', async_client(server, workers), create, records, workers))
+        else:
+            results.append(run_sync('user creation', name, lambda record: client.create_user(*record), records,
+                                    workers))
+    return results
+
+
+def bench_workflow_settings(server, units, concurrency):
+    """
+    Сохранение формы настроек комнаты, в которой изменилась только тема:
+    все set_* подряд и RoomSettings (снимок комнаты загружен при прогреве)
+    """
+    rooms = sorted(server.state.rooms)[:units]
+    form = {'description': 'описание', 'private': False}
+    client = sync_client(server, concurrency)
+    for roomId in rooms:
+        client.room_settings(roomId).set(name=server.state.rooms[roomId]['name'], topic='тема', **form).commit()
+
+    def legacy(roomId):
+        room = server.state.rooms[roomId]
+        prefix = 'groups' if room['t'] == 'p' else 'channels'
+        return all([getattr(client, prefix + '_rename')(roomId, room['name']),
+                    getattr(client, prefix + '_set_description')(roomId, form['description']),
+                    getattr(client, prefix + '_set_topic')(roomId, 'новая тема'),
+                    getattr(client, prefix + '_set_type')(roomId, form['private'])])
+
+    def unit_of_work(roomId):
+        return client.room_settings(roomId).set(name=server.state.rooms[roomId]['name'], topic='другая тема',
+                                                **form).commit()['success']
+
+    return [run_sync('settings save', 'set_*', legacy, rooms, concurrency),
+            run_sync('settings save', 'room_settings', unit_of_work, rooms, concurrency)]
+
+
+class NoFlight(object):
+    """
+    Без объединения запросов - для сравнения с SingleFlight
+    """
+
+    def do(self, key, fn, *args, **kwargs):
+        return fn(*args, **kwargs)
+
+    def metrics(self):
+        return {}
+
+
+def bench_workflow_profile(server, units, users, concurrency):
+    """
+    Шапка страницы: about_me на каждый запрос страницы без кеша (ttl=0) и с кешем;
+    каждый пользователь открывает в среднем 10 страниц
+    """
+    user_ids = ['user%s' % i for i in range(max(1, min(users, units // 10)))]
+    renders = [user_ids[i % len(user_ids)] for i in range(units)]
+    results = []
+    for name, info_cache in (('no cache', helpers.InfoCache(ttl=0)), ('info cache', helpers.InfoCache())):
+        client = sync_client(server, concurrency)
+        client.info_cache = info_cache
+        client.single_flight = NoFlight()
+        results.append(run_sync('page header', name, client.about_me, renders, concurrency))
+        print('%-40s %s' % ('', info_cache.stats()))
+    return results
+
+
+def bench_workflow_tabs(server, units, users, concurrency, tabs=4):
+    """
+    Пользователь открывает tabs вкладок сразу: каждая запрашивает notifications
+    и about_me (кеш about_me выключен); без объединения и с SingleFlight
+    """
+    user_ids = ['user%s' % i for i in range(users)]
+    opens = [user_ids[i % users] for i in range(units)]
+    results = []
+    for name, single_flight in (('no coalescing', NoFlight()), ('single flight', helpers.SingleFlight())):
+        client = sync_client(server, concurrency * tabs)
+        client.info_cache = helpers.InfoCache(ttl=0)
+        client.single_flight = single_flight
+        for userId in user_ids:
+            client.notifications(userId)
+
+        def open_tabs(userId, pool=ThreadPoolExecutor(max_workers=concurrency * tabs)):
+            futures = [pool.submit(client.notifications, userId) for _ in range(tabs)]
+            futures += [pool.submit(client.about_me, userId) for _ in range(tabs)]
+            return all(future.result() for future in futures)
+
+        results.append(run_sync('open tabs', name, open_tabs, opens, concurrency))
+        print('%-40s %s' % ('', single_flight.metrics()))
+    return results
+
+
+def bench_workflow_outage(server, units, users, concurrency, stall=1.0):
+    """
+    Сервер завис (отвечает через stall секунд, таймаут чтения 0.2 с): опрос
+    непрочитанного без CircuitBreaker (порог не достигается) и с ним -
+    открытый автомат сразу отдает последние известные счетчики
+    """
+    user_ids = ['user%s' % i for i in range(users)]
+    polls = [user_ids[i % users] for i in range(units)]
+    results = []
+    for name, failures in (('no breaker', 10 ** 9), ('breaker', 5)):
+        client = sync_client(server, concurrency)
+        client.transport = helpers.Transport(base_url=server.url, pool_maxsize=concurrency, retries=0,
+                                             timeouts={'subscriptions': (1, 0.2)},
+                                             breakers=helpers.CircuitBreakers(failures=failures, reset_timeout=60))
+        for userId in user_ids:
+            client.notifications(userId)
+        server.state.latency, latency = stall, server.state.latency
+        try:
+            results.append(run_sync('outage polling', name, client.notifications, polls, concurrency))
+        finally:
+            server.state.latency = latency
+        print('%-40s %s' % ('', client.transport.breakers.metrics().get('subscriptions')))
+    return results
+
+
+def bench_workflow_outbox(server, units, concurrency):
+    """
+    Сохранение формы комнаты (тема, описание, приглашение): запросы в
+    обработчике и через Outbox - время ответа пользователю и время, за
+    которое фоновый поток выполнил все записи
+    """
+    rooms = sorted(server.state.rooms)[:units]
+    users = sorted(server.state.users)
+    client = sync_client(server, concurrency)
+
+    def inline(index):
+        roomId = rooms[index]
+        return all([client.channels_set_topic(roomId, 'тема %s' % index),
+                    client.channels_set_description(roomId, 'описание %s' % index),
+                    client.channels_invite(roomId, users[index % len(users)])])
+
+    results = [run_sync('room save', 'inline', inline, range(len(rooms)), concurrency)]
+    with tempfile.TemporaryDirectory() as directory:
+        outbox = helpers.Outbox(os.path.join(directory, 'outbox.sqlite3'), client, concurrency=concurrency)
+
+        def queued(index):
+            roomId = rooms[index]
+            outbox.channels_set_topic(roomId, 'тема %s' % index)
+            outbox.channels_set_description(roomId, 'описание %s' % index)
+            return outbox.channels_invite(roomId, users[index % len(users)])
+
+        start = time.perf_counter()
+        results.append(run_sync('room save', 'outbox', queued, range(len(rooms)), concurrency))
+        while outbox.status()['pending'] or outbox.status()['running']:
+            time.sleep(0.01)
+        print('%-40s %s drained in %.2fs' % ('', outbox.status(), time.perf_counter() - start))
+        outbox.close()
+    return results
+
+
+def walk(workflow, client, items, work):
+    """
+    Перебрать items, обрабатывая каждый элемент work секунд (ввод-вывод,
+    например запись в базу); latency - ожидание
+    следующего элемента (на границах страниц - ожидание ответа сервера)
+    """
+    latencies = []
+    count = 0
+    start = previous = time.perf_counter()
+    for _ in items:
+        latencies.append(time.perf_counter() - previous)
+        count += 1
+        time.sleep(work)
+        previous = time.perf_counter()
+    return report(workflow, client, latencies, time.perf_counter() - start, 0, 1)
+
+
+def bench_workflow_lists(server, work=0.0001):
+    """
+    Обход всех комнат: все страницы в память, итератор с подгрузкой следующей страницы, итератор с fields
+    """
+    client = sync_client(server, 2)
+
+    def pages():
+        for key, path in (('channels', '/api/v1/channels.list'), ('groups', '/api/v1/groups.listAll')):
+            for item in client._run(helpers.list_pages(key + '_list', path, key)):
+                yield item
+
+    return [
+        walk('room walk', 'list_pages', pages(), work),
+        walk('room walk', 'iter', itertools.chain(client.iter_channels(), client.iter_groups()), work),
+        walk('room walk', 'iter fields', itertools.chain(client.iter_channels(fields=['name']),
+                                                         client.iter_groups(fields=['name'])), work),
+    ]
+
+
+def bench_workflow_export(server, rooms, concurrency):
+    """
+    Выгрузка истории rooms комнат в gzip: потоки с чтением ответов по частям и async
+    """
+    results = []
+    room_ids = sorted(server.state.rooms)[:rooms]
+    for name, client, workers in clients(server, concurrency)[1:]:
+        with tempfile.TemporaryDirectory() as directory:
+            start = time.perf_counter()
+            if client is None:
+                async def export():
+                    client = async_client(server, workers)()
+                    try:
+                        return await client.export_history(room_ids, directory, concurrency=workers)
+                    finally:
+                        await client.aclose()
+                exported = asyncio.run(export())
+            else:
+                exported = client.export_history(room_ids, directory, concurrency=workers)
+            elapsed = time.perf_counter() - start
+        messages = sum(item['messages'] for item in exported)
+        result = {'name': 'history export %s' % name, 'workflow': 'history export', 'client': name,
+                  'concurrency': workers, 'units': messages, 'errors': sum(1 for item in exported if item['error']),
+                  'seconds': elapsed, 'per_second': messages / elapsed}
+        print('%(name)-40s x%(concurrency)-3s %(per_second)9.1f messages/s  errors=%(errors)s' % result)
+        results.append(result)
+    return results
+
+
+def bench_workflows(server, units, users, concurrency):
+    return (bench_workflow_provisioning(server, units, concurrency) +
+            bench_workflow_roster(server, units, concurrency) +
+            bench_workflow_notifications(server, units * 10, users, concurrency) +
+            bench_workflow_users(server, units, concurrency) +
+            bench_workflow_settings(server, units, concurrency) +
+            bench_workflow_profile(server, units * 10, users, concurrency) +
+            bench_workflow_tabs(server, units, users, concurrency) +
+            bench_workflow_outage(server, units, users, concurrency) +
+            bench_workflow_outbox(server, units, concurrency) +
+            bench_workflow_lists(server) +
+            bench_workflow_export(server, units, concurrency))
+
+
+def bench_notifications(server, n, users, threads):
+    transport = helpers.Transport(base_url=server.url, pool_maxsize=threads)
+    user_ids = ['user%s' % i for i in range(users)]
+    results = []
+    for name, store in (('notifications full sync', helpers.SubscriptionStore(resync_interval=0)),
+                        ('notifications incremental', helpers.SubscriptionStore())):
+        client = helpers.RocketChat(transport=transport, token_cache=helpers.TokenCache(), subscription_store=store,
+                                    room_index=helpers.RoomNameIndex(), info_cache=helpers.InfoCache(),
+                                    single_flight=helpers.SingleFlight(window=0))
+        for userId in user_ids:
+            client.notifications(userId)
+        cycle = itertools.cycle(user_ids)
+        results.append(measure('%s (%s rooms)' % (name, server.state.subscriptions_count),
+                               lambda: client.notifications(next(cycle)), n, threads))
+    return results
+
+
+def bench_realtime(server, n, users, threads):
+    client = sync_client(server, threads)
+    user_ids = ['user%s' % i for i in range(users)]
+    with FakeDDPServer(server.state) as ddp:
+        realtime = helpers.RealtimeUnread(client, url=ddp.url).start()
+        for userId in user_ids:
+            realtime.watch(userId)
+        end = time.monotonic() + 10
+        while time.monotonic() < end and not all(userId in realtime.live and userId in realtime.table
+                                                 for userId in user_ids):
+            time.sleep(0.01)
+        cycle = itertools.cycle(user_ids)
+        result = measure('notifications realtime table', lambda: realtime.notifications(next(cycle)), n, threads)
+        realtime.stop()
+    return [result]
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def legacy_handle(call, resp):
+    """
+    Прежний разбор ответа: строка лога форматируется всегда, exc_info=True
+    """
+    logger = logging.getLogger('helpers')
+    if resp.status_code != 200:
+        logger.error('Fail %s: %s' % (call.name, resp.content.decode()), exc_info=True)
+        return call.error
+    logger.info('%s.resp - %s' % (call.name, resp), exc_info=True)
+    return call.parse(resp)
+
+
+def bench_logging(n):
+    """
+    Накладные расходы лога на один разбор ответа без сети, мкс
+    """
+    logger = logging.getLogger('helpers')
+    handler = logging.StreamHandler(io.StringIO())
+    logger.addHandler(handler)
+    logger.propagate = False
+    call = helpers.Call('channels_set_topic', 'POST', '/api/v1/channels.setTopic')
+    ok = FakeResponse(200, b'{"success": true}')
+    fail = FakeResponse(400, b'{"success": false, "error": "' + b'x' * 1000000 + b'"}')
+    log = helpers.RequestLog()
+    sampled = helpers.RequestLog(sample=0.01)
+    scenarios = [
+        ('legacy', lambda resp: legacy_handle(call, resp)),
+        ('RequestLog', lambda resp: call.handle(resp, 0.001, log)),
+        ('RequestLog sample=0.01', lambda resp: call.handle(resp, 0.001, sampled)),
+    ]
+    results = []
+    for level in (logging.DEBUG, logging.INFO, logging.WARNING):
+        logger.setLevel(level)
+        for name, fn in scenarios:
+            start = time.perf_counter()
+            for _ in range(n):
+                fn(ok)
+            per_call = (time.perf_counter() - start) / n * 1e6
+            result = {'name': '%s %s' % (name, logging.getLevelName(level)), 'us_per_call': per_call}
+            print('%(name)-40s %(us_per_call)9.2f us/call' % result)
+            results.append(result)
+    logger.setLevel(logging.ERROR)
+    for name, fn in scenarios[:2]:
+        start = time.perf_counter()
+        for _ in range(max(n // 100, 1)):
+            fn(fail)
+        per_call = (time.perf_counter() - start) / max(n // 100, 1) * 1e6
+        result = {'name': '%s error 1MB body' % name, 'us_per_call': per_call}
+        print('%(name)-40s %(us_per_call)9.2f us/call' % result)
+        results.append(result)
+    logger.removeHandler(handler)
+    logger.propagate = True
+    return results
+
+
+def model_payloads(n):
+    """
+    Ответы списочных методов по n элементов, с полями, которые есть у
+    настоящего Rocket.Chat, но не нужны клиенту
+    :return: [(название, ключ списка, модель, тело ответа), ...]
+    """
+    stamp = '2020-01-01T00:00:00.000Z'
+    rooms = [{'_id': 'room%s' % i, 'name': 'room%s' % i, 'fname': 'Комната %s' % i, 't': 'c' if i % 2 else 'p',
+              'usersCount': i % 50, 'msgs': i, 'ro': False, 'archived': False, 'default': False, 'sysMes': True,
+              'topic': 'Тема %s' % i, 'description': '', 'u': {'_id': 'user0', 'username': 'admin'},
+              'customFields': {}, 'ts': stamp, 'lm': stamp, '_updatedAt': stamp,
+              'lastMessage': {'_id': 'm%s' % i, 'rid': 'room%s' % i, 'msg': 'Последнее сообщение %s' % i, 'ts': stamp,
+                              'u': {'_id': 'user0', 'username': 'admin', 'name': 'Admin'}, 'mentions': [],
+                              'channels': [], 'md': [{'type': 'PARAGRAPH', 'value': [{'type': 'PLAIN_TEXT',
+                                                                                      'value': 'Последнее'}]}],
+                              '_updatedAt': stamp}} for i in range(n)]
+    users = [{'_id': 'user%s' % i, 'username': 'user%s' % i, 'name': 'User %s' % i, 'status': 'offline',
+              'active': True, 'type': 'user', 'roles': ['user'], 'utcOffset': 3,
+              'emails': [{'address': 'user%s@example.com' % i, 'verified': True}], 'createdAt': stamp,
+              'lastLogin': stamp, 'statusConnection': 'offline', 'nameInsensitive': 'user %s' % i,
+              'settings': {'preferences': {'language': 'ru', 'newRoomNotification': 'door', 'sidebarViewMode':
+                                           'medium', 'emailNotificationMode': 'mentions', 'highlights': []}},
+              '_updatedAt': stamp} for i in range(n)]
+    subscriptions = [{'_id': 'sub%s' % i, 'rid': 'room%s' % i, 'name': 'room%s' % i, 'fname': 'Комната %s' % i,
+                      't': 'c', 'alert': i % 10 == 0, 'unread': i % 7, 'userMentions': 0, 'groupMentions': 0,
+                      'open': True, 'ts': stamp, 'ls': stamp, 'lr': stamp, 'roles': ['owner'], 'tunread': [],
+                      'u': {'_id': 'user0', 'username': 'user0', 'name': 'User 0'}, '_updatedAt': stamp}
+                     for i in range(n)]
+    messages = [{'_id': 'm%s' % i, 'rid': 'room0', 'msg': 'Сообщение %s' % i, 'ts': stamp,
+                 'u': {'_id': 'user%s' % (i % 20), 'username': 'user%s' % (i % 20), 'name': 'User %s' % (i % 20)},
+                 'urls': [], 'mentions': [], 'channels': [], 'groupable': False, 'unread': True,
+                 'md': [{'type': 'PARAGRAPH', 'value': [{'type': 'PLAIN_TEXT', 'value': 'Сообщение %s' % i}]}],
+                 '_updatedAt': stamp} for i in range(n)]
+    return [
+        ('rooms', 'channels', helpers.Room, json.dumps({'channels': rooms, 'success': True}).encode()),
+        ('users', 'users', helpers.User, json.dumps({'users': users, 'success': True}).encode()),
+        ('subscriptions', 'update', helpers.Subscription,
+         json.dumps({'update': subscriptions, 'remove': [], 'success': True}).encode()),
+        ('messages', 'messages', helpers.Message, json.dumps({'messages': messages, 'success': True}).encode()),
+    ]
+
+
+def retained(fn):
+    """
+    Сколько памяти занимает результат fn(), КБ
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = fn()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del result
+    return size / 1024
+
+
+def bench_models(n, repeat=5):
+    """
+    Разбор списков из n элементов: dict из resp.json() против orjson и
+    моделей только с нужными полями; лучшее время разбора из repeat и
+    память результата
+    """
+    results = []
+    for name, key, model, content in model_payloads(n):
+        resp = FakeResponse(200, content)
+        scenarios = [
+            ('resp.json dict', lambda: resp.json()[key]),
+            ('decode dict', lambda: helpers.decode(resp.content)[key]),
+            ('decode %s' % model.__name__, lambda: model.from_list(helpers.decode(resp.content)[key])),
+        ]
+        for scenario, fn in scenarios:
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                fn()
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            result = {'name': 'models %s %s' % (name, scenario), 'ms_per_call': best * 1000,
+                      'retained_kb': retained(fn)}
+            print('%(name)-40s %(ms_per_call)9.2f ms/call %(retained_kb)9.0f KB' % result)
+            results.append(result)
+    return results
+
+
+def micro(name, fn, n):
+    """
+    Среднее время одного вызова fn(), мкс
+    """
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    result = {'name': name, 'us_per_call': (time.perf_counter() - start) / n * 1e6}
+    print('%(name)-40s %(us_per_call)9.2f us/call' % result)
+    return result
+
+
+def bench_instrumentation(server, n, threads):
+    """
+    Накладные расходы метрик: сам хук без сети и запросы через stub-сервер
+    """
+    instrumentation = helpers.Instrumentation([])
+    transport = helpers.Transport(base_url=server.url, pool_maxsize=threads, instrumentation=instrumentation)
+    data = {'roomId': 'room', 'topic': 'topic'}
+    resp = transport.post('/api/v1/channels.setTopic', json=data)
+    registry = helpers.PrometheusExporter()
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(('127.0.0.1', 0))
+    statsd = helpers.StatsDExporter('127.0.0.1', sink.getsockname()[1])
+
+    def hook():
+        if instrumentation.exporters:
+            instrumentation.observe(helpers.Sample('POST', '/api/v1/channels.setTopic', resp, 0.001, 0, True))
+
+    results = [micro('instrumentation hook, no exporter', hook, n * 20)]
+    results.append(measure('transport, no exporter',
+                           lambda: transport.post('/api/v1/channels.setTopic', json=data), n, threads))
+    for name, exporters in (('registry', [registry]), ('registry+statsd', [registry, statsd])):
+        instrumentation.exporters = exporters
+        results.append(micro('instrumentation hook, %s' % name, hook, n * 20))
+        results.append(measure('transport, %s' % name,
+                               lambda: transport.post('/api/v1/channels.setTopic', json=data), n, threads))
+    transport.close()
+    sink.close()
+    return results
+
+
+SURNAMES = ('Иванов', 'Смирнов', 'Кузнецов', 'Попов', 'Васильев', 'Петров', 'Соколов', 'Михайлов', 'Новиков',
+            'Фёдоров', 'Морозов', 'Волков', 'Алексеев', 'Лебедев', 'Семёнов', 'Егоров', 'Павлов', 'Козлов',
+            'Степанов', 'Николаев', 'Орлов', 'Андреев', 'Макаров', 'Никитин', 'Захаров', 'Зайцев', 'Щербаков',
+            'Жуков', 'Чернышёв', 'Воробьёв')
+FIRST_NAMES = ('Александр', 'Дмитрий', 'Максим', 'Сергей', 'Андрей', 'Алексей', 'Артём', 'Илья', 'Кирилл',
+               'Михаил', 'Анна', 'Мария', 'Елена', 'Дарья', 'Алёна', 'Ирина', 'Екатерина', 'Юлия', 'Наталья',
+               'Ольга')
+DEPARTMENTS = ('Отдел продаж', 'Бухгалтерия', 'Служба поддержки', 'Отдел кадров', 'Юридический отдел',
+               'Склад', 'Логистика', 'Маркетинг', 'Разработка', 'Служба безопасности', 'Закупки',
+               'Финансовый отдел')
+
+
+def name_corpus(n, seed=0):
+    """
+    n пар (ФИО, e-mail) и n названий комнат с типичными для выгрузки из кадров повторами
+    """
+    rng = random.Random(seed)
+    people = []
+    for i in range(n):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(SURNAMES)
+        people.append(('%s %s' % (last, first), 'user%s@example.com' % i))
+    cities = ('', ' Москва', ' Санкт-Петербург', ' Казань')
+    rooms = [rng.choice(DEPARTMENTS) + rng.choice(cities) for _ in range(n)]
+    return people, rooms
+
+
+def legacy_username(fullname, email):
+    username = translit.translify("_".join(fullname.split(' ')))
+    result = re.findall(r'@\w+.\w+', email)
+    return username + '_' + email.replace(result[0], '')
+
+
+def bench_normalization(n):
+    """
+    Транслитерация логинов и названий комнат: pytils, str.translate, LRU и normalize_many
+    """
+    people, rooms = name_corpus(n)
+    names = [fullname for fullname, _ in people] + rooms
+    expected = [translit.translify("_".join(name.split(' '))) for name in names]
+    assert [helpers.translify_name(name) for name in names] == expected
+    assert helpers.normalize_many(names) == expected
+    assert [helpers.make_username(*person) for person in people] == [legacy_username(*p) for p in people]
+
+    def per_name(name, fn, units):
+        start = time.perf_counter()
+        fn()
+        result = {'name': name, 'us_per_call': (time.perf_counter() - start) / units * 1e6}
+        print('%(name)-40s %(us_per_call)9.2f us/call' % result)
+        return result
+
+    return [
+        per_name('translit pytils', lambda: [translit.translify("_".join(name.split(' ')))
+                                             for name in names], len(names)),
+        per_name('translit str.translate', lambda: [helpers.translify(name.replace(' ', '_'))
+                                                    for name in names], len(names)),
+        per_name('translit LRU (warm)', lambda: [helpers.translify_name(name) for name in names], len(names)),
+        per_name('translit normalize_many', lambda: helpers.normalize_many(names), len(names)),
+        per_name('username legacy', lambda: [legacy_username(*person) for person in people], len(people)),
+        per_name('username make_username', lambda: [helpers.make_username(*person) for person in people],
+                 len(people)),
+    ]
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+    }
+
+
+def compare(previous, results):
+    """
+    Сравнить с сохраненными результатами: изменение пропускной способности и p99 в %
+    """
+    old = dict((item['name'], item) for item in previous['results'])
+    print('\nvs %s (%s)' % (previous['environment'].get('commit'), previous['environment'].get('timestamp')))
+    for item in results:
+        before = old.get(item['name'])
+        if before is None:
+            continue
+        changes = []
+        for key in ('rps', 'per_second', 'us_per_call', 'ms_per_call', 'retained_kb', 'p50_ms', 'p99_ms'):
+            if item.get(key) and before.get(key):
+                changes.append('%s %+.1f%%' % (key, (item[key] / before[key] - 1) * 100))
+        print('%-40s %s' % (item['name'], '  '.join(changes)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=500, help='кол-во вызовов на сценарий')
+    parser.add_argument('--threads', type=int, default=8, help='параллелизм threaded/async клиентов')
+    parser.add_argument('--latency', type=float, default=0.005, help='задержка stub-сервера, сек')
+    parser.add_argument('--rooms', type=int, default=1000, help='комнат на сервере и подписок у пользователя')
+    parser.add_argument('--members', type=int, default=20, help='участников в комнате')
+    parser.add_argument('--users', type=int, default=50, help='пользователей, опрашивающих счетчики')
+    parser.add_argument('--messages', type=int, default=200, help='сообщений в истории каждой комнаты')
+    parser.add_argument('--models', type=int, default=10000, help='элементов в списках для разбора моделей')
+    parser.add_argument('--payload', type=int, default=0, help='байт дополнительных данных в элементах списков')
+    parser.add_argument('--rate-limit', type=int, default=None, help='запросов к методу за окно на stub-сервере')
+    parser.add_argument('--rate-window', type=float, default=1.0, help='окно лимита, сек')
+    parser.add_argument('--suite', choices=('all', 'workflows', 'micro'), default='all')
+    parser.add_argument('--output', help='сохранить результаты в JSON')
+    parser.add_argument('--compare', help='сравнить с сохраненными результатами (JSON)')
+    args = parser.parse_args()
+
+    results = []
+    if args.suite in ('all', 'micro'):
+        results += bench_logging(args.n * 20)
+        results += bench_normalization(args.n * 20)
+        results += bench_models(args.models)
+    with StubServer(latency=args.latency, rooms=args.rooms, members=args.members,
+                    users=max(args.users, args.members * 2), messages=args.messages, payload=args.payload,
+                    rate_limit=args.rate_limit, rate_window=args.rate_window) as server:
+        settings.ROCKETCHAT_URL = server.url
+        if args.suite in ('all', 'micro'):
+            results += bench_transport(server, args.n, args.threads)
+            results += bench_instrumentation(server, args.n, args.threads)
+        if args.suite in ('all', 'workflows'):
+            results += bench_workflows(server, args.n // 10, args.users, args.threads)
+        if args.suite == 'all':
+            results += bench_notifications(server, args.n, args.users, args.threads)
+            results += bench_realtime(server, args.n, args.users, args.threads)
+
+    data = {'environment': environment(), 'params': vars(args), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
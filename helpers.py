@@ -1,738 +1,5153 @@
+import asyncio
+import bisect
+import codecs
+import contextlib
+import contextvars
+import functools
+import gzip
+import heapq
+import inspect
+import itertools
+import json
 import logging
+import os
+import random
 
 import re
+import socket
+import sqlite3
+import threading
+import time
+import weakref
+
+from collections import Counter, OrderedDict, deque, namedtuple
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from pytils import translit
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import websocket
+except ImportError:
+    websocket = None
 
 logger = logging.getLogger(__name__)
 
 
-class ChannelsAPIMixin(object):
+def setting(name, default=None):
+    """
+    Значение из django settings; без настроенного django - default
+    """
+    return getattr(settings, name, default) if settings.configured else default
+
+
+def required_setting(name):
+    value = setting(name)
+    if value is None:
+        raise ImproperlyConfigured('%s is not set' % name)
+    return value
 
-    def create_channels(self, name='', readOnly=False, members=None):
+
+class TokenBucket(object):
+    """
+    Ограничение частоты запросов: rate запросов в секунду, пачкой до capacity.
+    rate=None - без ограничения (пока сервер не попросит подождать)
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate) if rate else None
+        self.capacity = float(capacity or rate or 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.limit = None
+        self.window = 0.0
+        self.remaining = None
+        self.reset_at = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        if self.rate is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _delay(self, now):
+        if self.blocked_until > now:
+            return self.blocked_until - now
+        if self.remaining is not None:
+            if now >= self.reset_at:
+                self.remaining = self.limit
+                self.reset_at = now + self.window
+            if self.remaining is not None and self.remaining <= 0:
+                return self.reset_at - now
+        if self.rate is None or self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def delay(self):
         """
-        Создание публичного канала
-        :param name: Название канала
-        :param readOnly: true/false - возможность установить канал только для чтения
-        :param members: Добавить пользователей в канал
-        :return: Статус, id канала, название канала
+        :return: сколько секунд ждать, пока можно будет сделать запрос
         """
-        name = translit.translify("_".join(name.split(' ')))
-        members = [] if members is None else members
-        data = {
-            'name': name,
-            'members': members,
-            'readOnly': readOnly
-        }
-        resp = requests.post(settings.ROCKETCHAT_URL + '/api/v1/channels.create',
-                             headers=self.headers,
-                             json=data)
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            return self._delay(now)
 
-        if resp.status_code != 200:
-            logger.error('Fail create_channels: %s' % resp.text, exc_info=True)
-            return False
-        logger.info('create_channels.resp - %s' % resp, exc_info=True)
+    def take(self):
+        with self._lock:
+            self._take()
 
-        data = resp.json()
-        return data['success'], data['channel']['_id'], data['channel']['name'],
+    def _take(self):
+        if self.rate is not None:
+            self.tokens -= 1
+        if self.remaining is not None:
+            self.remaining -= 1
 
-    def channels_add_owner(self, roomId, userId):
+    def reserve(self):
         """
-        Добавляем админа в канал
-        :param roomId: id комнаты
-        :param userId: id пользователя в чате
-        :return: status (True/False)
+        Забронировать один запрос
+        :return: сколько секунд подождать перед запросом
         """
-        data = {
-            'roomId': roomId,
-            'userId': userId
-        }
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            delay = self._delay(now)
+            self._take()
+            return delay
 
-        resp = requests.post(settings.ROCKETCHAT_URL + '/api/v1/channels.addOwner',
-                             headers=self.headers,
-                             json=data)
+    def acquire(self):
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
 
-        if resp.status_code != 200:
-            logger.error('Fail channels_add_owner: %s' % resp.text, exc_info=True)
-            return False
-        logger.info('channels_add_owner.resp - %s' % resp, exc_info=True)
-        data = resp.json()
-        return data['success']
+    def block(self, seconds):
+        """
+        Не пропускать запросы ближайшие seconds секунд
+        """
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
 
-    def channels_set_description(self, roomId, description):
+    def observe(self, limit, remaining, reset):
         """
-        Добавляем описание для канала
-        :param roomId: id комнаты
-        :param description: описание
-        :return: status (True/False)
+        Учесть лимит, о котором сообщил сервер
+        :param limit: сколько запросов разрешено за окно (None - неизвестно)
+        :param remaining: сколько запросов осталось в текущем окне
+        :param reset: через сколько секунд окно сбросится
         """
-        data = {
-            'roomId': roomId,
-            'description': description
-        }
+        with self._lock:
+            reset_at = time.monotonic() + reset
+            if self.remaining is None or reset_at > self.reset_at + self.window / 2:
+                self.remaining = remaining
+            else:
+                self.remaining = min(self.remaining, remaining)
+            self.reset_at = reset_at
+            self.limit = limit
+            self.window = max(self.window, reset)
 
-        resp = requests.post(settings.ROCKETCHAT_URL + '/api/v1/channels.setDescription',
-                             headers=self.headers,
-                             json=data)
 
-        if resp.status_code != 200:
-            logger.error('Fail set_description: %s' % resp.text, exc_info=True)
-            return False
-        logger.info('set_description.resp - %s' % resp, exc_info=True)
-        data = resp.json()
-        return data['success']
+INTERACTIVE = 0
+BATCH = 10
+
+request_priority = contextvars.ContextVar('rocketchat_request_priority', default=INTERACTIVE)
+
+
+@contextlib.contextmanager
+def priority(level):
+    """
+    Приоритет запросов внутри блока: INTERACTIVE обслуживаются раньше BATCH
+    """
+    token = request_priority.set(level)
+    try:
+        yield
+    finally:
+        request_priority.reset(token)
+
+
+def run_batch(fn, *args, **kwargs):
+    with priority(BATCH):
+        return fn(*args, **kwargs)
 
-    def channels_set_topic(self, roomId, topic):
+
+class RequestScheduler(object):
+    """
+    Планировщик запросов с учетом лимитов сервера: token bucket на каждый
+    метод API, подстройка по X-RateLimit-*, очередь с приоритетами и
+    повтор 429 с задержкой
+    """
+
+    def __init__(self, rate=None, rates=None, retries=None, backoff_factor=None):
         """
-        Добавляем тему для канала
-        :param roomId: id комнаты
-        :param topic: тема
-        :return: status (True/False)
+        :param rate: запросов в секунду на метод по умолчанию (None - без ограничения)
+        :param rates: {путь: запросов в секунду} для отдельных методов
+        :param retries: сколько раз повторять запрос после 429
+        :param backoff_factor: базовая задержка повтора, если сервер ее не сообщил
         """
-        data = {
-            'roomId': roomId,
-            'topic': topic
-        }
+        self.rate = rate or setting('ROCKETCHAT_RATE_LIMIT', None)
+        self.rates = rates or setting('ROCKETCHAT_RATE_LIMITS', {})
+        self.retries = retries if retries is not None else setting('ROCKETCHAT_RATE_LIMIT_RETRIES', 5)
+        self.backoff_factor = backoff_factor or setting('ROCKETCHAT_RATE_LIMIT_BACKOFF', 0.5)
+        self.buckets = {}
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.throttled = 0
+        self.retried = 0
+        self._waiting = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
 
-        resp = requests.post(settings.ROCKETCHAT_URL + '/api/v1/channels.setTopic',
-                             headers=self.headers,
-                             json=data)
+    def bucket(self, path):
+        bucket = self.buckets.get(path)
+        if bucket is None:
+            with self._cond:
+                bucket = self.buckets.get(path)
+                if bucket is None:
+                    bucket = self.buckets[path] = TokenBucket(self.rates.get(path, self.rate))
+        return bucket
 
-        if resp.status_code != 200:
-            logger.error('Fail set_topic: %s' % resp.text, exc_info=True)
-            return False
-        logger.info('set_topic.resp - %s' % resp, exc_info=True)
-        data = resp.json()
-        return data['success']
+    def acquire(self, path):
+        """
+        Дождаться своей очереди на запрос к методу path; ожидание не дольше
+        срока текущего deadline (DeadlineExceeded)
+        """
+        bucket = self.bucket(path)
+        with self._cond:
+            heap = self._waiting.setdefault(path, [])
+            if not heap and bucket.delay() <= 0:
+                bucket.take()
+                return
+            entry = (request_priority.get(), next(self._seq))
+            heapq.heappush(heap, entry)
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+            start = time.monotonic()
+            try:
+                while True:
+                    delay = bucket.delay() if heap[0] is entry else None
+                    if delay is not None and delay <= 0:
+                        break
+                    remaining = remaining_time()
+                    if remaining is not None:
+                        if remaining <= 0:
+                            raise DeadlineExceeded('Deadline exceeded waiting for rate limit on %s' % path)
+                        delay = remaining if delay is None else min(delay, remaining)
+                    self._cond.wait(delay)
+                bucket.take()
+                self._waited(time.monotonic() - start)
+            finally:
+                # и при исключении (прерывание, срок): иначе очередь ждала бы ушедший запрос
+                if heap[0] is entry:
+                    heapq.heappop(heap)
+                else:
+                    heap.remove(entry)
+                    heapq.heapify(heap)
+                self.queue_depth -= 1
+                self._cond.notify_all()
 
-    def channels_set_type(self, roomId, private=False):
+    async def aacquire(self, path):
         """
-        Публичный/приватный канал
-        :param roomId: id комнаты
-        :param private: True/False
-        :return: status (True/False)
+        То же для asyncio: запросы ждут в порядке бронирования. Если до
+        брони дольше, чем до срока deadline, - сразу DeadlineExceeded
         """
-        type = 'p' if private is True else 'c'
-        data = {
-            'roomId': roomId,
-            'type': type
-        }
+        bucket = self.bucket(path)
+        remaining = remaining_time()
+        if remaining is not None and bucket.delay() >= remaining:
+            raise DeadlineExceeded('Deadline exceeded waiting for rate limit on %s' % path)
+        delay = bucket.reserve()
+        if remaining is not None and delay >= remaining:
+            # раньше забронировали другие запросы
+            raise DeadlineExceeded('Deadline exceeded waiting for rate limit on %s' % path)
+        if delay > 0:
+            with self._cond:
+                self.queue_depth += 1
+                self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                with self._cond:
+                    self.queue_depth -= 1
+                    self._waited(delay)
 
-        resp = requests.post(settings.ROCKETCHAT_URL + '/api/v1/channels.setType',
-                             headers=self.headers,
-                             json=data)
+    def _waited(self, seconds):
+        self.waits += 1
+        self.wait_time += seconds
+        self.max_wait_time = max(self.max_wait_time, seconds)
 
-        if resp.status_code != 200:
-            logger.error('Fail set_type: %s' % resp.text, exc_info=True)
-            return False
-        logger.info('set_type.resp - %s' % resp, exc_info=True)
-        data = resp.json()
-        return data['success']
+    def update(self, path, resp, attempt):
+        """
+        Учесть ответ сервера
+        :param path: путь API
+        :param resp: ответ
+        :param attempt: номер попытки, начиная с 0
+        :return: через сколько секунд повторить запрос или None
+        """
+        headers = resp.headers
+        reset = None
+        if 'X-RateLimit-Reset' in headers:
+            reset = max(int(headers['X-RateLimit-Reset']) / 1000.0 - time.time(), 0.0)
+            if 'X-RateLimit-Remaining' in headers:
+                limit = headers.get('X-RateLimit-Limit')
+                self.bucket(path).observe(int(limit) if limit else None, int(headers['X-RateLimit-Remaining']), reset)
+        if resp.status_code != 429:
+            return None
+        with self._cond:
+            self.throttled += 1
+        if attempt >= self.retries:
+            logger.warning('Rate limited on %s, giving up after %s retries', path, attempt)
+            return None
+        if headers.get('Retry-After', '').isdigit():
+            delay = int(headers['Retry-After']) + random.uniform(0, self.backoff_factor)
+        elif reset is not None:
+            delay = reset + random.uniform(0, self.backoff_factor)
+        else:
+            delay = random.uniform(0, self.backoff_factor * 2 ** attempt)
+        self.bucket(path).block(delay)
+        with self._cond:
+            self.retried += 1
+        return delay
 
-    def channels_rename(self, roomId, name):
+    def metrics(self):
         """
-        Изменить название канала
-        :param roomId: id комнаты
-        :param name: название
-        :return: status (True/False)
+        Счетчики очереди и ожидания
+        :return: dict
         """
-        data = {
-            'roomId': roomId,
-            'name': name
+        return {
+            'queue_depth': self.queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+            'waits': self.waits,
+            'wait_time': self.wait_time,
+            'max_wait_time': self.max_wait_time,
+            'throttled': self.throttled,
+            'retried': self.retried,
         }
 
-        resp = requests.post(settings.ROCKETCHAT_URL + '/api/v1/channels.rename',
-                             headers=self.headers,
-                             json=data)
 
-        if resp.status_code != 200:
-            logger.error('Fail channels_rename: %s' % resp.text, exc_info=True)
-            return False
-        logger.info('channels_rename.resp - %s' % resp, exc_info=True)
-        data = resp.json()
-        return data['success']
+request_origin = contextvars.ContextVar('rocketchat_request_origin', default=None)
+
+
+@contextlib.contextmanager
+def call_origin(name):
+    """
+    Приписать запросы внутри блока view или задаче name (метка origin в метриках).
+    Можно использовать и как декоратор
+    """
+    token = request_origin.set(name)
+    try:
+        yield
+    finally:
+        request_origin.reset(token)
+
+
+class OriginMiddleware(object):
+    """
+    Django middleware: запросы к чату во время обработки view попадают
+    в метрики с origin = <модуль>.<имя view>
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
 
-    def channels_kick(self, roomId, userId):
+    def __call__(self, request):
+        token = request_origin.set(None)
+        try:
+            return self.get_response(request)
+        finally:
+            request_origin.reset(token)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request_origin.set('%s.%s' % (view_func.__module__, getattr(view_func, '__name__', type(view_func).__name__)))
+
+
+def submit(pool, fn, *args, **kwargs):
+    """
+    pool.submit с контекстом вызывающего потока (origin, приоритет)
+    """
+    return pool.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+class Sample(object):
+    """
+    Измерение одного запроса к серверу чата
+    """
+    __slots__ = ('endpoint', 'method', 'status', 'elapsed', 'request_bytes', 'response_bytes',
+                 'retries', 'reused', 'origin')
+
+    def __init__(self, method, path, resp, elapsed, retries=0, reused=None, stream=False):
         """
-        Убрать пользователя из канала
-        :param roomId: id комнаты
-        :param userId: id пользователя в чате
-        :return: status (True/False)
+        :param method: GET/POST
+        :param path: путь API
+        :param resp: ответ requests/httpx (None - ошибка соединения)
+        :param elapsed: время запроса в секундах, включая повторы
+        :param retries: кол-во повторов
+        :param reused: запрос ушел по уже открытому соединению (None - неизвестно)
+        :param stream: тело читается по частям: без Content-Length размер ответа
+            неизвестен до конца чтения (response_bytes = None), тело не читается заранее
         """
-        data = {
-            'roomId': roomId,
-            'userId': userId
-        }
+        self.endpoint = path[len('/api/v1/'):] if path.startswith('/api/v1/') else path
+        self.method = method
+        self.elapsed = elapsed
+        self.retries = retries or 0
+        self.reused = reused
+        self.origin = request_origin.get()
+        if resp is None:
+            self.status = None
+            self.request_bytes = self.response_bytes = 0
+            return
+        self.status = resp.status_code
+        request = resp.request
+        body = request.body if isinstance(request, requests.PreparedRequest) else request.content
+        self.request_bytes = len(body) if body else 0
+        length = resp.headers.get('Content-Length')
+        if length is not None:
+            self.response_bytes = int(length)
+        else:
+            self.response_bytes = None if stream else len(resp.content)
 
-        resp = requests.post(settings.ROCKETCHAT_URL + '/api/v1/channels.kick',
-                             headers=self.headers,
-                             json=data)
 
-        if resp.status_code != 200:
-            logger.error('Fail channels_kick: %s' % resp.text, exc_info=True)
-            return False
-        logger.info('channels_kick.resp - %s' % resp, exc_info=True)
-        data = resp.json()
-        return data['success']
+class Instrumentation(object):
+    """
+    Передает измерения запросов экспортерам. Пока экспортеров нет,
+    транспорт не измеряет запросы вовсе.
+    """
 
-    def channels_invite(self, roomId, userId):
+    def __init__(self, exporters=None):
         """
-        Добавить пользователя в канал
-        :param roomId: id комнаты
-        :param userId: id пользователя в чате
-        :return: status (True/False)
+        :param exporters: объекты с методом observe(sample); по умолчанию
+            классы из settings.ROCKETCHAT_METRICS_EXPORTERS (пути для импорта)
         """
-        data = {
-            'roomId': roomId,
-            'userId': userId
-        }
+        if exporters is None:
+            exporters = [import_string(path)() for path in setting('ROCKETCHAT_METRICS_EXPORTERS', ())]
+        self.exporters = list(exporters)
+        self._lock = threading.Lock()
 
-        resp = requests.post(settings.ROCKETCHAT_URL + '/api/v1/channels.invite',
-                             headers=self.headers,
-                             json=data)
+    def add(self, exporter):
+        with self._lock:
+            self.exporters = self.exporters + [exporter]
+        return exporter
 
-        if resp.status_code != 200:
-            logger.error('Fail channels_invite: %s' % resp.text, exc_info=True)
-            return False
-        logger.info('channels_invite.resp - %s' % resp, exc_info=True)
-        data = resp.json()
-        return data['success']
+    def remove(self, exporter):
+        with self._lock:
+            self.exporters = [e for e in self.exporters if e is not exporter]
 
-    def channels_archive(self, roomId):
+    def observe(self, sample):
+        for exporter in self.exporters:
+            try:
+                exporter.observe(sample)
+            except Exception:
+                logger.exception('Metrics exporter %r failed', exporter)
+
+
+_default_instrumentation = None
+_default_instrumentation_lock = threading.Lock()
+
+
+def get_default_instrumentation():
+    """
+    Общая для процесса точка подключения экспортеров метрик
+    :return: Instrumentation
+    """
+    global _default_instrumentation
+    if _default_instrumentation is None:
+        with _default_instrumentation_lock:
+            if _default_instrumentation is None:
+                _default_instrumentation = Instrumentation()
+    return _default_instrumentation
+
+
+class MetricsRegistry(object):
+    """
+    Экспортер, который накапливает метрики в памяти процесса:
+    гистограммы времени по endpoint и origin, коды ответов, объем данных,
+    повторы и переиспользование соединений
+    """
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, buckets=None):
         """
-        Архивировать канал
-        :param roomId: id комнаты
-        :return: status (True/False)
+        :param buckets: границы корзин гистограммы в секундах
         """
-        data = {
-            'roomId': roomId
-        }
+        self.buckets = tuple(buckets or setting('ROCKETCHAT_METRICS_BUCKETS', self.buckets))
+        self._lock = threading.Lock()
+        self.clear()
 
-        resp = requests.post(settings.ROCKETCHAT_URL + '/api/v1/channels.archive',
-                             headers=self.headers,
-                             json=data)
+    def clear(self):
+        with self._lock:
+            self.latency = {}
+            self.requests = {}
+            self.request_bytes = {}
+            self.response_bytes = {}
+            self.retries = {}
+            self.connections = {}
 
-        if resp.status_code != 200:
-            logger.error('Fail channels_archive: %s' % resp.text, exc_info=True)
-            return False
-        logger.info('channels_archive.resp - %s' % resp, exc_info=True)
-        data = resp.json()
-        return data['success']
+    def observe(self, sample):
+        index = bisect.bisect_left(self.buckets, sample.elapsed)
+        endpoint = sample.endpoint
+        with self._lock:
+            histogram = self.latency.get((endpoint, sample.origin))
+            if histogram is None:
+                histogram = self.latency[(endpoint, sample.origin)] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][index] += 1
+            histogram[1] += sample.elapsed
+            histogram[2] += 1
+            key = (endpoint, sample.method, sample.status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.request_bytes[endpoint] = self.request_bytes.get(endpoint, 0) + sample.request_bytes
+            self.response_bytes[endpoint] = self.response_bytes.get(endpoint, 0) + sample.response_bytes
+            if sample.retries:
+                self.retries[endpoint] = self.retries.get(endpoint, 0) + sample.retries
+            if sample.reused is not None:
+                key = (endpoint, sample.reused)
+                self.connections[key] = self.connections.get(key, 0) + 1
 
-    def channels_unarchive(self, roomId):
+    def quantile(self, q, endpoint, origin=None):
         """
-        Разархивировать канал
-        :param roomId: id комнаты
-        :return: status (True/False)
+        Оценка квантиля времени по гистограмме (верхняя граница корзины)
+        :param q: 0..1
+        :param endpoint: endpoint, например 'channels.setTopic'
+        :param origin: view/задача; None - по всем
+        :return: секунды или None
         """
-        data = {
-            'roomId': roomId
-        }
+        with self._lock:
+            counts = [0] * (len(self.buckets) + 1)
+            for (name, source), (histogram, _, _) in self.latency.items():
+                if name == endpoint and (origin is None or source == origin):
+                    counts = [a + b for a, b in zip(counts, histogram)]
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        for bound, count in zip(self.buckets + (float('inf'),), itertools.accumulate(counts)):
+            if count >= rank:
+                return bound
 
-        resp = requests.post(settings.ROCKETCHAT_URL + '/api/v1/channels.unarchive',
-                             headers=self.headers,
-                             json=data)
+    def snapshot(self):
+        """
+        :return: {endpoint: {'count', 'seconds', 'statuses', 'request_bytes',
+            'response_bytes', 'retries', 'reused', 'origins'}}
+        """
+        result = {}
+        with self._lock:
+            for (endpoint, origin), (_, total, count) in self.latency.items():
+                item = result.setdefault(endpoint, {
+                    'count': 0, 'seconds': 0.0, 'statuses': {}, 'retries': self.retries.get(endpoint, 0),
+                    'request_bytes': self.request_bytes.get(endpoint, 0),
+                    'response_bytes': self.response_bytes.get(endpoint, 0),
+                    'reused': self.connections.get((endpoint, True), 0),
+                    'origins': {},
+                })
+                item['count'] += count
+                item['seconds'] += total
+                item['origins'][origin] = count
+            for (endpoint, method, status), count in self.requests.items():
+                statuses = result[endpoint]['statuses']
+                statuses[status] = statuses.get(status, 0) + count
+        return result
 
-        if resp.status_code != 200:
-            logger.error('Fail channels_unarchive: %s' % resp.text, exc_info=True)
-            return False
-        logger.info('channels_unarchive.resp - %s' % resp, exc_info=True)
-        data = resp.json()
 
-        return data['success']
+def prometheus_labels(**labels):
+    return ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                    for key, value in sorted(labels.items()) if value is not None)
+
 
-    def channels_close(self, roomId):
+class PrometheusExporter(MetricsRegistry):
+    """
+    Реестр метрик в памяти процесса с выдачей в текстовом формате Prometheus
+    """
+
+    def render(self):
         """
-        Закрыть канал
-        :param roomId: id комнаты
-        :return: status (True/False)
+        :return: str для отдачи по /metrics (text/plain; version=0.0.4)
         """
-        data = {
-            'roomId': roomId
-        }
+        lines = [
+            '# HELP rocketchat_request_duration_seconds Rocket.Chat API request latency',
+            '# TYPE rocketchat_request_duration_seconds histogram',
+        ]
+        with self._lock:
+            for (endpoint, origin), (histogram, total, count) in sorted(self.latency.items(), key=str):
+                cumulative = 0
+                for bound, value in zip(self.buckets + ('+Inf',), histogram):
+                    cumulative += value
+                    lines.append('rocketchat_request_duration_seconds_bucket{%s} %s' % (
+                        prometheus_labels(endpoint=endpoint, origin=origin, le=bound), cumulative))
+                labels = prometheus_labels(endpoint=endpoint, origin=origin)
+                lines.append('rocketchat_request_duration_seconds_sum{%s} %r' % (labels, total))
+                lines.append('rocketchat_request_duration_seconds_count{%s} %s' % (labels, count))
+            lines += ['# HELP rocketchat_requests_total Rocket.Chat API requests by status',
+                      '# TYPE rocketchat_requests_total counter']
+            for (endpoint, method, status), count in sorted(self.requests.items(), key=str):
+                lines.append('rocketchat_requests_total{%s} %s' % (
+                    prometheus_labels(endpoint=endpoint, method=method, status=status or 'error'), count))
+            for name, values in (('request_bytes', self.request_bytes), ('response_bytes', self.response_bytes),
+                                 ('retries', self.retries)):
+                lines += ['# TYPE rocketchat_%s_total counter' % name]
+                for endpoint, value in sorted(values.items()):
+                    lines.append('rocketchat_%s_total{%s} %s' % (name, prometheus_labels(endpoint=endpoint), value))
+            lines += ['# TYPE rocketchat_connections_total counter']
+            for (endpoint, reused), count in sorted(self.connections.items(), key=str):
+                lines.append('rocketchat_connections_total{%s} %s' % (
+                    prometheus_labels(endpoint=endpoint, reused=str(reused).lower()), count))
+        return '\n'.join(lines) + '\n'
 
-        resp = requests.post(settings.ROCKETCHAT_URL + '/api/v1/channels.close',
-                             headers=self.headers,
-                             json=data)
 
-        if resp.status_code != 200:
-            logger.error('Fail channels_close: %s' % resp.text, exc_info=True)
-            return False
-        logger.info('channels_close.resp - %s' % resp, exc_info=True)
-        data = resp.json()
-        return data['success']
+class StatsDExporter(object):
+    """
+    Экспортер в StatsD по UDP: время, код ответа, объем данных и повторы
+    """
+
+    def __init__(self, host=None, port=None, prefix=None, tags=None):
+        """
+        :param host: адрес StatsD (по умолчанию settings.ROCKETCHAT_STATSD_HOST или localhost)
+        :param port: порт (8125)
+        :param prefix: префикс метрик ('rocketchat')
+        :param tags: добавлять origin и method как теги DogStatsD
+        """
+        self.address = (host or setting('ROCKETCHAT_STATSD_HOST', 'localhost'),
+                        port or setting('ROCKETCHAT_STATSD_PORT', 8125))
+        self.prefix = prefix or setting('ROCKETCHAT_STATSD_PREFIX', 'rocketchat')
+        self.tags = tags if tags is not None else setting('ROCKETCHAT_STATSD_TAGS', False)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
+    def observe(self, sample):
+        name = '%s.%s' % (self.prefix, sample.endpoint.replace('.', '_'))
+        tags = ''
+        if self.tags:
+            tags = '|#method:%s' % sample.method
+            if sample.origin:
+                tags += ',origin:%s' % sample.origin
+        lines = [
+            '%s.time:%.3f|ms%s' % (name, sample.elapsed * 1000, tags),
+            '%s.status.%s:1|c%s' % (name, sample.status or 'error', tags),
+            '%s.request_bytes:%s|h%s' % (name, sample.request_bytes, tags),
+            '%s.response_bytes:%s|h%s' % (name, sample.response_bytes, tags),
+        ]
+        if sample.retries:
+            lines.append('%s.retries:%s|c%s' % (name, sample.retries, tags))
+        if sample.reused is not None:
+            lines.append('%s.connection.%s:1|c%s' % (name, 'reused' if sample.reused else 'new', tags))
+        try:
+            self.socket.sendto('\n'.join(lines).encode(), self.address)
+        except OSError:
+            pass
 
-class GroupsAPIMixin(object):
 
-    def create_groups(self, name='', readOnly=False, members=None):
+request_deadline = contextvars.ContextVar('rocketchat_request_deadline', default=None)
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    """
+    Ограничить по времени все запросы внутри блока вместе с повторами:
+    таймауты запросов урезаются до оставшегося времени, а новая попытка
+    после истечения срока не начинается (DeadlineExceeded).
+    Вложенный блок не может продлить внешний срок.
+    :param seconds: секунд на весь блок; None - без ограничения
+    """
+    if seconds is None:
+        yield
+        return
+    current = request_deadline.get()
+    value = time.monotonic() + seconds
+    token = request_deadline.set(value if current is None else min(current, value))
+    try:
+        yield
+    finally:
+        request_deadline.reset(token)
+
+
+def remaining_time():
+    """
+    :return: секунд до срока текущего deadline или None
+    """
+    value = request_deadline.get()
+    return None if value is None else value - time.monotonic()
+
+
+def call_deadline():
+    return setting('ROCKETCHAT_DEADLINE', 60)
+
+
+class DeadlineExceeded(TimeoutError):
+    """
+    Срок deadline истек до начала очередной попытки запроса
+    """
+
+
+class DeadlineRetry(Retry):
+    """
+    Retry, который не начинает повтор после срока deadline и не ждет дольше него
+    """
+
+    def is_exhausted(self):
+        remaining = remaining_time()
+        return super(DeadlineRetry, self).is_exhausted() or (remaining is not None and remaining <= 0)
+
+    def get_backoff_time(self):
+        backoff = super(DeadlineRetry, self).get_backoff_time()
+        remaining = remaining_time()
+        return backoff if remaining is None else max(min(backoff, remaining), 0)
+
+
+ENDPOINT_GROUPS = {
+    '/api/v1/login': 'auth',
+    '/api/v1/logout': 'auth',
+    '/api/v1/users.createToken': 'auth',
+    '/api/v1/me': 'users',
+}
+
+
+def endpoint_group(path):
+    """
+    Группа методов API для таймаутов и CircuitBreaker:
+    auth, channels, groups, users, subscriptions, rooms
+    :param path: путь API
+    """
+    group = ENDPOINT_GROUPS.get(path)
+    if group is None:
+        group = path.rpartition('/')[2].partition('.')[0]
+    return group
+
+
+def endpoint_timeout(timeouts, path, default):
+    """
+    :param timeouts: {путь или группа: (connect, read)}
+    :return: (connect, read) таймауты запроса, урезанные до срока deadline
+    """
+    timeout = timeouts.get(path) or timeouts.get(endpoint_group(path)) or default
+    remaining = remaining_time()
+    if remaining is None:
+        return timeout
+    if remaining <= 0:
+        raise DeadlineExceeded('Deadline exceeded before %s' % path)
+    return min(timeout[0], remaining), min(timeout[1], remaining)
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker(object):
+    """
+    Автомат для одной группы методов API: после failures ошибок подряд
+    (ошибка соединения, таймаут, ответ 5xx) запросы отклоняются сразу
+    (CircuitOpen), через reset_timeout секунд пропускается пробный запрос;
+    его успех закрывает автомат, ошибка - снова открывает.
+    """
+
+    def __init__(self, group, failures, reset_timeout, hooks=()):
         """
-        Создание публичного группы
-        :param name: Название группы
-        :param readOnly: true/false - возможность установить группу только для чтения
-        :param members: Добавить пользователей в группу
-        :return: Статус, id канала, название группы
+        :param group: группа методов
+        :param failures: сколько ошибок подряд открывают автомат
+        :param reset_timeout: через сколько секунд пробовать снова
+        :param hooks: функции (группа, старое состояние, новое состояние)
         """
-        name = translit.translify("_".join(name.split(' ')))
-        members = [] if members is None else members
-        data = {
-            'name': name,
-            'members': members,
-            'readOnly': readOnly
-        }
+        self.group = group
+        self.threshold = failures
+        self.reset_timeout = reset_timeout
+        self.hooks = hooks
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.opened = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
 
-        resp = requests.post(settings.ROCKETCHAT_URL + '/api/v1/groups.create',
-                             headers=self.headers,
-                             json=data)
+    def acquire(self):
+        """
+        Разрешение на запрос
+        :raise CircuitOpen: автомат открыт или пробный запрос уже выполняется
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            changed = None
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                changed = self._set(HALF_OPEN)
+            if self.state == HALF_OPEN and not self.probing:
+                self.probing = True
+            else:
+                self.rejected += 1
+                changed = False
+        self._notify(changed)
+        if changed is False:
+            raise CircuitOpen(self.group)
 
-        if resp.status_code != 200:
-            logger.error('Fail create_groups: %s' % resp.text, exc_info=True)
-            return False
-        logger.info('create_groups.resp - %s' % resp, exc_info=True)
+    def success(self):
+        if self.state == CLOSED and not self.failures:
+            return
+        with self._lock:
+            self.failures = 0
+            self.probing = False
+            changed = self._set(CLOSED) if self.state != CLOSED else None
+        self._notify(changed)
 
-        data = resp.json()
-        return data['success'], data['group']['_id'], data['group']['name']
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            self.probing = False
+            changed = None
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.threshold):
+                changed = self._set(OPEN)
+                self.opened_at = time.monotonic()
+                self.opened += 1
+        self._notify(changed)
 
-    def groups_add_owner(self, roomId, userId):
+    def release(self):
         """
-        Добавляем админа в группу
-        :param roomId: id комнаты
-        :param userId: id пользователя в чате
-        :return: status (True/False)
+        Запрос не состоялся (истек deadline) - не считать его ни успехом, ни ошибкой
         """
-        data = {
-            'roomId': roomId,
-            'userId': userId
-        }
+        self.probing = False
 
-        resp = requests.post(settings.ROCKETCHAT_URL + '/api/v1/groups.addOwner',
-                             headers=self.headers,
-                             json=data)
+    def record(self, status_code):
+        if status_code >= 500:
+            self.failure()
+        else:
+            self.success()
 
-        if resp.status_code != 200:
-            logger.error('Fail groups_add_owner: %s' % resp.text, exc_info=True)
-            return False
-        logger.info('groups_add_owner.resp - %s' % resp, exc_info=True)
-        data = resp.json()
-        return data['success']
+    def _set(self, state):
+        changed = (self.state, state)
+        self.state = state
+        return changed
 
-    def groups_set_description(self, roomId, description):
-        """ Добавляем описание для группы
-        :param roomId: id комнаты
-        :param description: описание
-        :return: status (True/False)
-        """
-        data = {
-            'roomId': roomId,
-            'description': description
+    def _notify(self, changed):
+        if not changed:
+            return
+        old, new = changed
+        log = logger.warning if new == OPEN else logger.info
+        log('Circuit %s: %s -> %s', self.group, old, new)
+        for hook in self.hooks:
+            try:
+                hook(self.group, old, new)
+            except Exception:
+                logger.exception('Circuit breaker hook failed')
+
+    def metrics(self):
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'opened': self.opened,
+            'rejected': self.rejected,
         }
 
-        resp = requests.post(settings.ROCKETCHAT_URL + '/api/v1/groups.setDescription',
-                             headers=self.headers,
-                             json=data)
 
-        if resp.status_code != 200:
-            logger.error('Fail groups_set_description: %s' % resp.text, exc_info=True)
-            return False
-        logger.info('groups_set_description.resp - %s' % resp, exc_info=True)
-        data = resp.json()
-        return data['success']
+class CircuitBreakers(object):
+    """
+    CircuitBreaker на каждую группу методов API (endpoint_group) одного сервера
+    """
 
-    def groups_set_topic(self, roomId, topic):
-        """ Добавляем тему для группы
-        :param roomId: id комнаты
-        :param topic: тема
-        :return: status (True/False)
+    def __init__(self, failures=None, reset_timeout=None, hooks=None):
         """
-        data = {
-            'roomId': roomId,
-            'topic': topic
-        }
+        :param failures: сколько ошибок подряд открывают автомат
+        :param reset_timeout: через сколько секунд пробовать снова
+        :param hooks: функции (группа, старое состояние, новое состояние);
+            по умолчанию из settings.ROCKETCHAT_BREAKER_HOOKS (пути для импорта)
+        """
+        self.failures = failures or setting('ROCKETCHAT_BREAKER_FAILURES', 5)
+        self.reset_timeout = reset_timeout if reset_timeout is not None else setting(
+            'ROCKETCHAT_BREAKER_RESET_TIMEOUT', 30)
+        if hooks is None:
+            hooks = [import_string(path) for path in setting('ROCKETCHAT_BREAKER_HOOKS', ())]
+        self.hooks = list(hooks)
+        self.breakers = {}
+        self._lock = threading.Lock()
 
-        resp = requests.post(settings.ROCKETCHAT_URL + '/api/v1/groups.setTopic',
-                             headers=self.headers,
-                             json=data)
+    def get(self, path):
+        group = endpoint_group(path)
+        breaker = self.breakers.get(group)
+        if breaker is None:
+            with self._lock:
+                breaker = self.breakers.get(group)
+                if breaker is None:
+                    breaker = self.breakers[group] = CircuitBreaker(group, self.failures, self.reset_timeout,
+                                                                    self.hooks)
+        return breaker
 
-        if resp.status_code != 200:
-            logger.error('Fail groups_set_topic: %s' % resp.text, exc_info=True)
-            return False
-        logger.info('groups_set_topic.resp - %s' % resp, exc_info=True)
-        data = resp.json()
-        return data['success']
+    def add_hook(self, hook):
+        self.hooks.append(hook)
 
-    def groups_set_type(self, roomId, private=False):
-        """ Публичный/приватный группа
-        :param roomId: id комнаты
-        :param private: True/False
-        :return: status (True/False)
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def metrics(self):
         """
-        type = 'p' if private is True else 'c'
-        data = {
-            'roomId': roomId,
-            'type': type
-        }
+        :return: {группа: {'state', 'failures', 'opened', 'rejected'}}
+        """
+        return dict((group, breaker.metrics()) for group, breaker in list(self.breakers.items()))
 
-        resp = requests.post(settings.ROCKETCHAT_URL + '/api/v1/groups.setType',
-                             headers=self.headers,
-                             json=data)
 
-        if resp.status_code != 200:
-            logger.error('Fail groups_set_type: %s' % resp.text, exc_info=True)
-            return False
-        logger.info('groups_set_type.resp - %s' % resp, exc_info=True)
-        data = resp.json()
-        return data['success']
+class PoolAdapter(HTTPAdapter):
+    """
+    HTTPAdapter, который отмечает в ответе (connection_reused), ушел ли
+    запрос по уже открытому соединению
+    """
 
-    def groups_rename(self, roomId, name):
-        """ Изменить название группы
-        :param roomId: id комнаты
-        :param name: название
-        :return: status (True/False)
-        """
-        data = {
-            'roomId': roomId,
-            'name': name
-        }
+    def build_response(self, req, resp):
+        response = super(PoolAdapter, self).build_response(req, resp)
+        connection = resp.connection
+        sock = getattr(connection, 'sock', None)
+        response.connection_reused = sock is not None and getattr(connection, 'rocketchat_sock', None) is sock
+        if connection is not None:
+            connection.rocketchat_sock = sock
+        return response
 
-        resp = requests.post(settings.ROCKETCHAT_URL + '/api/v1/groups.rename',
-                             headers=self.headers,
-                             json=data)
 
-        if resp.status_code != 200:
-            logger.error('Fail groups_rename: %s' % resp.text, exc_info=True)
-            return False
-        logger.info('groups_rename.resp - %s' % resp, exc_info=True)
-        data = resp.json()
-        return data['success']
+class Transport(object):
+    """
+    Пул keep-alive соединений с сервером чата.
+    Один экземпляр можно разделять между потоками: пул соединений общий,
+    а requests.Session у каждого потока своя.
+    """
 
-    def groups_kick(self, roomId, userId):
-        """ Убрать пользователя из группы
-        :param roomId: id комнаты
-        :param userId: id пользователя в чате
-        :return: status (True/False)
+    def __init__(self, base_url=None, pool_connections=None, pool_maxsize=None,
+                 pool_block=None, timeout=None, retries=None, backoff_factor=None, scheduler=None,
+                 instrumentation=None, timeouts=None, breakers=None, concurrency=None):
         """
-        data = {
-            'roomId': roomId,
-            'userId': userId
-        }
+        :param base_url: адрес сервера чата (по умолчанию settings.ROCKETCHAT_URL)
+        :param pool_connections: кол-во пулов (хостов), которые держим открытыми
+        :param pool_maxsize: максимум соединений к одному хосту
+        :param pool_block: ждать свободное соединение вместо открытия лишнего
+        :param timeout: (connect, read) таймауты в секундах
+        :param retries: кол-во повторов при ошибках соединения и 502/503/504
+        :param backoff_factor: множитель задержки между повторами
+        :param scheduler: RequestScheduler (лимиты запросов)
+        :param instrumentation: Instrumentation (метрики запросов)
+        :param timeouts: {путь или группа методов: (connect, read)} - таймауты отдельных методов
+        :param breakers: CircuitBreakers
+        :param concurrency: максимум одновременных запросов; сверх него запрос
+            ждет не дольше срока deadline (DeadlineExceeded). None - без ограничения
+        """
+        self.base_url = (base_url or required_setting('ROCKETCHAT_URL')).rstrip('/')
+        self.slots = threading.BoundedSemaphore(concurrency) if concurrency else None
+        self.scheduler = scheduler or RequestScheduler()
+        self.instrumentation = instrumentation or get_default_instrumentation()
+        self.timeout = timeout or setting('ROCKETCHAT_TIMEOUT', (3.05, 30))
+        self.timeouts = timeouts if timeouts is not None else setting('ROCKETCHAT_TIMEOUTS', {})
+        self.breakers = breakers or CircuitBreakers()
+        retry = DeadlineRetry(
+            total=retries if retries is not None else setting('ROCKETCHAT_RETRIES', 3),
+            backoff_factor=backoff_factor if backoff_factor is not None else setting('ROCKETCHAT_BACKOFF_FACTOR', 0.3),
+            status_forcelist=(502, 503, 504),
+            raise_on_status=False,
+        )
+        self.adapter = PoolAdapter(
+            pool_connections=pool_connections or setting('ROCKETCHAT_POOL_CONNECTIONS', 10),
+            pool_maxsize=pool_maxsize or setting('ROCKETCHAT_POOL_MAXSIZE', 10),
+            pool_block=pool_block if pool_block is not None else setting('ROCKETCHAT_POOL_BLOCK', False),
+            max_retries=retry,
+        )
+        self._local = threading.local()
 
-        resp = requests.post(settings.ROCKETCHAT_URL + '/api/v1/groups.kick',
-                             headers=self.headers,
-                             json=data)
+    @property
+    def session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', self.adapter)
+            session.mount('https://', self.adapter)
+            self._local.session = session
+        return session
 
-        if resp.status_code != 200:
-            logger.error('Fail groups_kick: %s' % resp.text, exc_info=True)
-            return False
-        logger.info('groups_kick.resp - %s' % resp, exc_info=True)
-        data = resp.json()
-        return data['success']
+    def request(self, method, path, **kwargs):
+        if not self.instrumentation.exporters:
+            return self._request(method, path, kwargs)[0]
+        start = time.perf_counter()
+        resp = None
+        attempt = 0
+        try:
+            resp, attempt = self._request(method, path, kwargs)
+            retries = getattr(resp.raw, 'retries', None)
+            if retries is not None:
+                attempt += len(retries.history)
+            return resp
+        finally:
+            sample = Sample(method, path, resp, time.perf_counter() - start, attempt,
+                            getattr(resp, 'connection_reused', None), kwargs.get('stream', False))
+            if sample.response_bytes is None:
+                self._observe_on_close(resp, sample)
+            else:
+                self.instrumentation.observe(sample)
 
-    def groups_invite(self, roomId, userId):
-        """ Добавить пользователя в группу
-        :param roomId: id комнаты
-        :param userId: id пользователя в чате
-        :return: status (True/False)
+    def _observe_on_close(self, resp, sample):
         """
-        data = {
-            'roomId': roomId,
-            'userId': userId
-        }
+        Потоковый ответ без Content-Length: байты считаются по мере чтения
+        (iter_content), измерение уходит экспортерам при resp.close()
+        """
+        iter_content = resp.iter_content
+        close = resp.close
+        received = [0]
 
-        resp = requests.post(settings.ROCKETCHAT_URL + '/api/v1/groups.invite',
-                             headers=self.headers,
-                             json=data)
+        def counted_iter_content(*args, **kwargs):
+            for chunk in iter_content(*args, **kwargs):
+                received[0] += len(chunk) if isinstance(chunk, bytes) else len(chunk.encode('utf-8'))
+                yield chunk
 
-        if resp.status_code != 200:
-            logger.error('Fail groups_invite: %s' % resp.text, exc_info=True)
-            return False
-        logger.info('groups_invite.resp - %s' % resp, exc_info=True)
-        data = resp.json()
-        return data['success']
+        def observed_close():
+            if sample.response_bytes is None:
+                sample.response_bytes = received[0]
+                self.instrumentation.observe(sample)
+            close()
 
-    def groups_archive(self, roomId):
-        """ Архивировать группу
-        :param roomId: id комнаты
-        :return: status (True/False)
-        """
-        data = {
-            'roomId': roomId
-        }
+        resp.iter_content = counted_iter_content
+        resp.close = observed_close
 
-        resp = requests.post(settings.ROCKETCHAT_URL + '/api/v1/groups.archive',
-                             headers=self.headers,
-                             json=data)
+    def _request(self, method, path, kwargs):
+        if self.slots is None:
+            return self._send(method, path, kwargs)
+        remaining = remaining_time()
+        if not self.slots.acquire(timeout=None if remaining is None else max(remaining, 0)):
+            raise DeadlineExceeded('Deadline exceeded waiting for a connection to %s' % path)
+        try:
+            resp, attempt = self._send(method, path, kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        if kwargs.get('stream'):
+            # соединение занято, пока потоковый ответ не закрыт
+            close = resp.close
+            released = []
 
-        if resp.status_code != 200:
-            logger.error('Fail groups_archive: %s' % resp.text, exc_info=True)
-            return False
-        logger.info('groups_archive.resp - %s' % resp, exc_info=True)
-        data = resp.json()
-        return data['success']
+            def release_on_close():
+                if not released:
+                    released.append(True)
+                    self.slots.release()
+                close()
 
-    def groups_unarchive(self, roomId):
-        """ Разархивировать группу
-        :param roomId: id комнаты
-        :return: status (True/False)
-        """
-        data = {
-            'roomId': roomId
-        }
+            resp.close = release_on_close
+        else:
+            self.slots.release()
+        return resp, attempt
 
-        resp = requests.post(settings.ROCKETCHAT_URL + '/api/v1/groups.unarchive',
-                             headers=self.headers,
-                             json=data)
+    def _send(self, method, path, kwargs):
+        breaker = self.breakers.get(path)
+        breaker.acquire()
+        attempt = 0
+        try:
+            while True:
+                self.scheduler.acquire(path)
+                kwargs['timeout'] = endpoint_timeout(self.timeouts, path, self.timeout)
+                resp = self.session.request(method, self.base_url + path, **kwargs)
+                delay = self.scheduler.update(path, resp, attempt)
+                remaining = remaining_time()
+                if delay is None or (remaining is not None and delay >= remaining):
+                    break
+                resp.close()
+                attempt += 1
+                time.sleep(delay)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            breaker.failure()
+            raise
+        except BaseException:
+            # ошибка на стороне клиента или истек deadline - не ошибка сервера
+            breaker.release()
+            raise
+        breaker.record(resp.status_code)
+        return resp, attempt
 
-        if resp.status_code != 200:
-            logger.error('Fail groups_unarchive: %s' % resp.text, exc_info=True)
-            return False
-        logger.info('groups_unarchive.resp - %s' % resp, exc_info=True)
-        data = resp.json()
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
 
-        return data['success']
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
 
-    def groups_close(self, roomId):
-        """ Закрыть группу
-        :param roomId: id комнаты
-        :return: status (True/False)
-        """
-        data = {
-            'roomId': roomId
-        }
+    def close(self):
+        self.adapter.close()
 
-        resp = requests.post(settings.ROCKETCHAT_URL + '/api/v1/groups.close',
-                             headers=self.headers,
-                             json=data)
 
-        if resp.status_code != 200:
-            logger.error('Fail groups_close: %s' % resp.text, exc_info=True)
-            return False
-        logger.info('groups_close.resp - %s' % resp, exc_info=True)
-        data = resp.json()
-        return data['success']
+_default_transport = None
+_default_transport_lock = threading.Lock()
 
 
-class RocketChat(ChannelsAPIMixin, GroupsAPIMixin):
-    userId = None
-    authToken = None
-    headers = {
-        'X-Auth-Token': None,
-        'X-User-Id': None,
-    }
+def get_default_transport():
+    """
+    Общий для процесса транспорт, создается при первом обращении
+    :return: Transport
+    """
+    global _default_transport
+    if _default_transport is None:
+        with _default_transport_lock:
+            if _default_transport is None:
+                _default_transport = Transport()
+    return _default_transport
 
-    def __init__(self, **kwargs):
-        self.userId, self.authToken = self.authorize(settings.ROCKETCHAT_USERNAME, settings.ROCKETCHAT_PASSWORD)
-        self.headers = {
-            'X-Auth-Token': self.authToken,
-            'X-User-Id': self.userId,
-        }
 
-    def auth_admin(self):
-        self.__init__()
-        return self.userId, self.authToken
+async def acquire_slot(semaphore, path):
+    """
+    Дождаться места в семафоре запросов, но не дольше срока deadline
+    :raise DeadlineExceeded: срок истек раньше
+    """
+    remaining = remaining_time()
+    if remaining is None:
+        await semaphore.acquire()
+        return
+    try:
+        await asyncio.wait_for(semaphore.acquire(), max(remaining, 0))
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded('Deadline exceeded waiting for a connection to %s' % path)
 
-    def get_headers(self, userId):
-        return {
-            'X-Auth-Token': self.create_token(userId),
-            'X-User-Id': userId,
-        }
 
-    def authorize(self, username, password):
+class AsyncTransport(object):
+    """
+    Асинхронный пул keep-alive соединений на httpx.
+    httpx-клиент привязан к event loop, поэтому на каждый loop создается свой
+    клиент и свой семафор; сам объект можно разделять между потоками.
+    """
+
+    def __init__(self, base_url=None, max_connections=None, max_keepalive_connections=None,
+                 timeout=None, retries=None, concurrency=None, scheduler=None, instrumentation=None,
+                 timeouts=None, breakers=None):
         """
-        Авторизация пользователя в чате
-        :param username: логин
-        :param password: пароль
-        :return: userId, authToken
+        :param base_url: адрес сервера чата (по умолчанию settings.ROCKETCHAT_URL)
+        :param max_connections: максимум соединений к серверу
+        :param max_keepalive_connections: сколько соединений держать открытыми
+        :param timeout: (connect, read) таймауты в секундах
+        :param retries: кол-во повторов при ошибках соединения
+        :param concurrency: максимум одновременных запросов в одном event loop
+        :param scheduler: RequestScheduler (лимиты запросов)
+        :param instrumentation: Instrumentation (метрики запросов)
+        :param timeouts: {путь или группа методов: (connect, read)} - таймауты отдельных методов
+        :param breakers: CircuitBreakers
         """
-        data = {
-            'user': username,
-            'password': password
-        }
-        resp = requests.post(settings.ROCKETCHAT_URL + '/api/v1/login',
-                             json=data)
+        if httpx is None:
+            raise ImproperlyConfigured('AsyncTransport requires httpx')
+        self.base_url = (base_url or required_setting('ROCKETCHAT_URL')).rstrip('/')
+        self.scheduler = scheduler or RequestScheduler()
+        self.instrumentation = instrumentation or get_default_instrumentation()
+        self.timeout = timeout or setting('ROCKETCHAT_TIMEOUT', (3.05, 30))
+        self.timeouts = timeouts if timeouts is not None else setting('ROCKETCHAT_TIMEOUTS', {})
+        self.breakers = breakers or CircuitBreakers()
+        self.retries = retries if retries is not None else setting('ROCKETCHAT_RETRIES', 3)
+        self.max_connections = max_connections or setting('ROCKETCHAT_ASYNC_MAX_CONNECTIONS', 100)
+        self.max_keepalive_connections = max_keepalive_connections or setting('ROCKETCHAT_ASYNC_MAX_KEEPALIVE', 20)
+        self.concurrency = concurrency or setting('ROCKETCHAT_ASYNC_CONCURRENCY', 1000)
+        self._loops = weakref.WeakKeyDictionary()
 
-        if resp.status_code != 200:
-            logger.error('Fail authorize: %s' % resp.text, exc_info=True)
-            return None, None
+    def _state(self):
+        loop = asyncio.get_running_loop()
+        state = self._loops.get(loop)
+        if state is None:
+            connect, read = self.timeout
+            limits = httpx.Limits(max_connections=self.max_connections,
+                                  max_keepalive_connections=self.max_keepalive_connections)
+            client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=httpx.Timeout(read, connect=connect),
+                transport=httpx.AsyncHTTPTransport(limits=limits, retries=self.retries),
+            )
+            state = self._loops[loop] = (client, asyncio.Semaphore(self.concurrency))
+        return state
+
+    async def request(self, method, path, **kwargs):
+        if not self.instrumentation.exporters:
+            return (await self._request(method, path, kwargs))[0]
+        connects = []
+
+        async def trace(event, info):
+            if event == 'connection.connect_tcp.started':
+                connects.append(event)
+
+        kwargs['extensions'] = dict(kwargs.get('extensions') or {}, trace=trace)
+        start = time.perf_counter()
+        resp = None
+        attempt = 0
+        try:
+            resp, attempt = await self._request(method, path, kwargs)
+            return resp
+        finally:
+            self.instrumentation.observe(Sample(method, path, resp, time.perf_counter() - start, attempt,
+                                                None if resp is None else not connects))
+
+    async def _request(self, method, path, kwargs):
+        client, semaphore = self._state()
+        breaker = self.breakers.get(path)
+        breaker.acquire()
+        attempt = 0
+        try:
+            while True:
+                await self.scheduler.aacquire(path)
+                await acquire_slot(semaphore, path)
+                try:
+                    connect, read = endpoint_timeout(self.timeouts, path, self.timeout)
+                    resp = await client.request(method, path, timeout=httpx.Timeout(read, connect=connect), **kwargs)
+                finally:
+                    semaphore.release()
+                delay = self.scheduler.update(path, resp, attempt)
+                remaining = remaining_time()
+                if delay is None or (remaining is not None and delay >= remaining):
+                    break
+                attempt += 1
+                await asyncio.sleep(delay)
+        except httpx.TransportError:
+            breaker.failure()
+            raise
+        except BaseException:
+            # ошибка на стороне клиента, отмена или истек deadline - не ошибка сервера
+            breaker.release()
+            raise
+        breaker.record(resp.status_code)
+        return resp, attempt
 
-        logger.info('authorize - %s' % resp, exc_info=True)
+    async def get(self, path, **kwargs):
+        return await self.request('GET', path, **kwargs)
 
-        data = resp.json()['data']
-        return data['userId'], data['authToken']
+    async def post(self, path, **kwargs):
+        return await self.request('POST', path, **kwargs)
 
-    def create_user(self, email, fullname, password):
+    async def aclose(self):
+        state = self._loops.pop(asyncio.get_running_loop(), None)
+        if state is not None:
+            await state[0].aclose()
+
+    def close(self):
         """
-        Создание пользователя в чате
-        :param email: E-mail
-        :param fullname: Фамилия и Имя
-        :param password: пароль
-        :return: id в чате
+        Закрыть клиенты всех event loop из любого потока; клиенты
+        остановленных loop закрываются сборщиком мусора
         """
-        username = translit.translify("_".join(fullname.split(' ')))
-        result = re.findall(r'@\w+.\w+', email)
-        username = username + '_' + email.replace(result[0], '')
+        for loop, (client, _) in list(self._loops.items()):
+            if loop.is_running():
+                asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+        self._loops.clear()
 
-        data = {
-            'email': email,
-            'name': fullname,
-            'username': username,
-            'password': password,
-        }
 
-        resp = requests.post(settings.ROCKETCHAT_URL + '/api/v1/users.create',
-                             headers=self.headers,
-                             json=data)
+_default_async_transport = None
 
-        if resp.status_code != 200:
-            logger.error('Could not create user: %s' % resp.text, exc_info=True)
-            return False
-        logger.info('create_user.resp - %s' % resp, exc_info=True)
-        data = resp.json()['user']
-        return data['_id']
 
-    def logout(self, userId):
+def get_default_async_transport():
+    """
+    Общий для процесса асинхронный транспорт
+    :return: AsyncTransport
+    """
+    global _default_async_transport
+    if _default_async_transport is None:
+        with _default_transport_lock:
+            if _default_async_transport is None:
+                _default_async_transport = AsyncTransport()
+    return _default_async_transport
+
+
+class LRUCache(object):
+    """
+    Кеш в памяти процесса с TTL и LRU-вытеснением
+    """
+
+    def __init__(self, ttl, maxsize):
         """
-        Выход из системы чата
-        :param userId: id пользователя в чате
-        :return: status
+        :param ttl: время жизни записи в секундах
+        :param maxsize: максимум записей в кеше
         """
-        headers = self.get_headers(userId)
-        if headers['X-Auth-Token'] is False:
-            return True
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
 
-        resp = requests.post(settings.ROCKETCHAT_URL + '/api/v1/logout',
-                             headers=headers)
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires <= time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
 
-        if resp.status_code != 200:
-            logger.error('Fail logout', exc_info=True)
-            return False
-        logger.info('logout.resp - %s' % resp, exc_info=True)
-        return resp
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
 
-    def create_token(self, userId):
+    def update(self, key, change):
         """
-        Генерация нового токена для пользователя
-        :param userId: id пользователя в чате
-        :return: authToken
+        Изменить значение, если оно есть в кеше, не продлевая время жизни
+        :param change: функция значение -> новое значение
         """
-        data = {
-            'userId': userId
-        }
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                self._data[key] = (change(item[0]), item[1])
 
-        resp = requests.post(settings.ROCKETCHAT_URL + '/api/v1/users.createToken',
-                             headers=self.headers,
-                             json=data)
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
 
-        if resp.status_code != 200:
-            logger.error('Fail create_token: %s' % resp.text, exc_info=True)
-            return False
-        logger.info('create_token.resp - %s' % resp, exc_info=True)
+    def clear(self):
+        with self._lock:
+            self._data.clear()
 
-        data = resp.json()['data']
-        return data['authToken']
 
-    def update_user(self, userId, **kwargs):
+class TokenCache(LRUCache):
+    """
+    Кеш токенов пользователей в памяти процесса с TTL и LRU-вытеснением
+    """
+
+    def __init__(self, ttl=None, maxsize=None):
         """
-        Обновление данных пользователя в чате
-        :param userId: id пользователя в чате
-        :param kwargs: {"name": "...", "email": "..."}
-        :return: status (True/False)
+        :param ttl: время жизни токена в секундах
+        :param maxsize: максимум пользователей в кеше
         """
-        data = {
-            'userId': userId,
-            'data': kwargs
-        }
-        resp = requests.post(settings.ROCKETCHAT_URL + '/api/v1/users.update',
-                             headers=self.headers,
-                             json=data)
+        super(TokenCache, self).__init__(
+            ttl if ttl is not None else setting('ROCKETCHAT_TOKEN_TTL', 3600),
+            maxsize or setting('ROCKETCHAT_TOKEN_CACHE_SIZE', 10000))
 
-        if resp.status_code != 200:
-            logger.error('Fail update_user: %s' % resp.text, exc_info=True)
-            return False
-        logger.info('update_user.resp - %s' % resp, exc_info=True)
 
-        data = resp.json()
-        return data['success']
+class CacheGeneration(object):
+    """
+    Поколение записей в общем django cache: каждая запись хранит номер
+    поколения, при котором она записана, а clear() только увеличивает
+    номер - старые записи перестают читаться и истекают сами. Остальные
+    ключи того же кеша (сессии, данные других приложений) не трогаются.
+    """
 
-    def about_me(self, userId):
+    def __init__(self, cache, key):
         """
-        Информация о текущем пользователе
-        :param userId: id пользователя в чате
-        :return: json
+        :param cache: django cache
+        :param key: ключ номера поколения
         """
-        headers = self.get_headers(userId)
-
-        resp = requests.get(settings.ROCKETCHAT_URL + '/api/v1/me',
-                            headers=headers)
+        self.cache = cache
+        self.key = key
 
-        if resp.status_code != 200:
-            logger.error('Fail me: %s' % resp.text, exc_info=True)
-            return False
-        logger.info('about_me.resp - %s' % resp, exc_info=True)
-        data = resp.json()
-        return data
+    def current(self):
+        generation = self.cache.get(self.key)
+        return self._start() if generation is None else generation
 
-    def notifications(self, userId):
+    def get(self, key):
         """
-        Информация о новых сообщениях
-        :param userId: id пользователя в чате
-        :return: alert True/False, unread кол-ва новых сообщений
+        Запись вместе с номером поколения, одним запросом к кешу
+        :return: (номер поколения, значение или None)
         """
-        headers = self.get_headers(userId)
+        values = self.cache.get_many([self.key, key])
+        generation = values.get(self.key)
+        return self._start() if generation is None else generation, values.get(key)
 
-        resp = requests.get(settings.ROCKETCHAT_URL + '/api/v1/subscriptions.get',
-                            headers=headers)
+    def _start(self):
+        # номер от текущего времени: если бэкенд вытеснил ключ поколения,
+        # новый номер все равно больше прежних и старые записи не оживут
+        self.cache.add(self.key, int(time.time() * 1000000), None)
+        return self.cache.get(self.key, 0)
+
+    def next(self):
+        self.current()
+        try:
+            return self.cache.incr(self.key)
+        except ValueError:
+            return self._start()
 
-        if resp.status_code != 200:
-            logger.error('Fail notifications: %s' % resp.text, exc_info=True)
-            return False
-        logger.info('notifications.resp - %s' % resp, exc_info=True)
-        data = resp.json()
-
-        alert = False
-        unread = 0
-        for obj in data['update']:
-            if obj['alert'] is True:
-                alert = True
-                unread += obj['unread']
-        return {
-            'alert': alert,
-            'unread': unread
-        }
 
-    def is_unique_name(self, name):
+class DjangoTokenCache(object):
+    """
+    Кеш токенов пользователей в django cache, общий для всех воркеров.
+    Размер кеша ограничивает сам бэкенд, clear() сбрасывает только эти
+    токены (CacheGeneration).
+    """
+
+    def __init__(self, alias='default', ttl=None, prefix='rocketchat:token:'):
         """
-        Проверка на уникальность имени
-        :param name: название
-        :return: True/False
+        :param alias: название кеша из settings.CACHES
+        :param ttl: время жизни токена в секундах
+        :param prefix: префикс ключей
         """
-        params = {
-            'query': {
-                "name": name
-            }
-        }
+        from django.core.cache import caches
 
-        resp_groups = requests.get(settings.ROCKETCHAT_URL + '/api/v1/groups.list',
-                                   headers=self.headers,
-                                   params=params)
+        self.cache = caches[alias]
+        self.ttl = ttl if ttl is not None else setting('ROCKETCHAT_TOKEN_TTL', 3600)
+        self.prefix = prefix
+        self.generation = CacheGeneration(self.cache, prefix.rstrip(':') + '#generation')
 
-        if resp_groups.status_code != 200:
-            logger.error('Fail groups_close: %s' % resp_groups.text, exc_info=True)
-            return False
+    def get(self, userId):
+        generation, item = self.generation.get(self.prefix + userId)
+        if isinstance(item, tuple) and item[1] == generation:
+            return item[0]
+        return None
 
-        resp_channels = requests.get(settings.ROCKETCHAT_URL + '/api/v1/groups.list',
-                                     headers=self.headers,
-                                     params=params)
+    def set(self, userId, token):
+        self.cache.set(self.prefix + userId, (token, self.generation.current()), self.ttl)
 
-        if resp_channels.status_code != 200:
-            logger.error('Fail groups_close: %s' % resp_channels.text, exc_info=True)
-            return False
+    def delete(self, userId):
+        self.cache.delete(self.prefix + userId)
 
-        data_groups = resp_groups.json()
-        data_channels = resp_channels.json()
+    def clear(self):
+        self.generation.next()
 
-        if data_groups['total'] != 0 or data_channels['total'] != 0:
-            return False
-        return True
+
+_default_token_cache = None
+_default_token_cache_lock = threading.Lock()
+
+
+def get_default_token_cache():
+    """
+    Общий для процесса кеш токенов.
+    Если задан settings.ROCKETCHAT_TOKEN_CACHE_ALIAS - токены хранятся в django cache
+    :return: TokenCache/DjangoTokenCache
+    """
+    global _default_token_cache
+    if _default_token_cache is None:
+        with _default_token_cache_lock:
+            if _default_token_cache is None:
+                alias = setting('ROCKETCHAT_TOKEN_CACHE_ALIAS', None)
+                _default_token_cache = DjangoTokenCache(alias) if alias else TokenCache()
+    return _default_token_cache
+
+
+class Subscriptions(object):
+    """
+    Подписки одного пользователя: вклад каждой комнаты в счетчики и
+    текущие итоги alert/unread, которые обновляются по дельте.
+    Удаленные подписки приходят в дельте без rid (только _id и _deletedAt),
+    поэтому храним id подписки -> rid
+    """
+
+    def __init__(self):
+        self.rooms = {}
+        self.ids = {}
+        self.alerts = 0
+        self.unread = 0
+        self.since = None
+        self.synced_at = None
+
+    def reset(self, update):
+        self.rooms = {}
+        self.ids = {}
+        self.alerts = 0
+        self.unread = 0
+        self.since = None
+        self.synced_at = time.monotonic()
+        self.merge(update, ())
+
+    def merge(self, update, remove):
+        for obj in remove:
+            rid = self.ids.pop(obj.get('_id'), None) or obj.get('rid')
+            if rid is not None:
+                self._discard(rid)
+            self._touch(obj.get('_deletedAt'))
+        for obj in update:
+            rid = obj['rid']
+            if obj.get('_id') is not None:
+                self.ids[obj['_id']] = rid
+            self._discard(rid)
+            alert = obj['alert'] is True
+            unread = obj['unread'] if alert else 0
+            self.rooms[rid] = (alert, unread)
+            self.alerts += alert
+            self.unread += unread
+            self._touch(obj.get('_updatedAt'))
+
+    def _discard(self, rid):
+        alert, unread = self.rooms.pop(rid, (False, 0))
+        self.alerts -= alert
+        self.unread -= unread
+
+    def _touch(self, updatedAt):
+        if isinstance(updatedAt, str) and (self.since is None or updatedAt > self.since):
+            self.since = updatedAt
+
+    def totals(self):
+        return {
+            'alert': self.alerts > 0,
+            'unread': self.unread
+        }
+
+
+class SubscriptionStore(object):
+    """
+    Подписки пользователей в памяти процесса с LRU-вытеснением.
+    Между полными синхронизациями запрашиваем только изменения (updatedSince)
+    """
+
+    def __init__(self, resync_interval=None, maxsize=None):
+        """
+        :param resync_interval: через сколько секунд делать полную синхронизацию
+        :param maxsize: максимум пользователей в памяти
+        """
+        self.resync_interval = resync_interval if resync_interval is not None else setting(
+            'ROCKETCHAT_SUBSCRIPTIONS_RESYNC', 300)
+        self.maxsize = maxsize or setting('ROCKETCHAT_SUBSCRIPTIONS_CACHE_SIZE', 10000)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, userId):
+        """
+        :return: Subscriptions или None, если нужна полная синхронизация
+        """
+        with self._lock:
+            state = self._data.get(userId)
+            if state is None:
+                return None
+            if state.since is None or time.monotonic() - state.synced_at >= self.resync_interval:
+                return None
+            self._data.move_to_end(userId)
+            return state
+
+    def reset(self, userId, update):
+        state = Subscriptions()
+        state.reset(update)
+        with self._lock:
+            self._data[userId] = state
+            self._data.move_to_end(userId)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return state.totals()
+
+    def merge(self, state, update, remove):
+        with self._lock:
+            state.merge(update, remove)
+            return state.totals()
+
+    def last_known(self, userId):
+        """
+        :return: последние известные счетчики без учета синхронизации или None
+        """
+        with self._lock:
+            state = self._data.get(userId)
+            return None if state is None else state.totals()
+
+    def delete(self, userId):
+        with self._lock:
+            self._data.pop(userId, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+_default_subscription_store = None
+_default_subscription_store_lock = threading.Lock()
+
+
+def get_default_subscription_store():
+    """
+    Общее для процесса хранилище подписок
+    :return: SubscriptionStore
+    """
+    global _default_subscription_store
+    if _default_subscription_store is None:
+        with _default_subscription_store_lock:
+            if _default_subscription_store is None:
+                _default_subscription_store = SubscriptionStore()
+    return _default_subscription_store
+
+
+TRANSLIT_TABLE = {}
+for _symbol, _replacement in translit.TRANSTABLE:
+    TRANSLIT_TABLE.setdefault(ord(_symbol), _replacement)
+NOT_TRANSLITERATED = re.compile('[\x81-\U0010ffff]')
+
+
+def translify(text):
+    """
+    То же, что pytils translit.translify, но одним str.translate
+    """
+    result = text.translate(TRANSLIT_TABLE)
+    if NOT_TRANSLITERATED.search(result):
+        raise ValueError("Unicode string doesn't transliterate completely, is it russian?")
+    return result
+
+
+_translify_name = None
+
+
+def translify_name(name):
+    """
+    Название для чата: пробелы -> '_', транслит. Результаты запоминаются
+    (LRU, settings.ROCKETCHAT_TRANSLIT_CACHE_SIZE), т.к. при импорте одни и
+    те же фамилии и отделы повторяются тысячи раз
+    :param name: 'Отдел продаж'
+    :return: 'Otdel_prodazh'
+    """
+    global _translify_name
+    if _translify_name is None:
+        _translify_name = functools.lru_cache(setting('ROCKETCHAT_TRANSLIT_CACHE_SIZE', 10000))(
+            lambda name: translify(name.replace(' ', '_')))
+    return _translify_name(name)
+
+
+def normalize_many(names):
+    """
+    translify_name для пачки названий: повторы считаются один раз, а
+    новые названия транслитерируются одним вызовом str.translate
+    :param names: iterable из str
+    :return: список в том же порядке
+    """
+    names = list(names)
+    unique = dict.fromkeys(names)
+    if any('\n' in name for name in unique):
+        for name in unique:
+            unique[name] = translify_name(name)
+    else:
+        result = translify('\n'.join(unique).replace(' ', '_'))
+        unique.update(zip(unique, result.split('\n')))
+    return [unique[name] for name in names]
+
+
+def search_name(name):
+    """
+    Название для поиска комнаты: как translify_name, но символы, для которых
+    нет транслитерации ('café', эмодзи), остаются как есть, без ValueError -
+    такие комнаты на сервере могут быть созданы не через helpers
+    :param name: 'Отдел café'
+    :return: 'Otdel_café'
+    """
+    return name.replace(' ', '_').translate(TRANSLIT_TABLE)
+
+
+def normalize_room_name(name):
+    return search_name(name).lower()
+
+
+class RoomNameIndex(object):
+    """
+    Имена всех комнат сервера (каналы и группы) для проверки уникальности
+    без запросов. Загружается один раз, потом догружает изменения и
+    обновляется нашими же create_*/*_rename/*_delete. Архивные комнаты имя
+    сохраняют. Имена сравниваются без учета регистра, как в unique_name_calls.
+    Удаленные комнаты в изменениях не приходят: занятое по индексу имя
+    проверяется на сервере, и не найденное там из индекса убирается.
+    """
+
+    def __init__(self, refresh_interval=None):
+        """
+        :param refresh_interval: как часто догружать изменения с сервера, сек
+        """
+        self.refresh_interval = refresh_interval if refresh_interval is not None else setting(
+            'ROCKETCHAT_ROOM_INDEX_REFRESH', 60)
+        self.rooms = {}
+        self.names = set()
+        self.since = None
+        self.refreshed_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self.refreshed_at is not None
+
+    def stale(self):
+        return self.refreshed_at is None or time.monotonic() - self.refreshed_at >= self.refresh_interval
+
+    def since_ms(self):
+        return int(datetime.fromisoformat(self.since.replace('Z', '+00:00')).timestamp() * 1000)
+
+    def __contains__(self, name):
+        return normalize_room_name(name) in self.names
+
+    def merge(self, rooms):
+        with self._lock:
+            for room in rooms:
+                self._set(room['_id'], room.get('name'))
+                updatedAt = room.get('_updatedAt')
+                if isinstance(updatedAt, str) and (self.since is None or updatedAt > self.since):
+                    self.since = updatedAt
+            self.refreshed_at = time.monotonic()
+
+    def created(self, result):
+        if isinstance(result, tuple):
+            with self._lock:
+                self._set(result[1], result[2])
+
+    def renamed(self, roomId, name, result):
+        if result is True:
+            with self._lock:
+                self._set(roomId, name)
+
+    def deleted(self, roomId, result):
+        if result is True:
+            with self._lock:
+                name = self.rooms.pop(roomId, None)
+                if name is not None:
+                    self.names.discard(name)
+
+    def discard(self, name):
+        """
+        Имя свободно на сервере: убрать его из индекса
+        """
+        name = normalize_room_name(name)
+        with self._lock:
+            for roomId in [roomId for roomId, value in self.rooms.items() if value == name]:
+                del self.rooms[roomId]
+            self.names.discard(name)
+
+    def _set(self, roomId, name):
+        old = self.rooms.get(roomId)
+        if old is not None:
+            self.names.discard(old)
+        if name:
+            name = normalize_room_name(name)
+            self.rooms[roomId] = name
+            self.names.add(name)
+
+
+_room_indexes = {}
+_room_indexes_lock = threading.Lock()
+
+
+def get_room_index(transport):
+    """
+    Общий для процесса индекс имен комнат сервера транспорта
+    :param transport: Transport/AsyncTransport
+    :return: RoomNameIndex
+    """
+    index = _room_indexes.get(transport.base_url)
+    if index is None:
+        with _room_indexes_lock:
+            index = _room_indexes.setdefault(transport.base_url, RoomNameIndex())
+    return index
+
+
+class CacheStats(object):
+    """
+    Счетчики попаданий и промахов кеша по видам ключей (часть ключа до ':')
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = {}
+        self.misses = {}
+
+    def record(self, key, hit):
+        kind = key.partition(':')[0]
+        counters = self.hits if hit else self.misses
+        with self._lock:
+            counters[kind] = counters.get(kind, 0) + 1
+
+    def snapshot(self):
+        """
+        :return: {вид: {'hits', 'misses', 'ratio'}}
+        """
+        with self._lock:
+            stats = {}
+            for kind in set(self.hits) | set(self.misses):
+                hits, misses = self.hits.get(kind, 0), self.misses.get(kind, 0)
+                stats[kind] = {'hits': hits, 'misses': misses, 'ratio': hits / (hits + misses)}
+            return stats
+
+    def clear(self):
+        with self._lock:
+            self.hits.clear()
+            self.misses.clear()
+
+
+class InfoCache(LRUCache):
+    """
+    Кеш ответов about_me, room_info и user_info в памяти процесса с TTL,
+    LRU-вытеснением и статистикой попаданий. Значения общие для всех
+    вызывающих, изменять их нельзя.
+    """
+
+    def __init__(self, ttl=None, maxsize=None):
+        """
+        :param ttl: время жизни записи в секундах
+        :param maxsize: максимум записей в кеше
+        """
+        super(InfoCache, self).__init__(
+            ttl if ttl is not None else setting('ROCKETCHAT_INFO_CACHE_TTL', 60),
+            maxsize or setting('ROCKETCHAT_INFO_CACHE_SIZE', 10000))
+        self.counters = CacheStats()
+
+    def get(self, key):
+        value = super(InfoCache, self).get(key)
+        self.counters.record(key, value is not None)
+        return value
+
+    def stats(self):
+        return self.counters.snapshot()
+
+
+class DjangoInfoCache(object):
+    """
+    Кеш ответов about_me, room_info и user_info в django cache, общий для
+    всех воркеров; clear() сбрасывает только эти записи (CacheGeneration).
+    Статистика попаданий - по текущему процессу.
+    """
+
+    def __init__(self, alias='default', ttl=None, prefix='rocketchat:info:'):
+        """
+        :param alias: название кеша из settings.CACHES
+        :param ttl: время жизни записи в секундах
+        :param prefix: префикс ключей
+        """
+        from django.core.cache import caches
+
+        self.cache = caches[alias]
+        self.ttl = ttl if ttl is not None else setting('ROCKETCHAT_INFO_CACHE_TTL', 60)
+        self.prefix = prefix
+        self.generation = CacheGeneration(self.cache, prefix.rstrip(':') + '#generation')
+        self.counters = CacheStats()
+
+    def _get(self, key):
+        generation, item = self.generation.get(self.prefix + key)
+        return item if isinstance(item, tuple) and len(item) == 3 and item[2] == generation else None
+
+    def get(self, key):
+        item = self._get(key)
+        self.counters.record(key, item is not None)
+        return None if item is None else item[0]
+
+    def set(self, key, value):
+        self.cache.set(self.prefix + key, (value, time.time() + self.ttl, self.generation.current()), self.ttl)
+
+    def update(self, key, change):
+        item = self._get(key)
+        if item is not None:
+            timeout = item[1] - time.time()
+            if timeout > 0:
+                self.cache.set(self.prefix + key, (change(item[0]), item[1], item[2]), timeout)
+
+    def delete(self, key):
+        self.cache.delete(self.prefix + key)
+
+    def clear(self):
+        self.generation.next()
+
+    def stats(self):
+        return self.counters.snapshot()
+
+
+_info_caches = {}
+_info_caches_lock = threading.Lock()
+
+
+def get_info_cache(transport):
+    """
+    Общий для процесса кеш about_me/room_info/user_info сервера транспорта.
+    Если задан settings.ROCKETCHAT_INFO_CACHE_ALIAS - записи хранятся в django cache
+    :param transport: Transport/AsyncTransport
+    :return: InfoCache/DjangoInfoCache
+    """
+    cache = _info_caches.get(transport.base_url)
+    if cache is None:
+        with _info_caches_lock:
+            cache = _info_caches.get(transport.base_url)
+            if cache is None:
+                alias = setting('ROCKETCHAT_INFO_CACHE_ALIAS', None)
+                cache = _info_caches[transport.base_url] = (
+                    DjangoInfoCache(alias, prefix='rocketchat:info:%s:' % transport.base_url) if alias
+                    else InfoCache())
+    return cache
+
+
+class Flight(object):
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Объединение одинаковых одновременных чтений: пока запрос с ключом
+    выполняется, остальные вызовы с тем же ключом ждут его результат, а
+    следующие window секунд получают его без запроса. Работает для потоков
+    (do) и корутин (ado); ожидание общее в пределах одного event loop.
+    Результат общий для всех вызывающих, изменять его нельзя.
+    """
+
+    def __init__(self, window=None):
+        """
+        :param window: сколько секунд отдавать результат повторным вызовам
+        """
+        self.window = window if window is not None else setting('ROCKETCHAT_COALESCE_WINDOW', 0.5)
+        self.calls = 0
+        self.executed = 0
+        self.coalesced = 0
+        self.reused = 0
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._async_flights = weakref.WeakKeyDictionary()
+        self._results = OrderedDict()
+
+    def _reuse(self, key, now):
+        while self._results:
+            first = next(iter(self._results.values()))
+            if first[1] > now:
+                break
+            self._results.popitem(last=False)
+        return self._results.get(key)
+
+    def _done(self, key, result):
+        if self.window and result is not False:
+            self._results[key] = (result, time.monotonic() + self.window)
+            self._results.move_to_end(key)
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        :param key: ключ вызова (hashable), например (метод, аргументы)
+        :return: fn(*args, **kwargs), общий для одновременных вызовов с key
+        """
+        try:
+            hash(key)
+        except TypeError:
+            return fn(*args, **kwargs)
+        with self._lock:
+            self.calls += 1
+            reused = self._reuse(key, time.monotonic())
+            if reused is not None:
+                self.reused += 1
+                return reused[0]
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+                self.executed += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = fn(*args, **kwargs)
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+                if flight.error is None:
+                    self._done(key, flight.result)
+            flight.event.set()
+
+    async def ado(self, key, fn, *args, **kwargs):
+        """
+        То же для корутин: fn(*args, **kwargs) возвращает awaitable.
+        Запрос выполняется отдельной задачей, все вызывающие (и первый тоже)
+        ждут ее через shield: отмена одного из них не отменяет запрос остальным
+        """
+        try:
+            hash(key)
+        except TypeError:
+            return await fn(*args, **kwargs)
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self.calls += 1
+            reused = self._reuse(key, time.monotonic())
+            if reused is not None:
+                self.reused += 1
+                return reused[0]
+            flights = self._async_flights.setdefault(loop, {})
+            task = flights.get(key)
+            if task is None:
+                task = flights[key] = loop.create_task(self._flight(flights, key, fn, args, kwargs))
+                task.add_done_callback(lambda task: task.cancelled() or task.exception())
+                self.executed += 1
+            else:
+                self.coalesced += 1
+        return await asyncio.shield(task)
+
+    async def _flight(self, flights, key, fn, args, kwargs):
+        try:
+            result = await fn(*args, **kwargs)
+        except BaseException:
+            with self._lock:
+                del flights[key]
+            raise
+        with self._lock:
+            del flights[key]
+            self._done(key, result)
+        return result
+
+    def metrics(self):
+        """
+        Счетчики: calls - всего вызовов, executed - выполнено запросов,
+        coalesced - дождались чужого запроса, reused - результат из окна window
+        :return: dict
+        """
+        return {
+            'calls': self.calls,
+            'executed': self.executed,
+            'coalesced': self.coalesced,
+            'reused': self.reused,
+        }
+
+
+def coalesced(method):
+    """
+    Декоратор метода клиента: одновременные вызовы с одинаковыми аргументами
+    выполняются одним запросом (SingleFlight клиента)
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        key = (method.__name__,) + args + tuple(sorted(kwargs.items()))
+        return self._coalesce(key, method, self, *args, **kwargs)
+    return wrapper
+
+
+_single_flights = {}
+_single_flights_lock = threading.Lock()
+
+
+def get_single_flight(transport):
+    """
+    Общее для процесса объединение запросов к серверу транспорта
+    :param transport: Transport/AsyncTransport
+    :return: SingleFlight
+    """
+    single_flight = _single_flights.get(transport.base_url)
+    if single_flight is None:
+        with _single_flights_lock:
+            single_flight = _single_flights.setdefault(transport.base_url, SingleFlight())
+    return single_flight
+
+
+SECRET_FIELDS = re.compile(r'("(?:authToken|X-Auth-Token|password|token)"\s*:\s*")[^"]*')
+
+
+class RequestLog(object):
+    """
+    Структурированный лог запросов к API.
+    Строки форматируются лениво (только если уровень включен), успешные
+    запросы пишутся с заданной долей (sampling), тело ответа при ошибке
+    обрезается, токены и пароли в нем скрываются. Заголовки запроса
+    (X-Auth-Token) в лог не попадают. Поля записи доступны обработчикам
+    в record.rocketchat.
+    """
+
+    def __init__(self, sample=None, samples=None, body_limit=None, name=None):
+        """
+        :param sample: доля успешных запросов, которые попадают в лог (0..1)
+        :param samples: доли по отдельным операциям или путям API {'channels_set_topic': 0.1}
+        :param body_limit: сколько байт тела ответа писать при ошибке
+        :param name: имя logger'а
+        """
+        self.sample = sample if sample is not None else setting('ROCKETCHAT_LOG_SAMPLE', 1.0)
+        self.samples = samples if samples is not None else setting('ROCKETCHAT_LOG_SAMPLES', {})
+        self.body_limit = body_limit if body_limit is not None else setting('ROCKETCHAT_LOG_BODY_LIMIT',
+                                                                            1024)
+        self.logger = logging.getLogger(name) if name else logger
+
+    def sampled(self, call):
+        rate = self.samples.get(call.name)
+        if rate is None:
+            rate = self.samples.get(call.path, self.sample)
+        return rate >= 1 or random.random() < rate
+
+    def body(self, resp):
+        content = resp.content
+        text = SECRET_FIELDS.sub(r'\1***', content[:self.body_limit].decode('utf-8', 'replace'))
+        if len(content) > self.body_limit:
+            text += '... (%s bytes)' % len(content)
+        return text
+
+    def fields(self, call, resp, elapsed):
+        return {'rocketchat': {
+            'endpoint': call.name,
+            'method': call.method,
+            'path': call.path,
+            'status': resp.status_code,
+            'elapsed_ms': elapsed * 1000 if elapsed is not None else None,
+            'userId': call.userId,
+        }}
+
+    def success(self, call, resp, elapsed=None):
+        if self.logger.isEnabledFor(logging.INFO) and self.sampled(call):
+            self.logger.info('%s %s %s -> %s in %.1fms', call.name, call.method, call.path, resp.status_code,
+                             (elapsed or 0) * 1000, extra=self.fields(call, resp, elapsed))
+
+    def failure(self, call, resp, elapsed=None):
+        if self.logger.isEnabledFor(logging.ERROR):
+            self.logger.error('Fail %s %s %s -> %s in %.1fms: %s', call.name, call.method, call.path,
+                              resp.status_code, (elapsed or 0) * 1000, self.body(resp),
+                              extra=self.fields(call, resp, elapsed))
+
+
+_default_request_log = None
+
+
+def get_default_request_log():
+    """
+    Общий для процесса лог запросов
+    :return: RequestLog
+    """
+    global _default_request_log
+    if _default_request_log is None:
+        _default_request_log = RequestLog()
+    return _default_request_log
+
+
+class APIError(Exception):
+    """
+    Ошибка, которую вернул сервер чата
+    """
+
+    def __init__(self, status, message):
+        super(APIError, self).__init__(status, message)
+        self.status = status
+        self.message = message
+
+    def __str__(self):
+        return '%s: %s' % (self.status, self.message)
+
+
+class CircuitOpen(APIError):
+    """
+    Запрос отклонен без обращения к серверу: CircuitBreaker группы методов открыт
+    """
+
+    def __init__(self, group):
+        super(CircuitOpen, self).__init__(503, 'Circuit open for %s' % group)
+        self.group = group
+
+
+def api_error(resp):
+    """
+    Разбор ответа с ошибкой: APIError с сообщением сервера
+    """
+    try:
+        message = decode(resp.content).get('error')
+    except ValueError:
+        message = None
+    return APIError(resp.status_code, message or resp.content[:200].decode('utf-8', 'replace'))
+
+
+class Call(object):
+    """
+    Описание одного запроса к API: что отправить и как разобрать ответ.
+    Общее для синхронного и асинхронного клиентов.
+    """
+    __slots__ = ('name', 'method', 'path', 'kwargs', 'userId', 'auth', 'parse', 'error', 'after', 'cache')
+
+    def __init__(self, name, method, path, json=None, params=None, userId=None,
+                 auth=True, parse=None, error=False, after=None, stream=False, cache=None):
+        """
+        :param name: название операции для логов
+        :param method: GET/POST
+        :param path: путь API
+        :param json: тело запроса
+        :param params: query-параметры
+        :param userId: выполнить от имени пользователя (иначе от администратора)
+        :param auth: False - запрос без авторизации
+        :param parse: функция resp -> результат (по умолчанию поле success)
+        :param error: результат при ошибке или функция resp -> результат
+        :param after: функция result -> None, вызывается после успешного запроса
+        :param stream: не читать тело ответа заранее (только синхронный транспорт),
+            parse сам читает его по частям
+        :param cache: ключ в кеше клиента (info_cache): результат берется из кеша,
+            а успешный ответ сохраняется в него
+        """
+        self.name = name
+        self.method = method
+        self.path = path
+        self.kwargs = {}
+        if json is not None:
+            self.kwargs['json'] = json
+        if params is not None:
+            self.kwargs['params'] = params
+        if stream:
+            self.kwargs['stream'] = True
+        self.userId = userId
+        self.auth = auth
+        self.parse = parse or success_result
+        self.error = error
+        self.after = after
+        self.cache = cache
+
+    def handle(self, resp, elapsed=None, log=None):
+        """
+        Разобрать ответ
+        :param resp: ответ сервера
+        :param elapsed: время запроса в секундах (для лога)
+        :param log: RequestLog (по умолчанию общий для процесса)
+        :return: результат parse или error
+        """
+        log = log or get_default_request_log()
+        if resp.status_code != 200:
+            log.failure(self, resp, elapsed)
+            try:
+                return self.error(resp) if callable(self.error) else self.error
+            finally:
+                if 'stream' in self.kwargs:
+                    # тело ошибки прочитано, потоковый ответ больше не нужен
+                    resp.close()
+        log.success(self, resp, elapsed)
+        result = self.parse(resp)
+        if self.after is not None:
+            self.after(result)
+        return result
+
+    def unauthorized(self):
+        """
+        Результат, если запрос не отправлен: не удалось выпустить токен пользователя
+        """
+        return APIError(401, 'Can not create token for %s' % self.userId) if callable(self.error) else self.error
+
+
+def success_result(resp):
+    return decode(resp.content)['success']
+
+
+def room_result(key):
+    """
+    Разбор ответа channels.create/groups.create
+    :param key: channel/group
+    :return: функция resp -> RoomCreated(Статус, id, название)
+    """
+    def parse(resp):
+        data = decode(resp.content)
+        return RoomCreated(data['success'], data[key]['_id'], data[key]['name'])
+    return parse
+
+
+def total_result(resp):
+    return decode(resp.content)['total']
+
+
+def json_result(resp):
+    return decode(resp.content)
+
+
+def decode(content):
+    """
+    Разбор JSON: orjson, если установлен (в несколько раз быстрее json)
+    :param content: тело ответа (bytes)
+    """
+    return orjson.loads(content) if orjson is not None else json.loads(content)
+
+
+class Model(object):
+    """
+    Компактный результат API: из JSON берутся только объявленные поля,
+    остальное сразу освобождается. Методы клиента возвращают dict, как и
+    раньше; модели - по запросу (iter_channels(model=Room),
+    Room.from_json(...)) и внутри helpers, где результат наружу не отдается.
+    Доступ по ключам JSON как у dict (room['_id'], room.get('topic'),
+    'topic' in room, dict(room)), для json.dumps - to_dict(); атрибуты - те
+    же поля без '_' в начале (room.id, room.updatedAt), отсутствующее поле - None.
+    """
+    __slots__ = ()
+    fields = ()
+
+    def __init__(self, **values):
+        """
+        :param values: поля с ключами JSON
+        """
+        for key, value in values.items():
+            if key not in self._attrs:
+                raise TypeError('%s has no field %r' % (type(self).__name__, key))
+            object.__setattr__(self, self._attrs[key], value)
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        :param data: объект из ответа API
+        :return: модель только с объявленными полями
+        """
+        obj = cls.__new__(cls)
+        for key, set_slot in cls._setters:
+            if key in data:
+                set_slot(obj, data[key])
+        return obj
+
+    @classmethod
+    def from_list(cls, items):
+        return [cls.from_json(item) for item in items]
+
+    def __getattr__(self, name):
+        # не заданный слот: поле не пришло в ответе
+        if name in self._keys:
+            return None
+        raise AttributeError(name)
+
+    def __getitem__(self, key):
+        try:
+            return object.__getattribute__(self, self._attrs[key])
+        except (KeyError, AttributeError):
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return (key for attr, key in self.fields if key in self)
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def keys(self):
+        return [key for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def replace(self, **changes):
+        """
+        Копия с измененными полями
+        :param changes: поля с ключами JSON
+        """
+        return self.from_json(dict(self.to_dict(), **changes))
+
+    def __eq__(self, other):
+        if isinstance(other, Model):
+            return type(self) is type(other) and self.to_dict() == other.to_dict()
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __reduce__(self):
+        return self.from_json, (self.to_dict(),)
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join('%s=%r' % item for item in self.items()))
+
+
+def model_fields(*keys):
+    """
+    Поля модели: ((атрибут, ключ JSON), ...), атрибут - ключ без '_' в начале
+    """
+    return tuple((key.lstrip('_'), key) for key in keys)
+
+
+class Room(Model):
+    fields = model_fields('_id', 'name', 'fname', 't', 'topic', 'description', 'announcement', 'usersCount',
+                          'msgs', 'archived', 'ro', 'default', '_updatedAt')
+    __slots__ = tuple(attr for attr, key in fields)
+
+
+class User(Model):
+    fields = model_fields('_id', 'username', 'name', 'emails', 'status', 'active', 'roles', 'type', 'utcOffset',
+                          '_updatedAt')
+    __slots__ = tuple(attr for attr, key in fields)
+
+
+class Subscription(Model):
+    fields = model_fields('_id', 'rid', 'name', 'fname', 't', 'alert', 'unread', 'userMentions', 'open',
+                          '_updatedAt', '_deletedAt')
+    __slots__ = tuple(attr for attr, key in fields)
+
+
+class Message(Model):
+    fields = model_fields('_id', 'rid', 'msg', 'ts', 'u', 'tmid', 'attachments', 'editedAt', '_updatedAt')
+    __slots__ = tuple(attr for attr, key in fields)
+
+
+for _model in (Room, User, Subscription, Message):
+    _model._attrs = dict((key, attr) for attr, key in _model.fields)
+    _model._keys = frozenset(attr for attr, key in _model.fields)
+    _model._setters = tuple((key, getattr(_model, attr).__set__) for attr, key in _model.fields)
+
+
+RoomCreated = namedtuple('RoomCreated', 'success id name')
+RoomCreated.__doc__ = 'Результат create_channels/create_groups; распаковывается как прежний кортеж'
+
+
+def subscriptions_result(resp):
+    """
+    Разбор subscriptions.get: {'update': [Subscription, ...], 'remove': [Subscription, ...]}
+    """
+    data = decode(resp.content)
+    return {'update': Subscription.from_list(data['update']), 'remove': Subscription.from_list(data.get('remove', ()))}
+
+
+def iter_json_array(resp, key, chunk_size=65536):
+    """
+    Элементы списка key из JSON-ответа по мере чтения тела: в памяти
+    только текущий кусок и текущий элемент. Элементы - объекты.
+    :param resp: ответ requests с stream=True
+    :param key: ключ списка ('messages')
+    :return: генератор элементов
+    """
+    start = re.compile(r'"%s"\s*:\s*\[' % re.escape(key))
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    chunks = resp.iter_content(chunk_size)
+    buffer = ''
+    try:
+        match = None
+        while match is None:
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise ValueError('No %r array in response' % key)
+            buffer += text.decode(chunk)
+            match = start.search(buffer)
+        buffer = buffer[match.end():]
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == ']':
+                return
+            try:
+                if pos == len(buffer):
+                    raise ValueError('Need more data')
+                item, pos = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    raise
+                buffer = buffer[pos:] + text.decode(chunk)
+                pos = 0
+                continue
+            yield item
+    finally:
+        resp.close()
+
+
+def login_call(username, password):
+    data = {
+        'user': username,
+        'password': password
+    }
+    return Call('authorize', 'POST', '/api/v1/login', json=data, auth=False, error=(None, None),
+                parse=lambda resp: tuple(decode(resp.content)['data'][key] for key in ('userId', 'authToken')))
+
+
+def logout_call(userId):
+    return Call('logout', 'POST', '/api/v1/logout', userId=userId, parse=lambda resp: resp)
+
+
+def unique_name_calls(name):
+    # без учета регистра, как в RoomNameIndex
+    params = {
+        'query': json.dumps({
+            "name": {"$regex": '^%s$' % re.escape(search_name(name)), "$options": "i"}
+        }),
+        'count': 1
+    }
+    return (Call('groups_list', 'GET', '/api/v1/groups.listAll', params=params, parse=total_result),
+            Call('channels_list', 'GET', '/api/v1/channels.list', params=params, parse=total_result))
+
+
+def unique_name_result(groups_total, channels_total):
+    if groups_total is False or channels_total is False:
+        return False
+    return groups_total == 0 and channels_total == 0
+
+
+def page_size():
+    return setting('ROCKETCHAT_PAGE_SIZE', 100)
+
+
+def list_pages(name, path, key, params=None, model=None):
+    """
+    Все элементы списочного метода API, постранично (offset/count)
+    :param name: название операции для логов
+    :param path: путь API
+    :param key: ключ списка в ответе (channels, groups, members, ...)
+    :param params: дополнительные query-параметры
+    :param model: Room/User/... - хранить элементы моделями, None - как в JSON
+    :return: генератор для _run, результат - список или False
+    """
+    items = []
+    offset = 0
+    while True:
+        page = dict(params or {}, offset=offset, count=page_size())
+        data = yield Call(name, 'GET', path, params=page, parse=json_result)
+        if data is False:
+            return False
+        items.extend(data[key] if model is None else model.from_list(data[key]))
+        offset += len(data[key])
+        if not data[key] or offset >= data['total']:
+            return items
+
+
+def members_pages(prefix, roomId):
+    """
+    Все участники комнаты, постранично (channels.members/groups.members)
+    :param prefix: channels/groups
+    :param roomId: id комнаты
+    :return: генератор для _run, результат - список участников или False
+    """
+    return list_pages(prefix + '_members', '/api/v1/%s.members' % prefix, 'members', {'roomId': roomId})
+
+
+def room_index_steps(index):
+    """
+    Загрузка индекса имен комнат: при первом вызове все каналы и группы,
+    потом только изменившиеся с прошлого раза
+    :param index: RoomNameIndex
+    :return: генератор для _run, результат - True или False
+    """
+    params = {'fields': json.dumps({'name': 1, '_updatedAt': 1})}
+    if index.since is not None:
+        params['query'] = json.dumps({'_updatedAt': {'$gt': {'$date': index.since_ms()}}})
+    channels = yield from list_pages('channels_list', '/api/v1/channels.list', 'channels', params, Room)
+    if channels is False:
+        return False
+    groups = yield from list_pages('groups_list', '/api/v1/groups.listAll', 'groups', params, Room)
+    if groups is False:
+        return False
+    index.merge(channels + groups)
+    return True
+
+
+def notifications_steps(store, userId):
+    """
+    Счетчики непрочитанного: полная синхронизация подписок или только
+    изменения с прошлого раза
+    :param store: SubscriptionStore
+    :param userId: id пользователя в чате
+    :return: генератор для _run, результат - {'alert': ..., 'unread': ...} или False;
+        пока сервер недоступен (CircuitOpen) - последние известные счетчики
+    """
+    state = store.get(userId)
+    params = None if state is None else {'updatedSince': state.since}
+    try:
+        data = yield Call('notifications', 'GET', '/api/v1/subscriptions.get', userId=userId, params=params,
+                          parse=subscriptions_result)
+    except CircuitOpen:
+        totals = store.last_known(userId)
+        if totals is None:
+            raise
+        return totals
+    if data is False:
+        return False
+    if state is None:
+        return store.reset(userId, data['update'])
+    return store.merge(state, data['update'], data['remove'])
+
+
+def membership_plan(current, target, keep=(), kick=True):
+    """
+    Какие приглашения и исключения нужны, чтобы состав комнаты стал target
+    :param current: id текущих участников
+    :param target: id нужных участников
+    :param keep: id, которых нельзя исключать
+    :param kick: исключать лишних
+    :return: [(userId, 'invite'/'kick'), ...], id участников без изменений
+    """
+    current = set(current)
+    target = set(target)
+    actions = [(userId, 'invite') for userId in target - current]
+    if kick:
+        actions.extend((userId, 'kick') for userId in current - target - set(keep))
+    return actions, current & target
+
+
+def membership_report(unchanged, actions, results):
+    report = dict((userId, {'action': None, 'success': True}) for userId in unchanged)
+    for (userId, action), result in zip(actions, results):
+        if isinstance(result, Exception):
+            logger.error('Fail sync_members %s %s: %r', action, userId, result)
+            report[userId] = {'action': action, 'success': False, 'error': repr(result)}
+        else:
+            report[userId] = {'action': action, 'success': result is True}
+    return report
+
+
+def login(transport, username, password):
+    """
+    Авторизация пользователя в чате
+    :param transport: Transport
+    :param username: логин
+    :param password: пароль
+    :return: userId, authToken
+    """
+    call = login_call(username, password)
+    start = time.perf_counter()
+    resp = transport.request(call.method, call.path, **call.kwargs)
+    return call.handle(resp, time.perf_counter() - start)
+
+
+async def alogin(transport, username, password):
+    """
+    Авторизация пользователя в чате через асинхронный транспорт
+    :param transport: AsyncTransport
+    :param username: логин
+    :param password: пароль
+    :return: userId, authToken
+    """
+    call = login_call(username, password)
+    start = time.perf_counter()
+    resp = await transport.request(call.method, call.path, **call.kwargs)
+    return call.handle(resp, time.perf_counter() - start)
+
+
+class AdminSession(object):
+    """
+    Сессия администратора, общая для всех клиентов процесса.
+    Логинимся лениво, при первом запросе. Если токен нужен многим потокам
+    (или корутинам) одновременно, логин выполняется ровно один раз.
+    """
+
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+        self.userId = None
+        self.authToken = None
+        self.logins = 0
+        self.login_failures = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+        self._async_locks = weakref.WeakKeyDictionary()
+
+    def get(self, transport):
+        """
+        Текущие userId и authToken, при необходимости логинимся
+        :param transport: Transport, через который логиниться
+        :return: userId, authToken
+        """
+        authToken = self.authToken
+        if authToken is not None:
+            return self.userId, authToken
+        with self._lock:
+            if self.authToken is None:
+                self._store(*login(transport, self.username, self.password))
+            return self.userId, self.authToken
+
+    async def aget(self, transport):
+        """
+        То же, что get, для асинхронного клиента
+        :param transport: AsyncTransport
+        :return: userId, authToken
+        """
+        authToken = self.authToken
+        if authToken is not None:
+            return self.userId, authToken
+        loop = asyncio.get_running_loop()
+        lock = self._async_locks.get(loop)
+        if lock is None:
+            lock = self._async_locks[loop] = asyncio.Lock()
+        async with lock:
+            if self.authToken is None:
+                self._store(*await alogin(transport, self.username, self.password))
+            return self.userId, self.authToken
+
+    def _store(self, userId, authToken):
+        if authToken is None:
+            self.login_failures += 1
+            return
+        self.logins += 1
+        self.userId, self.authToken = userId, authToken
+
+    def invalidate(self, authToken=None):
+        """
+        Сбросить токен, следующий запрос залогинится заново
+        :param authToken: сбросить, только если текущий токен совпадает с этим
+            (другой поток мог уже перелогиниться)
+        """
+        with self._lock:
+            if authToken is None or authToken == self.authToken:
+                self.authToken = None
+                self.invalidations += 1
+
+    def metrics(self):
+        """
+        Счетчики логинов
+        :return: dict
+        """
+        return {
+            'logins': self.logins,
+            'login_failures': self.login_failures,
+            'invalidations': self.invalidations,
+        }
+
+
+_admin_sessions = {}
+_admin_sessions_lock = threading.Lock()
+
+
+def get_admin_session(transport, username=None, password=None):
+    """
+    Общая для процесса сессия администратора на сервере транспорта
+    :param transport: Transport
+    :param username: логин (по умолчанию settings.ROCKETCHAT_USERNAME)
+    :param password: пароль (по умолчанию settings.ROCKETCHAT_PASSWORD)
+    :return: AdminSession
+    """
+    username = username or required_setting('ROCKETCHAT_USERNAME')
+    key = (transport.base_url, username)
+    session = _admin_sessions.get(key)
+    if session is None:
+        with _admin_sessions_lock:
+            session = _admin_sessions.get(key)
+            if session is None:
+                session = AdminSession(username, password or required_setting('ROCKETCHAT_PASSWORD'))
+                _admin_sessions[key] = session
+    return session
+
+
+PARAM_DOCS = {
+    'roomId': 'id комнаты',
+    'userId': 'id пользователя в чате',
+    'description': 'описание',
+    'topic': 'тема',
+    'private': 'True/False',
+    'name': 'название',
+}
+
+
+class Endpoint(object):
+    """
+    Описание метода API, из которого генерируется метод клиента: путь,
+    параметры, подготовка тела запроса и разбор ответа
+    """
+
+    def __init__(self, name, method, path, params=(), doc='', returns='status (True/False)',
+                 param_docs=None, prepare=None, parse=None, user=None, after=None, cache=None, coalesce=False):
+        """
+        :param name: название метода клиента
+        :param method: GET/POST
+        :param path: путь API
+        :param params: аргументы метода: 'имя', ('имя', значение по умолчанию) или '**kwargs'
+        :param doc: первая строка docstring
+        :param returns: описание результата для docstring
+        :param param_docs: описания аргументов, если отличаются от PARAM_DOCS
+        :param prepare: функция аргументы -> тело запроса (по умолчанию аргументы как есть)
+        :param parse: функция resp -> результат (по умолчанию поле success)
+        :param user: аргумент с id пользователя, от имени которого выполнить запрос
+        :param after: функция (клиент, аргументы, результат) после успешного запроса
+        :param cache: шаблон ключа в кеше клиента по аргументам, например 'room:{roomId}'
+        :param coalesce: объединять одновременные вызовы с одинаковыми аргументами (SingleFlight)
+        """
+        self.name = name
+        self.method = method
+        self.path = path
+        self.prepare = prepare
+        self.parse = parse
+        self.user = user
+        self.after = after
+        self.cache = cache
+        self.coalesce = coalesce
+        parameters = [inspect.Parameter('self', inspect.Parameter.POSITIONAL_OR_KEYWORD)]
+        lines = [doc]
+        param_docs = dict(PARAM_DOCS, **(param_docs or {}))
+        for param in params:
+            if isinstance(param, tuple):
+                param, default = param
+            else:
+                default = inspect.Parameter.empty
+            if param.startswith('**'):
+                param = param[2:]
+                parameters.append(inspect.Parameter(param, inspect.Parameter.VAR_KEYWORD))
+            else:
+                parameters.append(inspect.Parameter(param, inspect.Parameter.POSITIONAL_OR_KEYWORD, default=default))
+            lines.append(':param %s: %s' % (param, param_docs[param]))
+        lines.append(':return: %s' % returns)
+        self.signature = inspect.Signature(parameters)
+        self.names = tuple(p.name for p in parameters[1:] if p.kind != inspect.Parameter.VAR_KEYWORD)
+        self.positional = len(self.names) == len(parameters) - 1
+        self.doc = '\n'.join(lines)
+
+    def call(self, client, *args, **kwargs):
+        """
+        Запрос для вызова метода с такими аргументами
+        :return: Call
+        """
+        if self.positional and not kwargs and len(args) == len(self.names):
+            arguments = dict(zip(self.names, args))
+        else:
+            bound = self.signature.bind(client, *args, **kwargs)
+            bound.apply_defaults()
+            arguments = bound.arguments
+            del arguments['self']
+        cache = self.cache.format(**arguments) if self.cache else None
+        userId = arguments.pop(self.user) if self.user else None
+        data = self.prepare(arguments) if self.prepare else arguments
+        after = functools.partial(self.after, client, arguments) if self.after else None
+        if self.method == 'GET':
+            params = dict((key, value) for key, value in data.items() if value is not None)
+            return Call(self.name, self.method, self.path, params=params or None, userId=userId,
+                        parse=self.parse, after=after, cache=cache)
+        return Call(self.name, self.method, self.path, json=data, userId=userId, parse=self.parse, after=after)
+
+    def bind(self):
+        """
+        :return: метод клиента
+        """
+        endpoint = self
+
+        def method(self, *args, **kwargs):
+            return self._execute(endpoint.call(self, *args, **kwargs))
+        method.__name__ = method.__qualname__ = self.name
+        method.__doc__ = self.doc
+        method.__signature__ = self.signature
+        method.endpoint = self
+        return coalesced(method) if self.coalesce else method
+
+
+ENDPOINTS = OrderedDict()
+
+
+def endpoints(*table):
+    """
+    Декоратор класса: добавить методы по описаниям Endpoint
+    """
+    def decorate(cls):
+        for endpoint in table:
+            ENDPOINTS[endpoint.name] = endpoint
+            setattr(cls, endpoint.name, endpoint.bind())
+        return cls
+    return decorate
+
+
+def prepare_room(arguments):
+    members = arguments['members']
+    return {
+        'name': translify_name(arguments['name']),
+        'members': [] if members is None else members,
+        'readOnly': arguments['readOnly']
+    }
+
+
+def prepare_type(arguments):
+    return {
+        'roomId': arguments['roomId'],
+        'type': 'p' if arguments['private'] is True else 'c'
+    }
+
+
+EMAIL_DOMAIN = re.compile(r'@\w+.\w+')
+
+
+def make_username(fullname, email):
+    """
+    Логин в чате: транслит ФИО и имя ящика, 'Иван Петров', 'ivan@mail.ru' -> 'Ivan_Petrov_ivan'
+    """
+    return translify_name(fullname) + '_' + email_name(email)
+
+
+def email_name(email):
+    match = EMAIL_DOMAIN.search(email)
+    if match is None:
+        raise ValueError('Invalid email %r' % email)
+    return email.replace(match.group(), '')
+
+
+def user_data(email, fullname, password, username=None):
+    return {
+        'email': email,
+        'name': fullname,
+        'username': username or make_username(fullname, email),
+        'password': password,
+    }
+
+
+def prepare_user(arguments):
+    return user_data(arguments['email'], arguments['fullname'], arguments['password'])
+
+
+def prepare_update_user(arguments):
+    return {
+        'userId': arguments['userId'],
+        'data': arguments['kwargs']
+    }
+
+
+def room_created(client, arguments, result):
+    client.room_index.created(result)
+
+
+def room_renamed(client, arguments, result):
+    client.room_index.renamed(arguments['roomId'], arguments['name'], result)
+    room_changed('name', lambda arguments: arguments['name'])(client, arguments, result)
+
+
+def room_changed(key, value):
+    """
+    after для методов, меняющих поле комнаты: обновить rooms.info в кеше
+    :param key: поле в rooms.info
+    :param value: функция аргументы -> новое значение поля
+    """
+    def after(client, arguments, result):
+        if result is True:
+            client.info_cache.update('room:' + arguments['roomId'], lambda room: dict(room, **{key: value(arguments)}))
+    return after
+
+
+def room_deleted(client, arguments, result):
+    client.room_index.deleted(arguments['roomId'], result)
+    room_invalidated(client, arguments, result)
+
+
+def room_invalidated(client, arguments, result):
+    client.info_cache.delete('room:' + arguments['roomId'])
+
+
+def user_invalidated(client, arguments, result):
+    client.info_cache.delete('user:' + arguments['userId'])
+    client.info_cache.delete('me:' + arguments['userId'])
+
+
+def room_endpoints(prefix, key, noun):
+    """
+    Одинаковые для каналов и групп методы
+    :param prefix: channels/groups
+    :param key: channel/group - ключ комнаты в ответе на create
+    :param noun: падежи названия для docstring:
+        (именительный, родительный, винительный, предложный)
+    """
+    nominative, genitive, accusative, prepositional = noun
+    path = '/api/v1/%s.' % prefix
+    return (
+        Endpoint('create_' + prefix, 'POST', path + 'create',
+                 (('name', ''), ('readOnly', False), ('members', None)),
+                 doc='Создание публичного %s' % genitive,
+                 param_docs={
+                     'name': 'Название %s' % genitive,
+                     'readOnly': 'true/false - возможность установить %s только для чтения' % accusative,
+                     'members': 'Добавить пользователей в %s' % accusative,
+                 },
+                 returns='Статус, id канала, название %s' % genitive,
+                 prepare=prepare_room, parse=room_result(key), after=room_created),
+        Endpoint(prefix + '_add_owner', 'POST', path + 'addOwner', ('roomId', 'userId'),
+                 doc='Добавляем админа в %s' % accusative),
+        Endpoint(prefix + '_set_description', 'POST', path + 'setDescription', ('roomId', 'description'),
+                 doc='Добавляем описание для %s' % genitive,
+                 after=room_changed('description', lambda arguments: arguments['description'])),
+        Endpoint(prefix + '_set_topic', 'POST', path + 'setTopic', ('roomId', 'topic'),
+                 doc='Добавляем тему для %s' % genitive,
+                 after=room_changed('topic', lambda arguments: arguments['topic'])),
+        Endpoint(prefix + '_set_type', 'POST', path + 'setType', ('roomId', ('private', False)),
+                 doc='Публичный/приватный %s' % nominative, prepare=prepare_type,
+                 after=room_changed('t', lambda arguments: 'p' if arguments['private'] is True else 'c')),
+        Endpoint(prefix + '_rename', 'POST', path + 'rename', ('roomId', 'name'),
+                 doc='Изменить название %s' % genitive, after=room_renamed),
+        Endpoint(prefix + '_kick', 'POST', path + 'kick', ('roomId', 'userId'),
+                 doc='Убрать пользователя из %s' % genitive, after=room_invalidated),
+        Endpoint(prefix + '_invite', 'POST', path + 'invite', ('roomId', 'userId'),
+                 doc='Добавить пользователя в %s' % accusative, after=room_invalidated),
+        Endpoint(prefix + '_archive', 'POST', path + 'archive', ('roomId',),
+                 doc='Архивировать %s' % accusative, after=room_invalidated),
+        Endpoint(prefix + '_unarchive', 'POST', path + 'unarchive', ('roomId',),
+                 doc='Разархивировать %s' % accusative, after=room_invalidated),
+        Endpoint(prefix + '_close', 'POST', path + 'close', ('roomId',),
+                 doc='Закрыть %s' % accusative),
+        Endpoint(prefix + '_delete', 'POST', path + 'delete', ('roomId',),
+                 doc='Удалить %s' % accusative, after=room_deleted),
+    )
+
+
+@endpoints(*room_endpoints('channels', 'channel', ('канал', 'канала', 'канал', 'канале')))
+class ChannelsAPIMixin(object):
+
+    def channels_members(self, roomId):
+        """
+        Участники канала
+        :param roomId: id комнаты
+        :return: список участников ({'_id': ..., 'username': ...}) или False
+        """
+        return self._run(members_pages('channels', roomId))
+
+
+@endpoints(*room_endpoints('groups', 'group', ('группа', 'группы', 'группу', 'группе')))
+class GroupsAPIMixin(object):
+
+    def groups_members(self, roomId):
+        """
+        Участники группы
+        :param roomId: id комнаты
+        :return: список участников ({'_id': ..., 'username': ...}) или False
+        """
+        return self._run(members_pages('groups', roomId))
+
+
+@endpoints(
+    Endpoint('create_user', 'POST', '/api/v1/users.create', ('email', 'fullname', 'password'),
+             doc='Создание пользователя в чате',
+             param_docs={'email': 'E-mail', 'fullname': 'Фамилия и Имя', 'password': 'пароль'},
+             returns='id в чате', prepare=prepare_user, parse=lambda resp: decode(resp.content)['user']['_id']),
+    Endpoint('create_token', 'POST', '/api/v1/users.createToken', ('userId',),
+             doc='Генерация нового токена для пользователя', returns='authToken',
+             parse=lambda resp: decode(resp.content)['data']['authToken']),
+    Endpoint('update_user', 'POST', '/api/v1/users.update', ('userId', '**kwargs'),
+             doc='Обновление данных пользователя в чате', param_docs={'kwargs': '{"name": "...", "email": "..."}'},
+             prepare=prepare_update_user, after=user_invalidated),
+    Endpoint('about_me', 'GET', '/api/v1/me', ('userId',), user='userId',
+             doc='Информация о текущем пользователе', returns='json', parse=json_result, cache='me:{userId}',
+             coalesce=True),
+    Endpoint('user_info', 'GET', '/api/v1/users.info', ('userId',),
+             doc='Информация о пользователе', returns='json пользователя или False',
+             parse=lambda resp: decode(resp.content)['user'], cache='user:{userId}'),
+    Endpoint('subscriptions_get', 'GET', '/api/v1/subscriptions.get', ('userId', ('updatedSince', None)),
+             user='userId', doc='Подписки пользователя на комнаты',
+             param_docs={'updatedSince': 'только изменившиеся после этой даты (ISO)'},
+             returns="{'update': [...], 'remove': [...]} или False", parse=json_result),
+)
+class UsersAPIMixin(object):
+    pass
+
+
+ROOM_SETTINGS = OrderedDict([
+    # поле: (метод без префикса channels/groups, значение поля в rooms.info)
+    ('name', ('rename', lambda room: room.get('name'))),
+    ('description', ('set_description', lambda room: room.get('description') or '')),
+    ('topic', ('set_topic', lambda room: room.get('topic') or '')),
+    ('private', ('set_type', lambda room: room.get('t') == 'p')),
+])
+
+
+class RoomSettings(object):
+    """
+    Изменение настроек комнаты одной единицей работы: изменения копятся через
+    set() и отправляются в commit(). Совпадающие с текущим состоянием комнаты
+    (room_info из info_cache клиента) не отправляются, остальные выполняются
+    параллельно; смена типа - последней, после нее меняется префикс методов.
+    """
+
+    def __init__(self, client, roomId):
+        """
+        :param client: RocketChat/AsyncRocketChat
+        :param roomId: id комнаты
+        """
+        self.client = client
+        self.roomId = roomId
+        self.pending = OrderedDict()
+
+    def set(self, **changes):
+        """
+        :param changes: name, description, topic, private (True/False);
+            None в name и private - не менять, в description и topic - очистить
+        :return: self
+        """
+        unknown = set(changes) - set(ROOM_SETTINGS)
+        if unknown:
+            raise TypeError('Unknown room settings: %s' % ', '.join(sorted(unknown)))
+        self.pending.update(changes)
+        return self
+
+    def commit(self, refresh=False):
+        """
+        Отправить накопленные изменения
+        :param refresh: заново запросить rooms.info, не доверяя кешу
+        :return: {'roomId', 'success', 'steps', 'unchanged', 'errors'};
+            неудавшиеся изменения остаются в pending
+        """
+        return self.client.commit_room_settings(self, refresh)
+
+    def stages(self, room):
+        """
+        :param room: снимок rooms.info
+        :return: [[(поле, метод, аргументы), ...], ...] - шаги внутри этапа независимы
+        """
+        prefix = 'groups' if room.get('t') == 'p' else 'channels'
+        steps = []
+        for field, value in self.pending.items():
+            if value is None:
+                if field in ('name', 'private'):
+                    continue
+                value = ''
+            method, current = ROOM_SETTINGS[field]
+            if current(room) != value:
+                steps.append((field, '%s_%s' % (prefix, method), (self.roomId, value)))
+        stages = [[step for step in steps if step[0] != 'private'], [step for step in steps if step[0] == 'private']]
+        return [stage for stage in stages if stage]
+
+    def result(self, results):
+        """
+        :param results: {поле: результат} отправленных изменений
+        """
+        errors = OrderedDict()
+        for field, result in results.items():
+            if isinstance(result, Exception):
+                logger.error('Fail room settings %s %s: %r', self.roomId, field, result)
+                result = results[field] = repr(result)
+            if result is True:
+                del self.pending[field]
+            else:
+                errors[field] = result
+        unchanged = [field for field in self.pending if field not in results]
+        for field in unchanged:
+            del self.pending[field]
+        return {
+            'roomId': self.roomId,
+            'success': not errors,
+            'steps': results,
+            'unchanged': unchanged,
+            'errors': errors,
+        }
+
+    def failed(self, error):
+        return {
+            'roomId': self.roomId,
+            'success': False,
+            'steps': OrderedDict(),
+            'unchanged': [],
+            'errors': {'room_info': error},
+        }
+
+
+@endpoints(
+    Endpoint('room_info', 'GET', '/api/v1/rooms.info', ('roomId',),
+             doc='Информация о комнате (канал или группа)', returns='json комнаты или False',
+             parse=lambda resp: decode(resp.content)['room'], cache='room:{roomId}'),
+)
+class RoomsAPIMixin(object):
+
+    def room_settings(self, roomId):
+        """
+        Изменение настроек комнаты одним commit()
+        :param roomId: id комнаты
+        :return: RoomSettings
+        """
+        return RoomSettings(self, roomId)
+
+    def commit_room_settings(self, room_settings, refresh=False):
+        """
+        См. RoomSettings.commit
+        """
+        if not room_settings.pending:
+            return room_settings.result(OrderedDict())
+        if refresh:
+            self.info_cache.delete('room:' + room_settings.roomId)
+        room = self.room_info(room_settings.roomId)
+        if room is False:
+            return room_settings.failed(room)
+        results = OrderedDict()
+        for stage in room_settings.stages(room):
+            if len(stage) == 1:
+                field, method, args = stage[0]
+                try:
+                    results[field] = getattr(self, method)(*args)
+                except Exception as e:
+                    results[field] = e
+                continue
+            with ThreadPoolExecutor(max_workers=len(stage)) as pool:
+                futures = [(field, submit(pool, getattr(self, method), *args)) for field, method, args in stage]
+            for field, future in futures:
+                results[field] = future_result(future)
+        return room_settings.result(results)
+
+
+class Pager(object):
+    """
+    Постраничный обход списочного метода API (offset/count). Хранит
+    смещение следующей страницы; общий для синхронного и асинхронного клиентов.
+    """
+
+    def __init__(self, name, path, key, params=None, query=None, fields=None, sort=None, cursor=0, count=None,
+                 model=None):
+        """
+        :param name: название операции для логов
+        :param path: путь API
+        :param key: ключ списка в ответе
+        :param params: дополнительные query-параметры
+        :param query: фильтр (mongo-запрос, dict)
+        :param fields: нужные поля: ['name', ...] или {'name': 1, ...}
+        :param sort: сортировка {'_id': 1}; при устойчивой сортировке продолжение
+            с cursor не пропускает и не повторяет элементы
+        :param cursor: смещение, с которого начинать
+        :param count: размер страницы (по умолчанию settings.ROCKETCHAT_PAGE_SIZE)
+        :param model: Room/User/... - элементы моделями, None - как в JSON
+        """
+        self.name = name
+        self.path = path
+        self.key = key
+        self.params = dict(params or {})
+        if query is not None:
+            self.params['query'] = json.dumps(query)
+        if fields is not None:
+            self.params['fields'] = json.dumps(fields if isinstance(fields, dict) else dict.fromkeys(fields, 1))
+        if sort is not None:
+            self.params['sort'] = json.dumps(sort)
+        self.offset = cursor
+        self.count = count or page_size()
+        self.model = model
+        self.done = False
+
+    def call(self):
+        return Call(self.name, 'GET', self.path, params=dict(self.params, offset=self.offset, count=self.count),
+                    parse=json_result, error=api_error)
+
+    def advance(self, data):
+        """
+        Принять страницу
+        :param data: ответ (APIError - ошибка, смещение не меняется)
+        :return: элементы страницы
+        """
+        if isinstance(data, Exception):
+            raise data
+        items = data[self.key]
+        self.offset += len(items)
+        total = data.get('total')
+        self.done = not items or (self.offset >= total if total is not None else len(items) < self.count)
+        return items if self.model is None else self.model.from_list(items)
+
+
+class PageIterator(object):
+    """
+    Итератор по элементам списочного метода: пока обрабатывается текущая
+    страница, следующая загружается в фоне. В памяти не больше двух страниц.
+    cursor - смещение следующего элемента: после ошибки можно продолжить этот
+    же итератор или начать новый с cursor=it.cursor.
+    """
+
+    def __init__(self, client, pager):
+        self.client = client
+        self.pager = pager
+        self.cursor = pager.offset
+        self._page = deque()
+        self._pending = None
+        self._pool = ThreadPoolExecutor(max_workers=1)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self._page:
+            if self._pending is None:
+                if self.pager.done:
+                    self.close()
+                    raise StopIteration
+                self._pending = self._fetch()
+            pending, self._pending = self._pending, None
+            self._page.extend(self.pager.advance(pending.result()))
+            if not self.pager.done:
+                self._pending = self._fetch()
+        self.cursor += 1
+        return self._page.popleft()
+
+    def _fetch(self):
+        return submit(self._pool, self.client._execute, self.pager.call())
+
+    def close(self):
+        if self._pending is not None:
+            self._pending.cancel()
+            self._pending = None
+        self._pool.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AsyncPageIterator(object):
+    """
+    То же для AsyncRocketChat: async for item in client.iter_users()
+    """
+
+    def __init__(self, client, pager):
+        self.client = client
+        self.pager = pager
+        self.cursor = pager.offset
+        self._page = deque()
+        self._pending = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._page:
+            if self._pending is None:
+                if self.pager.done:
+                    raise StopAsyncIteration
+                self._pending = self._fetch()
+            pending, self._pending = self._pending, None
+            self._page.extend(self.pager.advance(await pending))
+            if not self.pager.done:
+                self._pending = self._fetch()
+        self.cursor += 1
+        return self._page.popleft()
+
+    def _fetch(self):
+        return asyncio.ensure_future(self.client._execute(self.pager.call()))
+
+    async def aclose(self):
+        if self._pending is not None:
+            self._pending.cancel()
+            self._pending = None
+
+
+class ListsAPIMixin(object):
+
+    def iter_channels(self, query=None, fields=None, sort=None, cursor=0, count=None, model=None):
+        """
+        Все каналы сервера (channels.list), постранично
+        :param query: фильтр {'name': ...}
+        :param fields: нужные поля, например ['name', '_updatedAt']
+        :param sort: сортировка {'_id': 1}
+        :param cursor: смещение, с которого продолжить (it.cursor)
+        :param count: размер страницы
+        :param model: Room - элементы моделями только с нужными полями;
+            None - полный JSON (dict)
+        :return: итератор по каналам
+        """
+        return self._iterate(Pager('channels_list', '/api/v1/channels.list', 'channels', query=query,
+                                   fields=fields, sort=sort, cursor=cursor, count=count, model=model))
+
+    def iter_groups(self, query=None, fields=None, sort=None, cursor=0, count=None, model=None):
+        """
+        Все группы сервера (groups.listAll), постранично
+        :return: итератор по группам (параметры как у iter_channels)
+        """
+        return self._iterate(Pager('groups_list', '/api/v1/groups.listAll', 'groups', query=query,
+                                   fields=fields, sort=sort, cursor=cursor, count=count, model=model))
+
+    def iter_users(self, query=None, fields=None, sort=None, cursor=0, count=None, model=None):
+        """
+        Все пользователи сервера (users.list), постранично
+        :return: итератор по пользователям (параметры как у iter_channels)
+        """
+        return self._iterate(Pager('users_list', '/api/v1/users.list', 'users', query=query,
+                                   fields=fields, sort=sort, cursor=cursor, count=count, model=model))
+
+    def iter_members(self, roomId, group=False, cursor=0, count=None, model=None):
+        """
+        Участники комнаты (channels.members/groups.members), постранично
+        :param roomId: id комнаты
+        :param group: True - группа, False - канал
+        :param model: User - элементы моделями; None - полный JSON (dict)
+        :return: итератор по участникам
+        """
+        prefix = 'groups' if group else 'channels'
+        return self._iterate(Pager(prefix + '_members', '/api/v1/%s.members' % prefix, 'members',
+                                   {'roomId': roomId}, cursor=cursor, count=count, model=model))
+
+    def iter_history(self, roomId, group=False, latest=None, oldest=None, cursor=0, count=None, model=None):
+        """
+        Сообщения комнаты (channels.history/groups.history) от новых к старым
+        :param roomId: id комнаты
+        :param group: True - группа, False - канал
+        :param latest: не новее этой даты (ISO)
+        :param oldest: не старее этой даты (ISO)
+        :param model: Message - элементы моделями; None - полный JSON (dict)
+        :return: итератор по сообщениям
+        """
+        prefix = 'groups' if group else 'channels'
+        params = {'roomId': roomId}
+        if latest is not None:
+            params['latest'] = latest
+        if oldest is not None:
+            params['oldest'] = oldest
+        return self._iterate(Pager(prefix + '_history', '/api/v1/%s.history' % prefix, 'messages', params,
+                                   cursor=cursor, count=count, model=model))
+
+
+class HistoryExport(object):
+    """
+    Выгрузка истории одной комнаты в файл NDJSON (по сообщению на строку)
+    или NDJSON.gz, от новых сообщений к старым. После каждой страницы
+    рядом сохраняется курсор (<файл>.cursor): дата самого старого
+    выгруженного сообщения и размер файла, поэтому прерванная выгрузка
+    продолжается с того же места без дублей.
+    """
+
+    def __init__(self, roomId, directory, group=False, compress=True, oldest=None, count=None):
+        """
+        :param roomId: id комнаты
+        :param directory: каталог для файлов
+        :param group: True - группа, False - канал
+        :param compress: писать .ndjson.gz
+        :param oldest: не выгружать сообщения старше этой даты (ISO)
+        :param count: сообщений на страницу
+        """
+        self.roomId = roomId
+        self.prefix = 'groups' if group else 'channels'
+        self.compress = compress
+        self.oldest = oldest
+        self.count = count or page_size()
+        self.path = os.path.join(directory, roomId + ('.ndjson.gz' if compress else '.ndjson'))
+        self.cursor_path = self.path + '.cursor'
+        self.latest = None
+        self.seen = []
+        self.size = 0
+        self.messages = 0
+        self.inclusive = True
+        self.done = False
+        self.error = None
+        try:
+            with open(self.cursor_path) as f:
+                cursor = json.load(f)
+        except (FileNotFoundError, ValueError):
+            cursor = None
+        if cursor is not None:
+            self.latest = cursor['latest']
+            self.seen = cursor['seen']
+            self.size = cursor['size']
+            self.messages = cursor['messages']
+            self.done = cursor['done']
+        with open(self.path, 'ab') as f:
+            f.truncate(self.size)
+
+    def call(self, stream=True):
+        params = {'roomId': self.roomId, 'count': self.count}
+        if self.latest is not None:
+            params['latest'] = self.latest
+            params['inclusive'] = 'true' if self.inclusive else 'false'
+        if self.oldest is not None:
+            params['oldest'] = self.oldest
+        return Call(self.prefix + '_history', 'GET', '/api/v1/%s.history' % self.prefix, params=params,
+                    parse=(lambda resp: iter_json_array(resp, 'messages')) if stream else messages_result,
+                    error=api_error, stream=stream)
+
+    def write(self, messages):
+        """
+        Дописать страницу в файл и сохранить курсор
+        :param messages: сообщения страницы (итератор), от новых к старым
+        """
+        received = 0
+        written = 0
+        seen = set(self.seen)
+        with open(self.path, 'ab') as f:
+            out = gzip.GzipFile(fileobj=f, mode='wb') if self.compress else f
+            for message in messages:
+                received += 1
+                if message['_id'] in seen:
+                    continue
+                out.write(json.dumps(message, ensure_ascii=False).encode('utf-8') + b'\n')
+                written += 1
+                if message['ts'] != self.latest:
+                    self.latest = message['ts']
+                    self.seen = []
+                self.seen.append(message['_id'])
+            if out is not f:
+                out.close()
+            self.size = f.tell()
+        self.messages += written
+        # страница из одних повторов - больше count сообщений с одной датой:
+        # следующую запрашиваем строго старше нее
+        self.inclusive = not received or bool(written)
+        if not self.inclusive:
+            logger.warning('export_history %s: more than %s messages at %s', self.roomId, self.count, self.latest)
+        self.done = received < self.count
+        self.save()
+
+    def save(self):
+        tmp = self.cursor_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'latest': self.latest, 'seen': self.seen, 'size': self.size, 'messages': self.messages,
+                       'done': self.done}, f)
+        os.replace(tmp, self.cursor_path)
+
+    def result(self):
+        return {'roomId': self.roomId, 'path': self.path, 'messages': self.messages, 'done': self.done,
+                'error': self.error}
+
+
+def messages_result(resp):
+    return decode(resp.content)['messages']
+
+
+def history_export_steps(export, stream=True):
+    """
+    Выгрузка истории комнаты страница за страницей
+    :param export: HistoryExport
+    :param stream: читать ответы по частям (синхронный клиент)
+    :return: генератор для _run, результат - export.result()
+    """
+    while not export.done:
+        messages = yield export.call(stream)
+        if isinstance(messages, Exception):
+            export.error = str(messages)
+            logger.error('Fail export_history %s: %s', export.roomId, messages)
+            break
+        export.write(messages)
+    return export.result()
+
+
+def history_exports(rooms, directory, group=False, compress=True, oldest=None, count=None):
+    """
+    Выгрузки для export_history. Одна комната дважды писала бы один файл
+    одновременно, поэтому повтор roomId - ошибка, и она проверяется до
+    открытия файлов.
+    :param rooms: iterable из id комнат или dict {'roomId': ..., 'group': True/False}
+    :return: [HistoryExport, ...] в порядке rooms
+    """
+    rooms = [room if isinstance(room, dict) else {'roomId': room} for room in rooms]
+    counts = Counter(room['roomId'] for room in rooms)
+    duplicates = sorted(roomId for roomId, n in counts.items() if n > 1)
+    if duplicates:
+        raise ValueError('Duplicate roomId in export_history: %s' % ', '.join(duplicates))
+    return [HistoryExport(room['roomId'], directory, room.get('group', group), compress, oldest, count)
+            for room in rooms]
+
+
+def bulk_concurrency(concurrency=None):
+    return concurrency or setting('ROCKETCHAT_BULK_CONCURRENCY', 8)
+
+
+def membership_rate(rate=None):
+    return rate or setting('ROCKETCHAT_MEMBERSHIP_RATE', 20)
+
+
+class RoomPlan(object):
+    """
+    План создания одной комнаты для provision_rooms: создание и зависящие от
+    него независимые друг от друга шаги (владельцы, описание, тема).
+    Приватная комната сразу создается группой: после setType канал стал бы
+    группой, и channels.* для него уже не работали бы
+    """
+
+    def __init__(self, spec):
+        """
+        :param spec: {'name': ..., 'group': True/False, 'readOnly': ..., 'members': [...],
+            'owners': [...], 'description': ..., 'topic': ..., 'private': True/False}
+            (private, если задан, важнее group)
+        """
+        self.spec = spec
+        private = spec.get('private')
+        self.prefix = 'groups' if (spec.get('group') if private is None else private) else 'channels'
+        self.create = 'create_' + self.prefix
+        self.create_kwargs = {
+            'name': spec['name'],
+            'readOnly': spec.get('readOnly', False),
+            'members': spec.get('members'),
+        }
+        self.roomId = None
+        self.roomName = None
+        self.results = OrderedDict()
+
+    def created(self, result):
+        if isinstance(result, tuple):
+            success, self.roomId, self.roomName = result
+            self.results['create'] = success
+        else:
+            self.record('create', result)
+
+    def steps(self):
+        """
+        :return: [(шаг, метод, аргументы), ...]
+        """
+        if self.roomId is None:
+            return []
+        spec = self.spec
+        owners = spec.get('owners') or ([spec['owner']] if spec.get('owner') else [])
+        steps = [('add_owner:%s' % owner, self.prefix + '_add_owner', (self.roomId, owner)) for owner in owners]
+        if spec.get('description') is not None:
+            steps.append(('set_description', self.prefix + '_set_description', (self.roomId, spec['description'])))
+        if spec.get('topic') is not None:
+            steps.append(('set_topic', self.prefix + '_set_topic', (self.roomId, spec['topic'])))
+        return steps
+
+    def record(self, step, result):
+        if isinstance(result, Exception):
+            logger.error('Fail provision_rooms %s %s: %r', self.spec['name'], step, result)
+            result = repr(result)
+        self.results[step] = result
+
+    def result(self):
+        errors = OrderedDict((step, result) for step, result in self.results.items() if result is not True)
+        return {
+            'name': self.spec['name'],
+            'roomId': self.roomId,
+            'roomName': self.roomName,
+            'success': not errors,
+            'steps': self.results,
+            'errors': errors,
+        }
+
+
+class UserCheckpoint(object):
+    """
+    Файл с уже созданными пользователями для create_users: по строке JSON
+    на пользователя, дописывается сразу после создания. При повторном
+    запуске эти пользователи пропускаются.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: путь к файлу
+        """
+        self.path = path
+        self.ids = {}
+        self._lock = threading.Lock()
+        try:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        item = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.ids[item['key']] = item['userId']
+        except FileNotFoundError:
+            pass
+        self._file = open(path, 'a')
+
+    def get(self, key):
+        return self.ids.get(key)
+
+    def add(self, key, userId):
+        with self._lock:
+            self.ids[key] = userId
+            self._file.write(json.dumps({'key': key, 'userId': userId}) + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class UserImport(object):
+    """
+    Состояние create_users: логины и e-mail, уже существующие на сервере,
+    дубли внутри импорта, созданные id и ошибки. Пользователь с тем же
+    e-mail уже есть, даже если его логин получился бы другим; повтор e-mail
+    внутри импорта - ошибка, пользователь создается по первой записи
+    """
+
+    def __init__(self, checkpoint=None):
+        """
+        :param checkpoint: путь к файлу или объект с методами get(key)/add(key, userId)
+        """
+        self.checkpoint = UserCheckpoint(checkpoint) if isinstance(checkpoint, str) else checkpoint
+        self.existing = {}
+        self.emails = {}
+        self.seen = {}
+        self.planned = set()
+        self.ids = OrderedDict()
+        self.errors = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, users):
+        """
+        :param users: пользователи сервера [User(_id, username, emails), ...]
+        """
+        for user in users:
+            emails = set(e.get('address') for e in user.get('emails') or ())
+            self.existing[user['username']] = (user['_id'], emails)
+            for email in emails:
+                if isinstance(email, str):
+                    self.emails[email.lower()] = user['_id']
+
+    def plan(self, records):
+        """
+        Разобрать пачку записей: логины считаются за один проход, записи из
+        checkpoint и уже существующие пользователи сразу попадают в ids
+        :param records: [{'email': ..., 'fullname': ..., 'password': ...}, ...]
+        :return: [(email, запрос users.create), ...] - кого нужно создать
+        """
+        todo = []
+        try:
+            names = normalize_many(record['fullname'] for record in records)
+        except (KeyError, AttributeError, TypeError, ValueError):
+            names = [None] * len(records)
+        for record, name in zip(records, names):
+            key = record.get('email')
+            try:
+                username = record.get('username')
+                if username is None and name is not None:
+                    username = name + '_' + email_name(record['email'])
+                data = user_data(record['email'], record['fullname'], record['password'], username)
+                email = key.lower()
+            except (KeyError, AttributeError, TypeError, ValueError) as e:
+                self.errors[key] = 'invalid record: %r' % e
+                continue
+            username = data['username']
+            userId = self.checkpoint.get(key) if self.checkpoint is not None else None
+            if userId is None:
+                userId = self.emails.get(email)
+            if userId is None and username in self.existing:
+                userId, emails = self.existing[username]
+                if key not in emails:
+                    self.errors[key] = 'username %s is taken' % username
+                    continue
+            if userId is not None:
+                self.ids[key] = userId
+            elif email in self.planned:
+                # создается по первой записи с этим e-mail
+                self.errors[key] = 'duplicate e-mail %s' % email
+            elif username in self.seen:
+                if self.seen[username] != key:
+                    self.errors[key] = 'duplicate username %s' % username
+            else:
+                self.seen[username] = key
+                self.planned.add(email)
+                todo.append((key, data))
+        return todo
+
+    def record(self, key, data, result):
+        if isinstance(result, str):
+            with self._lock:
+                self.ids[key] = result
+                self.existing[data['username']] = (result, {key})
+                self.emails[key.lower()] = result
+            if self.checkpoint is not None:
+                self.checkpoint.add(key, result)
+        else:
+            logger.error('Fail create_users %s: %s', key, result)
+            self.errors[key] = str(result) if isinstance(result, Exception) else 'create failed'
+
+    def result(self):
+        if isinstance(self.checkpoint, UserCheckpoint):
+            self.checkpoint.close()
+        return {'ids': self.ids, 'errors': self.errors}
+
+
+def users_pages():
+    """
+    Логины и e-mail всех пользователей сервера, постранично
+    :return: генератор для _run, результат - [User(_id, username, emails), ...] или False
+    """
+    return list_pages('users_list', '/api/v1/users.list', 'users',
+                      {'fields': json.dumps({'username': 1, 'emails': 1})}, User)
+
+
+def create_user_call(data):
+    return Call('create_user', 'POST', '/api/v1/users.create', json=data,
+                parse=lambda resp: decode(resp.content)['user']['_id'], error=api_error)
+
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def bulk_chunk_size():
+    return setting('ROCKETCHAT_BULK_CHUNK_SIZE', 500)
+
+
+def future_result(future):
+    try:
+        return future.result()
+    except Exception as e:
+        return e
+
+
+class BulkAPIMixin(object):
+
+    def provision_rooms(self, specs, concurrency=None):
+        """
+        Массовое создание комнат. Комнаты создаются параллельно, а после
+        создания владельцы, описание и тема выставляются одновременно
+        :param specs: iterable из dict (см. RoomPlan)
+        :param concurrency: максимум одновременных запросов
+        :return: [{'name', 'roomId', 'roomName', 'success', 'steps', 'errors'}, ...]
+            в порядке specs
+        """
+        plans = [RoomPlan(spec) for spec in specs]
+        with ThreadPoolExecutor(max_workers=bulk_concurrency(concurrency)) as pool:
+            creating = dict((submit(pool, run_batch, getattr(self, plan.create), **plan.create_kwargs), plan)
+                            for plan in plans)
+            steps = {}
+            for future in as_completed(creating):
+                plan = creating[future]
+                plan.created(future_result(future))
+                for step, method, args in plan.steps():
+                    steps[submit(pool, run_batch, getattr(self, method), *args)] = (plan, step)
+            for future in as_completed(steps):
+                plan, step = steps[future]
+                plan.record(step, future_result(future))
+        return [plan.result() for plan in plans]
+
+    def sync_members(self, roomId, userIds, group=False, keep=(), kick=True, concurrency=None, rate=None):
+        """
+        Привести состав комнаты к списку userIds: получаем участников одним
+        проходом и отправляем только недостающие приглашения и исключения.
+        Для новой комнаты участников выгоднее передать сразу в
+        create_channels/create_groups (members).
+        :param roomId: id комнаты
+        :param userIds: id нужных участников
+        :param group: True - группа, False - канал
+        :param keep: id, которых нельзя исключать (например, владельцы)
+        :param kick: исключать участников, которых нет в userIds
+        :param concurrency: максимум одновременных запросов
+        :param rate: максимум запросов в секунду
+        :return: {userId: {'action': 'invite'/'kick'/None, 'success': True/False}} или False
+        """
+        prefix = 'groups' if group else 'channels'
+        members = getattr(self, prefix + '_members')(roomId)
+        if members is False:
+            return False
+        actions, unchanged = membership_plan((m['_id'] for m in members), userIds, keep, kick)
+        bucket = TokenBucket(membership_rate(rate))
+
+        def apply(userId, action):
+            bucket.acquire()
+            return run_batch(getattr(self, '%s_%s' % (prefix, action)), roomId, userId)
+
+        with ThreadPoolExecutor(max_workers=bulk_concurrency(concurrency)) as pool:
+            futures = [submit(pool, apply, userId, action) for userId, action in actions]
+            results = [future_result(future) for future in futures]
+        return membership_report(unchanged, actions, results)
+
+    def export_history(self, rooms, directory, group=False, compress=True, oldest=None, concurrency=None,
+                       count=None):
+        """
+        Выгрузка истории комнат в файлы <directory>/<roomId>.ndjson[.gz].
+        Комнаты выгружаются параллельно, ответы читаются по частям, так что
+        память не зависит от размера истории. Повторный вызов продолжает
+        прерванные выгрузки и пропускает законченные.
+        :param rooms: iterable из id комнат или dict {'roomId': ..., 'group': True/False}
+        :param directory: каталог для файлов
+        :param group: тип комнат, заданных просто id
+        :param compress: сжимать gzip
+        :param oldest: не выгружать сообщения старше этой даты (ISO)
+        :param concurrency: сколько комнат выгружать одновременно
+        :param count: сообщений на страницу
+        :return: [{'roomId', 'path', 'messages', 'done', 'error'}, ...] в порядке rooms
+        """
+        exports = history_exports(rooms, directory, group, compress, oldest, count)
+        with ThreadPoolExecutor(max_workers=bulk_concurrency(concurrency)) as pool:
+            futures = [submit(pool, run_batch, self._run, history_export_steps(export)) for export in exports]
+            for export, future in zip(exports, futures):
+                result = future_result(future)
+                if isinstance(result, Exception):
+                    logger.error('Fail export_history %s: %r', export.roomId, result)
+                    export.error = repr(result)
+        return [export.result() for export in exports]
+
+    def create_users(self, records, concurrency=None, checkpoint=None):
+        """
+        Массовое создание пользователей. Записи читаются пачками, логины
+        сверяются с уже существующими на сервере (один постраничный проход
+        users.list) и между собой, новые пользователи создаются параллельно.
+        Повторный запуск с тем же checkpoint продолжает с места остановки;
+        существующие пользователи не создаются заново, а попадают в ids.
+        :param records: iterable из dict {'email': ..., 'fullname': ..., 'password': ...}
+        :param concurrency: максимум одновременных запросов
+        :param checkpoint: путь к файлу с прогрессом (см. UserCheckpoint)
+        :return: {'ids': {email: userId}, 'errors': {email: текст ошибки}} или False
+        """
+        users = self._run(users_pages())
+        if users is False:
+            return False
+        state = UserImport(checkpoint)
+        state.load(users)
+        with ThreadPoolExecutor(max_workers=bulk_concurrency(concurrency)) as pool:
+            for chunk in chunks(records, bulk_chunk_size()):
+                futures = dict((submit(pool, run_batch, self._execute, create_user_call(data)), (key, data))
+                               for key, data in state.plan(chunk))
+                for future in as_completed(futures):
+                    state.record(*futures[future], future_result(future))
+        return state.result()
+
+
+class RocketChat(ChannelsAPIMixin, GroupsAPIMixin, UsersAPIMixin, RoomsAPIMixin, ListsAPIMixin, BulkAPIMixin):
+    transport = None
+    token_cache = None
+    admin_session = None
+    subscription_store = None
+    room_index = None
+    info_cache = None
+    single_flight = None
+    request_log = None
+
+    def __init__(self, transport=None, token_cache=None, admin_session=None, subscription_store=None,
+                 room_index=None, info_cache=None, single_flight=None, request_log=None, **kwargs):
+        if transport is not None:
+            self.transport = transport
+        elif self.transport is None:
+            self.transport = get_default_transport()
+        if token_cache is not None:
+            self.token_cache = token_cache
+        elif self.token_cache is None:
+            self.token_cache = get_default_token_cache()
+        if admin_session is not None:
+            self.admin_session = admin_session
+        elif self.admin_session is None:
+            self.admin_session = get_admin_session(self.transport)
+        if subscription_store is not None:
+            self.subscription_store = subscription_store
+        elif self.subscription_store is None:
+            self.subscription_store = get_default_subscription_store()
+        if room_index is not None:
+            self.room_index = room_index
+        elif self.room_index is None:
+            self.room_index = get_room_index(self.transport)
+        if info_cache is not None:
+            self.info_cache = info_cache
+        elif self.info_cache is None:
+            self.info_cache = get_info_cache(self.transport)
+        if single_flight is not None:
+            self.single_flight = single_flight
+        elif self.single_flight is None:
+            self.single_flight = get_single_flight(self.transport)
+        if request_log is not None:
+            self.request_log = request_log
+        elif self.request_log is None:
+            self.request_log = get_default_request_log()
+
+    @property
+    def userId(self):
+        return self.auth_admin()[0]
+
+    @property
+    def authToken(self):
+        return self.auth_admin()[1]
+
+    @property
+    def headers(self):
+        userId, authToken = self.auth_admin()
+        return {
+            'X-Auth-Token': authToken,
+            'X-User-Id': userId,
+        }
+
+    def auth_admin(self):
+        return self.admin_session.get(self.transport)
+
+    def admin_request(self, method, path, **kwargs):
+        """
+        Запрос от имени администратора. На 401 перелогиниваемся и повторяем
+        запрос один раз
+        :param method: GET/POST
+        :param path: путь API
+        :return: requests.Response
+        """
+        headers = self.headers
+        resp = self.transport.request(method, path, headers=headers, **kwargs)
+        if resp.status_code == 401:
+            logger.info('Admin token rejected, logging in again')
+            self.admin_session.invalidate(headers['X-Auth-Token'])
+            resp = self.transport.request(method, path, headers=self.headers, **kwargs)
+        return resp
+
+    def get_headers(self, userId, refresh=False):
+        """
+        Заголовки для запросов от имени пользователя, токен берется из кеша
+        :param userId: id пользователя в чате
+        :param refresh: выпустить новый токен, не глядя в кеш
+        :return: dict; X-Auth-Token - False, если токен выпустить не удалось
+        """
+        token = None if refresh else self.token_cache.get(userId)
+        if token is None:
+            token = self.create_token(userId) or False
+            if token:
+                self.token_cache.set(userId, token)
+        return {
+            'X-Auth-Token': token,
+            'X-User-Id': userId,
+        }
+
+    def user_request(self, method, path, userId, **kwargs):
+        """
+        Запрос от имени пользователя. Если сервер ответил 401 (токен протух
+        или отозван), выпускаем новый токен и повторяем запрос один раз
+        :param method: GET/POST
+        :param path: путь API
+        :param userId: id пользователя в чате
+        :return: requests.Response или False, если не удалось выпустить токен
+            (запрос не отправлялся)
+        """
+        headers = self.get_headers(userId)
+        if headers['X-Auth-Token'] is False:
+            logger.error('Fail %s %s: can not create token for %s', method, path, userId)
+            return False
+        resp = self.transport.request(method, path, headers=headers, **kwargs)
+        if resp.status_code == 401:
+            logger.info('Token for %s rejected, creating new one', userId)
+            headers = self.get_headers(userId, refresh=True)
+            if headers['X-Auth-Token'] is False:
+                logger.error('Fail %s %s: can not create token for %s', method, path, userId)
+                return resp
+            resp.close()
+            resp = self.transport.request(method, path, headers=headers, **kwargs)
+        return resp
+
+    def authorize(self, username, password):
+        """
+        Авторизация пользователя в чате
+        :param username: логин
+        :param password: пароль
+        :return: userId, authToken
+        """
+        return login(self.transport, username, password)
+
+    def logout(self, userId):
+        """
+        Выход из системы чата
+        :param userId: id пользователя в чате
+        :return: status
+        """
+        headers = self.get_headers(userId)
+        if headers['X-Auth-Token'] is False:
+            return True
+
+        result = self._execute(logout_call(userId))
+        self.token_cache.delete(userId)
+        return result
+
+    @coalesced
+    def notifications(self, userId):
+        """
+        Информация о новых сообщениях
+        :param userId: id пользователя в чате
+        :return: alert True/False, unread кол-ва новых сообщений
+        """
+        return self._run(notifications_steps(self.subscription_store, userId))
+
+    @coalesced
+    def is_unique_name(self, name, authoritative=False):
+        """
+        Проверка на уникальность имени по локальному индексу имен комнат;
+        занятое по индексу имя проверяется на сервере
+        :param name: название
+        :param authoritative: спросить сервер (каналы и группы параллельно)
+        :return: True/False
+        """
+        if not authoritative:
+            if self.room_index.stale():
+                self._run(room_index_steps(self.room_index))
+            if self.room_index.loaded and name not in self.room_index:
+                return True
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            futures = [submit(pool, self._execute, call) for call in unique_name_calls(name)]
+            result = unique_name_result(*[future.result() for future in futures])
+        if result is True:
+            self.room_index.discard(name)
+        return result
+
+    def _execute(self, call):
+        """
+        Выполнить запрос к API и разобрать ответ
+        :param call: Call
+        :return: результат call.parse или call.error
+        """
+        if call.cache is not None:
+            result = self.info_cache.get(call.cache)
+            if result is not None:
+                return result
+        start = time.perf_counter()
+        with deadline(call_deadline()):
+            if not call.auth:
+                resp = self.transport.request(call.method, call.path, **call.kwargs)
+            elif call.userId is None:
+                resp = self.admin_request(call.method, call.path, **call.kwargs)
+            else:
+                resp = self.user_request(call.method, call.path, call.userId, **call.kwargs)
+        if resp is False:
+            return call.unauthorized()
+        result = call.handle(resp, time.perf_counter() - start, self.request_log)
+        if call.cache is not None and resp.status_code == 200:
+            self.info_cache.set(call.cache, result)
+        return result
+
+    def _run(self, steps):
+        """
+        Выполнить операцию из нескольких запросов: steps - генератор, который
+        отдает Call и получает обратно результат (или CircuitOpen, если
+        запрос отклонен, - генератор может вернуть вместо него запасной результат)
+        :return: результат генератора
+        """
+        try:
+            call = next(steps)
+            while True:
+                try:
+                    result = self._execute(call)
+                except CircuitOpen as e:
+                    call = steps.throw(e)
+                else:
+                    call = steps.send(result)
+        except StopIteration as e:
+            return e.value
+
+    def _iterate(self, pager):
+        return PageIterator(self, pager)
+
+    def _coalesce(self, key, fn, *args, **kwargs):
+        return self.single_flight.do(key, fn, *args, **kwargs)
+
+
+class AsyncRocketChat(RocketChat):
+    """
+    Асинхронный клиент. Методы те же, что у RocketChat, но возвращают корутины;
+    запросы и разбор ответов общие с синхронным клиентом (Call).
+    """
+
+    def __init__(self, transport=None, **kwargs):
+        super(AsyncRocketChat, self).__init__(transport=transport or get_default_async_transport(), **kwargs)
+
+    @property
+    def userId(self):
+        return self.admin_session.userId
+
+    @property
+    def authToken(self):
+        return self.admin_session.authToken
+
+    @property
+    def headers(self):
+        return {
+            'X-Auth-Token': self.admin_session.authToken,
+            'X-User-Id': self.admin_session.userId,
+        }
+
+    async def auth_admin(self):
+        return await self.admin_session.aget(self.transport)
+
+    async def admin_request(self, method, path, **kwargs):
+        userId, authToken = await self.auth_admin()
+        headers = {'X-Auth-Token': authToken, 'X-User-Id': userId}
+        resp = await self.transport.request(method, path, headers=headers, **kwargs)
+        if resp.status_code == 401:
+            logger.info('Admin token rejected, logging in again')
+            self.admin_session.invalidate(authToken)
+            userId, authToken = await self.auth_admin()
+            headers = {'X-Auth-Token': authToken, 'X-User-Id': userId}
+            resp = await self.transport.request(method, path, headers=headers, **kwargs)
+        return resp
+
+    async def get_headers(self, userId, refresh=False):
+        token = None if refresh else self.token_cache.get(userId)
+        if token is None:
+            token = await self.create_token(userId) or False
+            if token:
+                self.token_cache.set(userId, token)
+        return {
+            'X-Auth-Token': token,
+            'X-User-Id': userId,
+        }
+
+    async def user_request(self, method, path, userId, **kwargs):
+        headers = await self.get_headers(userId)
+        if headers['X-Auth-Token'] is False:
+            logger.error('Fail %s %s: can not create token for %s', method, path, userId)
+            return False
+        resp = await self.transport.request(method, path, headers=headers, **kwargs)
+        if resp.status_code == 401:
+            logger.info('Token for %s rejected, creating new one', userId)
+            headers = await self.get_headers(userId, refresh=True)
+            if headers['X-Auth-Token'] is False:
+                logger.error('Fail %s %s: can not create token for %s', method, path, userId)
+                return resp
+            resp = await self.transport.request(method, path, headers=headers, **kwargs)
+        return resp
+
+    async def authorize(self, username, password):
+        return await alogin(self.transport, username, password)
+
+    async def logout(self, userId):
+        headers = await self.get_headers(userId)
+        if headers['X-Auth-Token'] is False:
+            return True
+
+        result = await self._execute(logout_call(userId))
+        self.token_cache.delete(userId)
+        return result
+
+    @coalesced
+    async def is_unique_name(self, name, authoritative=False):
+        if not authoritative:
+            if self.room_index.stale():
+                await self._run(room_index_steps(self.room_index))
+            if self.room_index.loaded and name not in self.room_index:
+                return True
+        result = unique_name_result(*await asyncio.gather(*map(self._execute, unique_name_calls(name))))
+        if result is True:
+            self.room_index.discard(name)
+        return result
+
+    async def commit_room_settings(self, room_settings, refresh=False):
+        if not room_settings.pending:
+            return room_settings.result(OrderedDict())
+        if refresh:
+            self.info_cache.delete('room:' + room_settings.roomId)
+        room = await self.room_info(room_settings.roomId)
+        if room is False:
+            return room_settings.failed(room)
+        results = OrderedDict()
+        for stage in room_settings.stages(room):
+            done = await asyncio.gather(*[getattr(self, method)(*args) for _, method, args in stage],
+                                        return_exceptions=True)
+            results.update((field, result) for (field, _, _), result in zip(stage, done))
+        return room_settings.result(results)
+
+    async def provision_rooms(self, specs, concurrency=None):
+        semaphore = asyncio.Semaphore(bulk_concurrency(concurrency))
+
+        async def run(method, *args, **kwargs):
+            async with semaphore:
+                return await getattr(self, method)(*args, **kwargs)
+
+        async def provision(plan):
+            plan.created((await asyncio.gather(run(plan.create, **plan.create_kwargs), return_exceptions=True))[0])
+            steps = plan.steps()
+            results = await asyncio.gather(*[run(method, *args) for _, method, args in steps], return_exceptions=True)
+            for (step, _, _), result in zip(steps, results):
+                plan.record(step, result)
+
+        plans = [RoomPlan(spec) for spec in specs]
+        await asyncio.gather(*[provision(plan) for plan in plans])
+        return [plan.result() for plan in plans]
+
+    async def sync_members(self, roomId, userIds, group=False, keep=(), kick=True, concurrency=None, rate=None):
+        prefix = 'groups' if group else 'channels'
+        members = await getattr(self, prefix + '_members')(roomId)
+        if members is False:
+            return False
+        actions, unchanged = membership_plan((m['_id'] for m in members), userIds, keep, kick)
+        bucket = TokenBucket(membership_rate(rate))
+        semaphore = asyncio.Semaphore(bulk_concurrency(concurrency))
+
+        async def apply(userId, action):
+            await asyncio.sleep(bucket.reserve())
+            async with semaphore:
+                return await getattr(self, '%s_%s' % (prefix, action))(roomId, userId)
+
+        results = await asyncio.gather(*[apply(userId, action) for userId, action in actions],
+                                       return_exceptions=True)
+        return membership_report(unchanged, actions, results)
+
+    async def export_history(self, rooms, directory, group=False, compress=True, oldest=None, concurrency=None,
+                             count=None):
+        exports = history_exports(rooms, directory, group, compress, oldest, count)
+        semaphore = asyncio.Semaphore(bulk_concurrency(concurrency))
+
+        async def export_room(export):
+            async with semaphore:
+                try:
+                    await self._run(history_export_steps(export, stream=False))
+                except Exception as e:
+                    logger.error('Fail export_history %s: %r', export.roomId, e)
+                    export.error = repr(e)
+
+        await asyncio.gather(*[export_room(export) for export in exports])
+        return [export.result() for export in exports]
+
+    async def create_users(self, records, concurrency=None, checkpoint=None):
+        users = await self._run(users_pages())
+        if users is False:
+            return False
+        state = UserImport(checkpoint)
+        state.load(users)
+        semaphore = asyncio.Semaphore(bulk_concurrency(concurrency))
+
+        async def create(key, data):
+            async with semaphore:
+                try:
+                    result = await self._execute(create_user_call(data))
+                except Exception as e:
+                    result = e
+            state.record(key, data, result)
+
+        for chunk in chunks(records, bulk_chunk_size()):
+            await asyncio.gather(*[create(key, data) for key, data in state.plan(chunk)])
+        return state.result()
+
+    async def _execute(self, call):
+        if call.cache is not None:
+            result = self.info_cache.get(call.cache)
+            if result is not None:
+                return result
+        start = time.perf_counter()
+        with deadline(call_deadline()):
+            if not call.auth:
+                resp = await self.transport.request(call.method, call.path, **call.kwargs)
+            elif call.userId is None:
+                resp = await self.admin_request(call.method, call.path, **call.kwargs)
+            else:
+                resp = await self.user_request(call.method, call.path, call.userId, **call.kwargs)
+        if resp is False:
+            return call.unauthorized()
+        result = call.handle(resp, time.perf_counter() - start, self.request_log)
+        if call.cache is not None and resp.status_code == 200:
+            self.info_cache.set(call.cache, result)
+        return result
+
+    async def _run(self, steps):
+        try:
+            call = next(steps)
+            while True:
+                try:
+                    result = await self._execute(call)
+                except CircuitOpen as e:
+                    call = steps.throw(e)
+                else:
+                    call = steps.send(result)
+        except StopIteration as e:
+            return e.value
+
+    def _iterate(self, pager):
+        return AsyncPageIterator(self, pager)
+
+    def _coalesce(self, key, fn, *args, **kwargs):
+        return self.single_flight.ado(key, fn, *args, **kwargs)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+OUTBOX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    idempotency_key TEXT UNIQUE,
+    method TEXT NOT NULL,
+    args TEXT NOT NULL,
+    kwargs TEXT NOT NULL,
+    queue TEXT NOT NULL,
+    coalesce_key TEXT,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_at REAL NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    owner TEXT,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_queue ON outbox (queue, status, id);
+CREATE INDEX IF NOT EXISTS outbox_status ON outbox (status, next_at);
+CREATE INDEX IF NOT EXISTS outbox_coalesce ON outbox (coalesce_key, status);
+"""
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+SUPERSEDED = 'superseded'
+
+# методы, у которых новый вызов отменяет ожидающий с тем же первым аргументом;
+# у update_user поля ожидающего вызова добавляются к новому
+OUTBOX_REPLACE = re.compile(r'_(set_topic|set_description|set_type|rename)$')
+OUTBOX_MERGE = ('update_user',)
+OUTBOX_EXCLUDE = ('create_token',)
+
+
+def write_failed(result):
+    return result is False or result is None or (isinstance(result, tuple) and result[0] is False)
+
+
+class Outbox(object):
+    """
+    Очередь записей в чат в локальном файле SQLite: вызов сохраняется и
+    сразу возвращает id записи, а фоновый поток выполняет записи по порядку
+    внутри комнаты (пользователя) и параллельно для разных комнат, с
+    повторами при ошибках. Ожидающий вызов, который перекрыт новым (две смены
+    темы), не выполняется. Один файл можно использовать из нескольких процессов.
+    В файле хранятся аргументы вызовов (в т.ч. пароли create_user/update_user).
+
+    outbox.channels_invite(roomId, userId) - то же, что enqueue('channels_invite', (roomId, userId))
+    """
+
+    def __init__(self, path=None, client=None, concurrency=None, retries=None, backoff=None, poll_interval=None,
+                 lease=None, autostart=True):
+        """
+        :param path: файл SQLite (по умолчанию settings.ROCKETCHAT_OUTBOX_PATH)
+        :param client: RocketChat, который выполняет записи
+        :param concurrency: сколько комнат обрабатывать одновременно
+        :param retries: сколько раз повторить неудавшуюся запись
+        :param backoff: задержка перед первым повтором в секундах, дальше удваивается
+        :param poll_interval: как часто проверять очередь (записи других процессов, повторы)
+        :param lease: через сколько секунд запись, которую начал выполнять
+            остановившийся процесс, снова становится ожидающей
+        :param autostart: запустить фоновый поток при первой записи
+        """
+        self.path = path or required_setting('ROCKETCHAT_OUTBOX_PATH')
+        self.client = client
+        self.concurrency = concurrency or setting('ROCKETCHAT_OUTBOX_CONCURRENCY', 4)
+        self.retries = retries if retries is not None else setting('ROCKETCHAT_OUTBOX_RETRIES', 5)
+        self.backoff = backoff if backoff is not None else setting('ROCKETCHAT_OUTBOX_BACKOFF', 1.0)
+        self.poll_interval = poll_interval or setting('ROCKETCHAT_OUTBOX_POLL_INTERVAL', 1.0)
+        self.lease = lease or setting('ROCKETCHAT_OUTBOX_LEASE', 300)
+        self.autostart = autostart
+        self.owner = '%s:%s:%s' % (socket.gethostname(), os.getpid(), id(self))
+        os.close(os.open(self.path, os.O_CREAT | os.O_WRONLY, 0o600))
+        self._db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(OUTBOX_SCHEMA)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._pool = None
+        self._running = set()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                yield
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def __getattr__(self, name):
+        endpoint = ENDPOINTS.get(name)
+        if endpoint is None or endpoint.method != 'POST' or name in OUTBOX_EXCLUDE:
+            raise AttributeError(name)
+
+        def enqueue(*args, **kwargs):
+            return self.enqueue(name, args, kwargs)
+        enqueue.__name__ = name
+        return enqueue
+
+    def enqueue(self, method, args=(), kwargs=None, idempotency_key=None):
+        """
+        Добавить запись в очередь
+        :param method: метод клиента (create_channels, channels_invite, update_user, ...)
+        :param args: позиционные аргументы
+        :param kwargs: именованные аргументы
+        :param idempotency_key: ключ записи: повторный вызов с тем же ключом
+            не добавляет новую запись, а возвращает id существующей
+        :return: id записи
+        """
+        endpoint = ENDPOINTS.get(method)
+        if endpoint is None or endpoint.method != 'POST' or method in OUTBOX_EXCLUDE:
+            raise ValueError('%s can not be queued' % method)
+        kwargs = dict(kwargs or {})
+        bound = endpoint.signature.bind(None, *args, **kwargs)
+        bound.apply_defaults()
+        arguments = bound.arguments
+        first = endpoint.names[0]
+        target = arguments[first]
+        queue = '%s:%s' % (first, target)
+        coalesce_key = None
+        if OUTBOX_REPLACE.search(method) or method in OUTBOX_MERGE:
+            coalesce_key = '%s:%s' % (method, target)
+        now = time.time()
+        with self._transaction():
+            if idempotency_key is not None:
+                row = self._db.execute('SELECT id FROM outbox WHERE idempotency_key = ?',
+                                       (idempotency_key,)).fetchone()
+                if row is not None:
+                    return row[0]
+            if coalesce_key is not None:
+                for item_id, old_kwargs in self._db.execute(
+                        'SELECT id, kwargs FROM outbox WHERE coalesce_key = ? AND status = ? ORDER BY id',
+                        (coalesce_key, PENDING)).fetchall():
+                    if method in OUTBOX_MERGE:
+                        kwargs = dict(json.loads(old_kwargs), **kwargs)
+                    self._db.execute('UPDATE outbox SET status = ?, updated = ? WHERE id = ? AND status = ?',
+                                     (SUPERSEDED, now, item_id, PENDING))
+            item_id = self._db.execute(
+                'INSERT INTO outbox (idempotency_key, method, args, kwargs, queue, coalesce_key, status, next_at, '
+                'created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (idempotency_key, method, json.dumps(list(args)), json.dumps(kwargs), queue, coalesce_key, PENDING,
+                 now, now, now)).lastrowid
+        if self.autostart:
+            self.start()
+        self._wake.set()
+        return item_id
+
+    def start(self):
+        """
+        Запустить фоновый поток, если он еще не запущен
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._loop, name='rocketchat-outbox', daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Остановить фоновый поток, дождавшись выполняющихся записей
+        """
+        self._stopping.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def drain(self, timeout=None):
+        """
+        Выполнить в текущем потоке все записи, которые можно выполнить сейчас
+        (без ожидающих повтора позже)
+        :param timeout: максимум секунд
+        :return: status()
+        """
+        end = None if timeout is None else time.monotonic() + timeout
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            while end is None or time.monotonic() < end:
+                self._wake.clear()
+                claimed = self._dispatch(pool)
+                if not claimed and not self._running:
+                    break
+                self._wake.wait(self.poll_interval)
+        return self.status()
+
+    def _loop(self):
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            while not self._stopping.is_set():
+                self._wake.clear()
+                try:
+                    self._dispatch(pool)
+                except Exception:
+                    logger.exception('Outbox dispatch failed')
+                self._wake.wait(self.poll_interval)
+
+    def _dispatch(self, pool):
+        """
+        Взять и отправить в pool первые записи свободных очередей
+        :return: сколько записей взято
+        """
+        free = self.concurrency - len(self._running)
+        if free <= 0:
+            return 0
+        now = time.time()
+        with self._transaction():
+            self._db.execute('UPDATE outbox SET status = ?, owner = NULL WHERE status = ? AND updated < ?',
+                             (PENDING, RUNNING, now - self.lease))
+            rows = self._db.execute(
+                'SELECT id, method, args, kwargs FROM outbox WHERE status = ? AND next_at <= ? AND id IN '
+                '(SELECT MIN(id) FROM outbox WHERE status IN (?, ?) GROUP BY queue) ORDER BY id LIMIT ?',
+                (PENDING, now, PENDING, RUNNING, free)).fetchall()
+            claimed = []
+            for row in rows:
+                cursor = self._db.execute(
+                    'UPDATE outbox SET status = ?, owner = ?, updated = ? WHERE id = ? AND status = ?',
+                    (RUNNING, self.owner, now, row[0], PENDING))
+                if cursor.rowcount:
+                    claimed.append(row)
+                    self._running.add(row[0])
+        for item_id, method, args, kwargs in claimed:
+            submit(pool, self._execute, item_id, method, json.loads(args), json.loads(kwargs))
+        return len(claimed)
+
+    def _execute(self, item_id, method, args, kwargs):
+        try:
+            if self.client is None:
+                self.client = RocketChat()
+            try:
+                result = run_batch(getattr(self.client, method), *args, **kwargs)
+                error = 'failed' if write_failed(result) else None
+            except Exception as e:
+                result, error = None, repr(e)
+            self._record(item_id, method, result, error)
+        finally:
+            self._running.discard(item_id)
+            self._wake.set()
+
+    def _record(self, item_id, method, result, error):
+        now = time.time()
+        with self._transaction():
+            if error is None:
+                self._db.execute('UPDATE outbox SET status = ?, result = ?, error = NULL, owner = NULL, updated = ? '
+                                 'WHERE id = ?', (DONE, json.dumps(result, default=str), now, item_id))
+                return
+            attempts = self._db.execute('SELECT attempts FROM outbox WHERE id = ?', (item_id,)).fetchone()[0] + 1
+            if attempts > self.retries:
+                logger.error('Outbox %s %s failed after %s attempts: %s', item_id, method, attempts, error)
+                status, next_at = FAILED, now
+            else:
+                logger.warning('Outbox %s %s failed (attempt %s): %s', item_id, method, attempts, error)
+                status, next_at = PENDING, now + min(self.backoff * 2 ** (attempts - 1), 300)
+            self._db.execute('UPDATE outbox SET status = ?, attempts = ?, next_at = ?, error = ?, owner = NULL, '
+                             'updated = ? WHERE id = ?', (status, attempts, next_at, error, now, item_id))
+
+    def status(self):
+        """
+        :return: {'pending', 'running', 'done', 'failed', 'superseded'} - кол-во записей
+        """
+        counts = dict.fromkeys((PENDING, RUNNING, DONE, FAILED, SUPERSEDED), 0)
+        with self._lock:
+            counts.update(self._db.execute('SELECT status, COUNT(*) FROM outbox GROUP BY status').fetchall())
+        return counts
+
+    def items(self, status=None, limit=100):
+        """
+        Записи очереди, новые последними
+        :param status: pending/running/done/failed/superseded или None - все
+        :param limit: максимум записей
+        :return: [{'id', 'method', 'args', 'kwargs', 'status', 'attempts', 'error', 'result', ...}, ...]
+        """
+        query = ('SELECT id, idempotency_key, method, args, kwargs, queue, status, attempts, next_at, created, '
+                 'updated, result, error FROM outbox')
+        params = ()
+        if status is not None:
+            query += ' WHERE status = ?'
+            params = (status,)
+        query += ' ORDER BY id DESC LIMIT ?'
+        with self._lock:
+            rows = self._db.execute(query, params + (limit,)).fetchall()
+        items = []
+        for row in reversed(rows):
+            item = dict(zip(('id', 'idempotency_key', 'method', 'args', 'kwargs', 'queue', 'status', 'attempts',
+                             'next_at', 'created', 'updated', 'result', 'error'), row))
+            item['args'] = json.loads(item['args'])
+            item['kwargs'] = json.loads(item['kwargs'])
+            item['result'] = None if item['result'] is None else json.loads(item['result'])
+            items.append(item)
+        return items
+
+    def retry(self, item_id=None):
+        """
+        Вернуть в очередь неудавшиеся записи
+        :param item_id: id записи или None - все неудавшиеся
+        :return: сколько записей возвращено
+        """
+        query = 'UPDATE outbox SET status = ?, attempts = 0, next_at = ?, updated = ? WHERE status = ?'
+        params = (PENDING, time.time(), time.time(), FAILED)
+        if item_id is not None:
+            query += ' AND id = ?'
+            params += (item_id,)
+        with self._transaction():
+            count = self._db.execute(query, params).rowcount
+        self._wake.set()
+        return count
+
+    def purge(self, older_than=0):
+        """
+        Удалить выполненные и отмененные записи
+        :param older_than: старше скольких секунд
+        :return: сколько записей удалено
+        """
+        with self._transaction():
+            return self._db.execute('DELETE FROM outbox WHERE status IN (?, ?) AND updated < ?',
+                                    (DONE, SUPERSEDED, time.time() - older_than)).rowcount
+
+    def close(self):
+        self.stop()
+        self._db.close()
+
+
+_default_outbox = None
+_default_outbox_lock = threading.Lock()
+
+
+def get_default_outbox():
+    """
+    Общая для процесса очередь записей в файле settings.ROCKETCHAT_OUTBOX_PATH
+    :return: Outbox
+    """
+    global _default_outbox
+    if _default_outbox is None:
+        with _default_outbox_lock:
+            if _default_outbox is None:
+                _default_outbox = Outbox()
+    return _default_outbox
+
+
+class Tenant(object):
+    """
+    Клиенты одного сервера чата в ClientRegistry: свой пул соединений,
+    сессия администратора и кеши, общие для синхронного и асинхронного клиентов
+    """
+
+    def __init__(self, name, options):
+        """
+        :param name: название сервера в реестре
+        :param options: {'url', 'username', 'password', 'concurrency', 'timeout'}
+        """
+        missing = [key for key in ('url', 'username', 'password') if not options.get(key)]
+        if missing:
+            raise ImproperlyConfigured('Rocket.Chat tenant %s: %s is not set' % (name, ', '.join(missing)))
+        self.name = name
+        self.url = options['url']
+        self.timeout = options.get('timeout')
+        self.concurrency = options.get('concurrency') or setting('ROCKETCHAT_TENANT_CONCURRENCY', 10)
+        self.admin_session = AdminSession(options['username'], options['password'])
+        token_alias = setting('ROCKETCHAT_TOKEN_CACHE_ALIAS')
+        self.token_cache = (DjangoTokenCache(token_alias, prefix='rocketchat:token:%s:' % name) if token_alias
+                            else TokenCache())
+        info_alias = setting('ROCKETCHAT_INFO_CACHE_ALIAS')
+        self.info_cache = (DjangoInfoCache(info_alias, prefix='rocketchat:info:%s:' % name) if info_alias
+                           else InfoCache())
+        self.subscription_store = SubscriptionStore()
+        self.room_index = RoomNameIndex()
+        self.single_flight = SingleFlight()
+        self.used = time.monotonic()
+        self._client = None
+        self._async_client = None
+        self._lock = threading.Lock()
+
+    def _components(self):
+        return {
+            'token_cache': self.token_cache,
+            'admin_session': self.admin_session,
+            'subscription_store': self.subscription_store,
+            'room_index': self.room_index,
+            'info_cache': self.info_cache,
+            'single_flight': self.single_flight,
+        }
+
+    def client(self):
+        """
+        :return: RocketChat; не больше concurrency одновременных запросов,
+            остальные потоки ждут свободное соединение не дольше срока deadline
+        """
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    transport = Transport(self.url, pool_maxsize=self.concurrency, pool_block=True,
+                                          timeout=self.timeout, concurrency=self.concurrency)
+                    self._client = RocketChat(transport=transport, **self._components())
+        return self._client
+
+    def async_client(self):
+        """
+        :return: AsyncRocketChat; не больше concurrency одновременных запросов в одном event loop
+        """
+        if self._async_client is None:
+            with self._lock:
+                if self._async_client is None:
+                    transport = AsyncTransport(self.url, max_connections=self.concurrency,
+                                               max_keepalive_connections=self.concurrency,
+                                               timeout=self.timeout, concurrency=self.concurrency)
+                    self._async_client = AsyncRocketChat(transport=transport, **self._components())
+        return self._async_client
+
+    def metrics(self):
+        metrics = {'idle': time.monotonic() - self.used, 'admin_session': self.admin_session.metrics()}
+        if self._client is not None:
+            metrics['scheduler'] = self._client.transport.scheduler.metrics()
+        if self._async_client is not None:
+            metrics['async_scheduler'] = self._async_client.transport.scheduler.metrics()
+        return metrics
+
+    def close(self):
+        """
+        Закрыть соединения. Уже выданные клиенты продолжают работать,
+        открывая новые соединения при необходимости
+        """
+        if self._client is not None:
+            self._client.transport.close()
+        if self._async_client is not None:
+            self._async_client.transport.close()
+
+
+class ClientRegistry(object):
+    """
+    Клиенты для многих серверов чата из одного процесса: по Tenant на сервер,
+    создаются при первом обращении и закрываются после idle_timeout без
+    обращений. Медленный сервер занимает только свои concurrency соединений
+    и не мешает остальным. Django settings не обязательны.
+    """
+
+    def __init__(self, tenants=None, loader=None, idle_timeout=None):
+        """
+        :param tenants: {название: {'url', 'username', 'password', 'concurrency', 'timeout'}}
+            (по умолчанию settings.ROCKETCHAT_TENANTS)
+        :param loader: функция название -> настройки сервера или None, для серверов не из tenants
+            (например, из базы)
+        :param idle_timeout: через сколько секунд без обращений закрыть клиентов сервера
+        """
+        self.configs = dict(tenants if tenants is not None else setting('ROCKETCHAT_TENANTS', {}))
+        self.loader = loader
+        self.idle_timeout = idle_timeout or setting('ROCKETCHAT_TENANT_IDLE_TIMEOUT', 600)
+        self._tenants = {}
+        self._lock = threading.Lock()
+        self._swept = time.monotonic()
+
+    def register(self, name, url, username, password, **options):
+        """
+        Добавить или заменить сервер
+        :param options: concurrency, timeout
+        """
+        with self._lock:
+            self.configs[name] = dict(options, url=url, username=username, password=password)
+            tenant = self._tenants.pop(name, None)
+        if tenant is not None:
+            tenant.close()
+
+    def unregister(self, name):
+        with self._lock:
+            self.configs.pop(name, None)
+            tenant = self._tenants.pop(name, None)
+        if tenant is not None:
+            tenant.close()
+
+    def tenant(self, name):
+        """
+        :param name: название сервера
+        :return: Tenant
+        """
+        now = time.monotonic()
+        if now - self._swept > self.idle_timeout / 2:
+            self.evict_idle(now)
+        tenant = self._tenants.get(name)
+        if tenant is None:
+            with self._lock:
+                tenant = self._tenants.get(name)
+                if tenant is None:
+                    options = self.configs.get(name)
+                    if options is None and self.loader is not None:
+                        options = self.loader(name)
+                    if options is None:
+                        raise KeyError(name)
+                    tenant = self._tenants[name] = Tenant(name, options)
+        tenant.used = now
+        return tenant
+
+    def client(self, name):
+        """
+        :param name: название сервера
+        :return: RocketChat
+        """
+        return self.tenant(name).client()
+
+    def async_client(self, name):
+        """
+        :param name: название сервера
+        :return: AsyncRocketChat
+        """
+        return self.tenant(name).async_client()
+
+    def evict_idle(self, now=None):
+        """
+        Закрыть клиентов серверов, к которым не обращались дольше idle_timeout
+        :return: названия закрытых серверов
+        """
+        now = now or time.monotonic()
+        with self._lock:
+            self._swept = now
+            idle = [name for name, tenant in self._tenants.items() if now - tenant.used > self.idle_timeout]
+            tenants = [self._tenants.pop(name) for name in idle]
+        for tenant in tenants:
+            logger.info('Closing idle Rocket.Chat tenant %s', tenant.name)
+            tenant.close()
+        return idle
+
+    def metrics(self):
+        """
+        :return: {название: {'idle', 'admin_session', 'scheduler', 'async_scheduler'}}
+        """
+        with self._lock:
+            tenants = list(self._tenants.values())
+        return dict((tenant.name, tenant.metrics()) for tenant in tenants)
+
+    def close(self):
+        with self._lock:
+            tenants = list(self._tenants.values())
+            self._tenants.clear()
+        for tenant in tenants:
+            tenant.close()
+
+
+_client_registry = None
+_client_registry_lock = threading.Lock()
+
+
+def get_client_registry():
+    """
+    Общий для процесса реестр клиентов (серверы из settings.ROCKETCHAT_TENANTS)
+    :return: ClientRegistry
+    """
+    global _client_registry
+    if _client_registry is None:
+        with _client_registry_lock:
+            if _client_registry is None:
+                _client_registry = ClientRegistry()
+    return _client_registry
+
+
+class RealtimeUnread(object):
+    """
+    Счетчики непрочитанного в реальном времени через DDP (websocket).
+    Сервер разрешает сессии подписку только на поток ее пользователя, поэтому
+    на каждого отслеживаемого пользователя открывается свое соединение
+    (RealtimeSession) с входом по его токену из token_cache клиента. Изменения
+    subscriptions-changed обновляют таблицу счетчиков в памяти.
+    Пока соединения пользователя нет или сервер отказал в подписке,
+    notifications() идет через REST.
+    """
+
+    def __init__(self, client=None, url=None, reconnect_min=None, reconnect_max=None, ping_interval=None,
+                 resync_concurrency=None):
+        """
+        :param client: RocketChat, через который выпускаем токены и делаем REST-запросы
+        :param url: адрес websocket (по умолчанию <ROCKETCHAT_URL>/websocket)
+        :param reconnect_min: начальная задержка переподключения, сек
+        :param reconnect_max: максимальная задержка переподключения, сек
+        :param ping_interval: через сколько секунд тишины пинговать сервер; если
+            за 2 * ping_interval от сервера ничего не пришло, соединение считается
+            потерянным (полуоткрытое соединение, например после таймаута NAT)
+        :param resync_concurrency: сколько полных синхронизаций через REST
+            выполнять одновременно после (пере)подключений
+        """
+        if websocket is None:
+            raise ImproperlyConfigured('RealtimeUnread requires websocket-client')
+        self.client = client or RocketChat()
+        self.url = url or re.sub(r'^http', 'ws', self.client.transport.base_url) + '/websocket'
+        self.reconnect_min = reconnect_min or setting('ROCKETCHAT_REALTIME_RECONNECT_MIN', 1)
+        self.reconnect_max = reconnect_max or setting('ROCKETCHAT_REALTIME_RECONNECT_MAX', 60)
+        self.ping_interval = ping_interval or setting('ROCKETCHAT_REALTIME_PING', 25)
+        self.resync_concurrency = resync_concurrency or setting('ROCKETCHAT_REALTIME_RESYNC_CONCURRENCY', 4)
+        self.users = set()
+        self.live = set()
+        self.table = {}
+        self.sessions = {}
+        # изменения, пришедшие во время полной синхронизации пользователя
+        self._pending = {}
+        self._pool = None
+        self._started = False
+        self._lock = threading.Lock()
+
+    @property
+    def reconnects(self):
+        return sum(session.reconnects for session in list(self.sessions.values()))
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return self
+            self._started = True
+            self._pool = ThreadPoolExecutor(max_workers=self.resync_concurrency,
+                                            thread_name_prefix='rocketchat-realtime-resync')
+            sessions = [self._session(userId) for userId in self.users]
+        for session in sessions:
+            session.start()
+        return self
+
+    def stop(self):
+        with self._lock:
+            self._started = False
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+            pool, self._pool = self._pool, None
+        for session in sessions:
+            session.stop()
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+    def watch(self, userId):
+        """
+        Начать отслеживать пользователя
+        :param userId: id пользователя в чате
+        """
+        with self._lock:
+            if userId in self.users:
+                return
+            self.users.add(userId)
+            session = self._session(userId) if self._started else None
+        if session is not None:
+            session.start()
+
+    def unwatch(self, userId):
+        with self._lock:
+            self.users.discard(userId)
+            session = self.sessions.pop(userId, None)
+        if session is not None:
+            session.stop()
+        with self._lock:
+            self.live.discard(userId)
+            self.table.pop(userId, None)
+            self._pending.pop(userId, None)
+
+    def is_connected(self, userId):
+        """
+        :return: True, если соединение пользователя установлено
+        """
+        session = self.sessions.get(userId)
+        return session is not None and session.connected.is_set()
+
+    def notifications(self, userId):
+        """
+        Информация о новых сообщениях: из таблицы, если пользователь
+        отслеживается по websocket, иначе через REST
+        :param userId: id пользователя в чате
+        :return: alert True/False, unread кол-ва новых сообщений
+        """
+        with self._lock:
+            state = self.table.get(userId) if userId in self.live else None
+            if state is not None:
+                return state.totals()
+        return self.client.notifications(userId)
+
+    def _session(self, userId):
+        session = self.sessions[userId] = RealtimeSession(self, userId)
+        return session
+
+    def _connected(self, session):
+        """
+        Соединение пользователя установлено: изменения копятся до конца полной
+        синхронизации, которая выполняется в пуле, а не в потоке чтения
+        (иначе поток не отвечает на ping сервера)
+        """
+        with self._lock:
+            if self.sessions.get(session.userId) is not session:
+                return
+            self.table.pop(session.userId, None)
+            self._pending[session.userId] = []
+            pool = self._pool
+        if pool is not None:
+            submit(pool, self._resync, session, session.epoch)
+
+    def _resync(self, session, epoch):
+        userId = session.userId
+        try:
+            data = self.client.subscriptions_get(userId)
+        except Exception:
+            logger.exception('Realtime resync for %s failed', userId)
+            data = False
+        with self._lock:
+            if self.sessions.get(userId) is not session or session.epoch != epoch:
+                return
+            pending = self._pending.pop(userId, ())
+            if data is False:
+                return
+            state = Subscriptions()
+            state.reset(data['update'])
+            for action, sub in pending:
+                self._merge(state, action, sub)
+            self.table[userId] = state
+
+    def _subscribed(self, session, ready):
+        with self._lock:
+            if self.sessions.get(session.userId) is not session:
+                return
+            if ready:
+                self.live.add(session.userId)
+            else:
+                self.live.discard(session.userId)
+
+    def _disconnected(self, session):
+        with self._lock:
+            if self.sessions.get(session.userId) is not session:
+                return
+            self.live.discard(session.userId)
+            self._pending.pop(session.userId, None)
+
+    def _apply(self, session, fields):
+        userId, _, event = fields['eventName'].partition('/')
+        if event != 'subscriptions-changed' or userId != session.userId:
+            return
+        action, sub = fields['args'][0], fields['args'][1]
+        with self._lock:
+            pending = self._pending.get(userId)
+            if pending is not None:
+                pending.append((action, sub))
+                return
+            state = self.table.get(userId)
+            if state is not None:
+                self._merge(state, action, sub)
+
+    @staticmethod
+    def _merge(state, action, sub):
+        if action == 'removed':
+            state.merge((), [sub])
+        else:
+            state.merge([sub], ())
+
+
+class RealtimeSession(object):
+    """
+    DDP-соединение одного пользователя для RealtimeUnread: вход по токену
+    пользователя (resume), подписка на <userId>/subscriptions-changed,
+    переподключение с экспоненциальной задержкой
+    """
+
+    def __init__(self, owner, userId):
+        """
+        :param owner: RealtimeUnread
+        :param userId: id пользователя в чате
+        """
+        self.owner = owner
+        self.userId = userId
+        self.connected = threading.Event()
+        self.reconnects = 0
+        self.refused = False
+        # номер соединения: результат синхронизации прежнего соединения отбрасывается
+        self.epoch = 0
+        self._ws = None
+        self._received_at = None
+        self._stopping = threading.Event()
+        self._send_lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='rocketchat-realtime-%s' % self.userId, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        ws = self._ws
+        if ws is not None:
+            ws.close()
+        if self._thread is not None:
+            self._thread.join()
+
+    @property
+    def sub_id(self):
+        return 'unread:' + self.userId
+
+    def _send(self, message):
+        with self._send_lock:
+            self._ws.send(json.dumps(message))
+
+    def _run(self):
+        owner = self.owner
+        delay = owner.reconnect_min
+        while not self._stopping.is_set():
+            try:
+                self._ws = websocket.create_connection(owner.url, timeout=owner.ping_interval)
+                self._handshake()
+                self.epoch += 1
+                self.connected.set()
+                owner._connected(self)
+                self._send({'msg': 'sub', 'id': self.sub_id, 'name': 'stream-notify-user',
+                            'params': ['%s/subscriptions-changed' % self.userId, False]})
+                delay = owner.reconnect_min
+                self._read_loop()
+            except Exception as e:
+                if not self._stopping.is_set():
+                    logger.warning('Realtime connection for %s lost: %r', self.userId, e)
+            finally:
+                self.connected.clear()
+                owner._disconnected(self)
+                if self._ws is not None:
+                    self._ws.close()
+            if self.refused or self._stopping.wait(delay * random.uniform(0.5, 1.0)):
+                break
+            self.reconnects += 1
+            delay = min(delay * 2, owner.reconnect_max)
+
+    def _handshake(self):
+        self._send({'msg': 'connect', 'version': '1', 'support': ['1']})
+        self._expect('connected')
+        for refresh in (False, True):
+            token = self.owner.client.get_headers(self.userId, refresh=refresh)['X-Auth-Token']
+            if token is False:
+                raise ValueError('can not create token for %s' % self.userId)
+            self._send({'msg': 'method', 'method': 'login', 'id': 'login', 'params': [{'resume': token}]})
+            message = self._expect('result')
+            if 'error' not in message:
+                return
+            logger.info('Realtime login for %s rejected: %s', self.userId, message['error'])
+        raise ValueError('login failed: %s' % message['error'])
+
+    def _expect(self, msg):
+        while True:
+            message = self._recv()
+            if message.get('msg') == msg:
+                return message
+
+    def _recv(self):
+        raw = self._ws.recv()
+        if not raw:
+            raise websocket.WebSocketConnectionClosedException('Connection closed by server')
+        self._received_at = time.monotonic()
+        message = json.loads(raw)
+        if message.get('msg') == 'ping':
+            self._send({'msg': 'pong'})
+        return message
+
+    def _read_loop(self):
+        ping_interval = self.owner.ping_interval
+        while not self._stopping.is_set():
+            try:
+                message = self._recv()
+            except websocket.WebSocketTimeoutException:
+                if time.monotonic() - self._received_at >= 2 * ping_interval:
+                    raise websocket.WebSocketTimeoutException('No response for %s seconds' % (2 * ping_interval))
+                self._send({'msg': 'ping'})
+                continue
+            msg = message.get('msg')
+            if msg == 'ready' and self.sub_id in message['subs']:
+                self.owner._subscribed(self, True)
+            elif msg == 'nosub' and message.get('id') == self.sub_id:
+                logger.info('Realtime subscription for %s refused, using REST: %s', self.userId,
+                            message.get('error'))
+                self.owner._subscribed(self, False)
+                self.refused = True
+                return
+            elif msg == 'changed' and message.get('collection') == 'stream-notify-user':
+                self.owner._apply(self, message['fields'])
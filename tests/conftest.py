@@ -0,0 +1,30 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bench  # noqa: E402 - настраивает django settings
+import helpers  # noqa: E402
+
+from django.conf import settings  # noqa: E402
+
+
+@pytest.fixture
+def server():
+    with bench.StubServer(latency=0, rooms=10, members=3, users=10, messages=10) as server:
+        settings.ROCKETCHAT_URL = server.url
+        yield server
+
+
+@pytest.fixture
+def client(server):
+    client = bench.sync_client(server, 4)
+    yield client
+    client.transport.close()
+
+
+@pytest.fixture
+def make_async_client(server):
+    return bench.async_client(server, 4)
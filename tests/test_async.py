@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+
+import bench
+
+
+@pytest.fixture
+def async_server(server):
+    # второй сервер с теми же данными: sync и async выполняют одни и те же операции
+    with bench.StubServer(latency=0, rooms=10, members=3, users=10, messages=10) as async_server:
+        yield async_server
+
+
+def run_async(async_server, operation):
+    async def main():
+        client = bench.async_client(async_server, 4)()
+        try:
+            return await operation(client)
+        finally:
+            await client.aclose()
+    return asyncio.run(main())
+
+
+def test_create_user(server, client, async_server):
+    args = ('new@example.com', 'Новый Сотрудник', 'secret')
+    userId = client.create_user(*args)
+    assert run_async(async_server, lambda c: c.create_user(*args)) == userId
+    assert server.state.users[userId]['username'] == async_server.state.users[userId]['username']
+    assert client.create_user(*args) is False
+    assert run_async(async_server, lambda c: c.create_user(*args)) is False
+
+
+def test_create_users(client, async_server):
+    records = [{'email': 'user1@example.com', 'fullname': 'Иван Петров', 'password': 'secret'},
+               {'email': 'new@example.com', 'fullname': 'Новый Сотрудник', 'password': 'secret'}]
+    result = client.create_users(records)
+    assert run_async(async_server, lambda c: c.create_users(records)) == result
+
+
+def test_notifications(server, client, async_server):
+    async def poll(c):
+        return [await c.notifications('user0'), await c.notifications('user0')]
+    expected = [client.notifications('user0'), client.notifications('user0')]
+    assert expected[0] != expected[1]
+    assert run_async(async_server, poll) == expected
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'kick': False}, {'keep': ['user0']}])
+def test_sync_members(server, client, async_server, kwargs):
+    userIds = ['user1', 'user5', 'user6']
+    report = client.sync_members('room0', userIds, **kwargs)
+    assert run_async(async_server, lambda c: c.sync_members('room0', userIds, **kwargs)) == report
+    assert server.state.rooms['room0']['members'] == async_server.state.rooms['room0']['members']
+
+
+def test_sync_members_group(server, client, async_server):
+    report = client.sync_members('room1', ['user1', 'user9'], group=True)
+    assert run_async(async_server, lambda c: c.sync_members('room1', ['user1', 'user9'], group=True)) == report
+    assert async_server.state.rooms['room1']['members'] == {'user1', 'user9'}
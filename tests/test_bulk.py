@@ -0,0 +1,108 @@
+import asyncio
+
+import bench
+
+
+def test_provision_private_room_created_as_group(server, client):
+    results = client.provision_rooms(bench.room_specs('Проект', 4))
+    assert [result['errors'] for result in results] == [{}] * 4
+    for i, result in enumerate(results):
+        room = server.state.rooms[result['roomId']]
+        assert room['t'] == ('p' if i % 2 else 'c')
+        assert (room['topic'], room['description'], room['owners']) == ('тема', 'описание', {'user1'})
+        assert 'set_type' not in result['steps']
+
+
+def test_provision_private_overrides_group(server, client):
+    result, = client.provision_rooms([{'name': 'public', 'group': True, 'private': False, 'topic': 'тема'}])
+    assert result['success'] and server.state.rooms[result['roomId']]['t'] == 'c'
+    assert list(result['steps']) == ['create', 'set_topic']
+
+
+def test_async_provision(server, make_async_client):
+    results = asyncio.run(make_async_client().provision_rooms(bench.room_specs('Async', 2)))
+    assert all(result['success'] for result in results)
+    assert server.state.rooms[results[1]['roomId']]['t'] == 'p'
+
+
+def test_stub_rejects_channel_methods_on_private_rooms(client):
+    created = client.create_groups('private_room')
+    assert client.channels_set_topic(created.id, 'тема') is False
+    assert client.groups_set_topic(created.id, 'тема') is True
+
+
+def test_create_users_matches_existing_email(server, client):
+    records = [
+        {'email': 'user1@example.com', 'fullname': 'Иван Петров', 'password': 'secret'},
+        {'email': 'USER2@example.com', 'fullname': 'Пётр Иванов', 'password': 'secret'},
+        {'email': 'new@example.com', 'fullname': 'Новый Сотрудник', 'password': 'secret'},
+        {'email': 'new@example.com', 'fullname': 'Новый Сотрудник Второй', 'password': 'secret'},
+    ]
+    users = len(server.state.users)
+    result = client.create_users(records)
+    assert result['errors'] == {'new@example.com': 'duplicate e-mail new@example.com'}
+    assert result['ids']['user1@example.com'] == 'user1'
+    assert result['ids']['USER2@example.com'] == 'user2'
+    assert len(server.state.users) == users + 1
+    again = client.create_users(records)
+    assert again['ids'] == result['ids'] and len(server.state.users) == users + 1
+
+
+def test_create_users_reports_duplicate_email(server, client):
+    records = [
+        {'email': 'New@example.com', 'fullname': 'Новый Сотрудник', 'password': 'secret'},
+        {'email': 'new@example.com', 'fullname': 'Новый Сотрудник', 'password': 'secret'},
+    ]
+    users = len(server.state.users)
+    result = client.create_users(records)
+    assert list(result['ids']) == ['New@example.com']
+    assert result['errors'] == {'new@example.com': 'duplicate e-mail new@example.com'}
+    assert len(server.state.users) == users + 1
+
+
+def test_async_create_users_matches_existing_email(server, make_async_client):
+    records = [{'email': 'user3@example.com', 'fullname': 'Анна Смирнова', 'password': 'secret'}]
+    result = asyncio.run(make_async_client().create_users(records))
+    assert result == {'ids': {'user3@example.com': 'user3'}, 'errors': {}}
+
+
+def test_sync_members_diff(server, client):
+    report = client.sync_members('room0', ['user1', 'user2', 'user5'])
+    assert report == {'user0': {'action': 'kick', 'success': True},
+                      'user1': {'action': None, 'success': True},
+                      'user2': {'action': None, 'success': True},
+                      'user5': {'action': 'invite', 'success': True}}
+    assert server.state.rooms['room0']['members'] == {'user1', 'user2', 'user5'}
+    assert client.sync_members('room0', ['user1', 'user2', 'user5']) == dict(
+        (userId, {'action': None, 'success': True}) for userId in ('user1', 'user2', 'user5'))
+
+
+def test_sync_members_keep_and_no_kick(server, client):
+    report = client.sync_members('room0', ['user3'], keep=['user0'])
+    assert {userId: item['action'] for userId, item in report.items()} == {
+        'user1': 'kick', 'user2': 'kick', 'user3': 'invite'}
+    assert server.state.rooms['room0']['members'] == {'user0', 'user3'}
+    report = client.sync_members('room0', ['user4'], kick=False)
+    assert {userId: item['action'] for userId, item in report.items()} == {'user4': 'invite'}
+    assert server.state.rooms['room0']['members'] == {'user0', 'user3', 'user4'}
+
+
+def test_sync_members_partial_failure(server, client, monkeypatch):
+    channels_kick = client.channels_kick
+
+    def kick(roomId, userId):
+        if userId == 'user1':
+            raise ConnectionError('connection reset')
+        return channels_kick(roomId, userId)
+    monkeypatch.setattr(client, 'channels_kick', kick)
+    report = client.sync_members('room0', ['user2', 'ghost'])
+    assert report['ghost'] == {'action': 'invite', 'success': False}
+    assert report['user1']['success'] is False and 'connection reset' in report['user1']['error']
+    assert report['user0'] == {'action': 'kick', 'success': True}
+    assert report['user2'] == {'action': None, 'success': True}
+    assert server.state.rooms['room0']['members'] == {'user1', 'user2'}
+
+
+def test_sync_members_unknown_room(client):
+    assert client.sync_members('missing', ['user1']) is False
+    assert client.sync_members('room1', ['user1']) is False
@@ -0,0 +1,53 @@
+from django.core.cache import caches
+
+import helpers
+
+
+def test_django_token_cache_clear_keeps_other_keys():
+    cache = caches['default']
+    cache.set('session:abc', 'session data')
+    tokens = helpers.DjangoTokenCache(prefix='test:token:')
+    other = helpers.DjangoTokenCache(prefix='test:other:')
+    tokens.set('user1', 'token1')
+    other.set('user1', 'other1')
+    assert tokens.get('user1') == 'token1'
+    tokens.clear()
+    assert tokens.get('user1') is None
+    assert other.get('user1') == 'other1'
+    assert cache.get('session:abc') == 'session data'
+    tokens.set('user1', 'token2')
+    assert tokens.get('user1') == 'token2'
+
+
+def test_django_token_cache_generation_lost():
+    cache = caches['default']
+    tokens = helpers.DjangoTokenCache(prefix='test:evicted:')
+    tokens.set('user1', 'token1')
+    tokens.clear()
+    cache.delete('test:evicted#generation')
+    assert tokens.get('user1') is None
+
+
+def test_django_info_cache_clear_keeps_other_keys():
+    cache = caches['default']
+    cache.set('session:abc', 'session data')
+    info = helpers.DjangoInfoCache(prefix='test:info:')
+    info.set('room:r1', {'_id': 'r1', 'topic': ''})
+    info.update('room:r1', lambda room: dict(room, topic='Тема'))
+    assert info.get('room:r1') == {'_id': 'r1', 'topic': 'Тема'}
+    info.clear()
+    assert info.get('room:r1') is None
+    info.update('room:r1', lambda room: dict(room, topic='old'))
+    assert info.get('room:r1') is None
+    assert cache.get('session:abc') == 'session data'
+    assert info.stats()['room'] == {'hits': 1, 'misses': 2, 'ratio': 1 / 3}
+
+
+def test_client_with_django_info_cache(server, client):
+    client.info_cache = helpers.DjangoInfoCache(prefix='test:client:')
+    assert client.room_info('room0')['topic'] == ''
+    assert client.channels_set_topic('room0', 'Тема') is True
+    server.state.rooms['room0']['topic'] = 'changed on server'
+    assert client.room_info('room0')['topic'] == 'Тема'
+    client.info_cache.clear()
+    assert client.room_info('room0')['topic'] == 'changed on server'
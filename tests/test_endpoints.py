@@ -0,0 +1,71 @@
+import pytest
+
+import helpers
+
+# вызов метода клиента -> запрос прежнего рукописного метода (путь, HTTP-метод, тело);
+# отличие одно: members=None отправляется как []
+CASES = [
+    ('create_channels', ('new_channel', True, ['user1']), 'POST', '/api/v1/channels.create',
+     {'name': 'new_channel', 'readOnly': True, 'members': ['user1']}),
+    ('create_groups', ('new_group',), 'POST', '/api/v1/groups.create',
+     {'name': 'new_group', 'readOnly': False, 'members': []}),
+    ('channels_add_owner', ('room0', 'user1'), 'POST', '/api/v1/channels.addOwner',
+     {'roomId': 'room0', 'userId': 'user1'}),
+    ('channels_set_description', ('room0', 'описание'), 'POST', '/api/v1/channels.setDescription',
+     {'roomId': 'room0', 'description': 'описание'}),
+    ('channels_set_topic', ('room0', 'тема'), 'POST', '/api/v1/channels.setTopic', {'roomId': 'room0', 'topic': 'тема'}),
+    ('channels_set_type', ('room0', True), 'POST', '/api/v1/channels.setType', {'roomId': 'room0', 'type': 'p'}),
+    ('channels_rename', ('room0', 'renamed'), 'POST', '/api/v1/channels.rename', {'roomId': 'room0', 'name': 'renamed'}),
+    ('channels_kick', ('room0', 'user1'), 'POST', '/api/v1/channels.kick', {'roomId': 'room0', 'userId': 'user1'}),
+    ('channels_invite', ('room0', 'user5'), 'POST', '/api/v1/channels.invite', {'roomId': 'room0', 'userId': 'user5'}),
+    ('channels_archive', ('room0',), 'POST', '/api/v1/channels.archive', {'roomId': 'room0'}),
+    ('channels_unarchive', ('room0',), 'POST', '/api/v1/channels.unarchive', {'roomId': 'room0'}),
+    ('channels_close', ('room0',), 'POST', '/api/v1/channels.close', {'roomId': 'room0'}),
+    ('groups_add_owner', ('room1', 'user1'), 'POST', '/api/v1/groups.addOwner', {'roomId': 'room1', 'userId': 'user1'}),
+    ('groups_set_topic', ('room1', 'тема'), 'POST', '/api/v1/groups.setTopic', {'roomId': 'room1', 'topic': 'тема'}),
+    ('groups_set_type', ('room1', False), 'POST', '/api/v1/groups.setType', {'roomId': 'room1', 'type': 'c'}),
+    ('groups_rename', ('room1', 'renamed'), 'POST', '/api/v1/groups.rename', {'roomId': 'room1', 'name': 'renamed'}),
+    ('groups_kick', ('room1', 'user1'), 'POST', '/api/v1/groups.kick', {'roomId': 'room1', 'userId': 'user1'}),
+    ('groups_invite', ('room1', 'user5'), 'POST', '/api/v1/groups.invite', {'roomId': 'room1', 'userId': 'user5'}),
+    ('groups_archive', ('room1',), 'POST', '/api/v1/groups.archive', {'roomId': 'room1'}),
+    ('create_user', ('new@example.com', 'Новый Сотрудник', 'secret'), 'POST', '/api/v1/users.create',
+     {'email': 'new@example.com', 'name': 'Новый Сотрудник', 'username': 'Novyij_Sotrudnik_new', 'password': 'secret'}),
+    ('create_token', ('user1',), 'POST', '/api/v1/users.createToken', {'userId': 'user1'}),
+    ('update_user', ('user1',), 'POST', '/api/v1/users.update', {'userId': 'user1', 'data': {}}),
+    ('about_me', ('user1',), 'GET', '/api/v1/me', {}),
+]
+
+
+@pytest.mark.parametrize('name, args, method, path, data', CASES, ids=[case[0] for case in CASES])
+def test_generated_method_request(server, client, name, args, method, path, data):
+    client.auth_admin()
+    client.get_headers('user1')
+    server.state.requests.clear()
+    assert getattr(client, name)(*args) not in (False, None)
+    assert list(server.state.requests) == [(method, path, data)]
+
+
+def test_update_user_kwargs(server, client):
+    client.auth_admin()
+    server.state.requests.clear()
+    assert client.update_user('user1', name='Новое имя', email='new@example.com') is True
+    assert list(server.state.requests) == [
+        ('POST', '/api/v1/users.update', {'userId': 'user1', 'data': {'name': 'Новое имя', 'email': 'new@example.com'}})]
+
+
+def test_keyword_arguments_and_defaults(server, client):
+    client.auth_admin()
+    server.state.requests.clear()
+    assert client.channels_set_topic(topic='тема', roomId='room0') is True
+    assert client.channels_set_type('room0') is True
+    assert [data for method, path, data in server.state.requests] == [
+        {'roomId': 'room0', 'topic': 'тема'}, {'roomId': 'room0', 'type': 'c'}]
+    with pytest.raises(TypeError):
+        client.channels_set_topic('room0')
+
+
+def test_signatures_keep_baseline_order():
+    assert [str(helpers.RocketChat.create_channels.__signature__), str(helpers.RocketChat.channels_set_type.__signature__),
+            str(helpers.RocketChat.create_user.__signature__), str(helpers.RocketChat.update_user.__signature__)] == [
+        "(self, name='', readOnly=False, members=None)", '(self, roomId, private=False)',
+        '(self, email, fullname, password)', '(self, userId, **kwargs)']
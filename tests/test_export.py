@@ -0,0 +1,70 @@
+import asyncio
+import gzip
+import json
+import os
+
+import pytest
+import requests
+
+
+def read_export(path):
+    with gzip.open(path) as f:
+        return [json.loads(line)['_id'] for line in f]
+
+
+def break_second_page(client, monkeypatch):
+    """
+    Ответ на вторую страницу обрывается после трех сообщений
+    """
+    execute = client._execute
+    broken = []
+
+    def stream(messages):
+        for i, message in enumerate(messages):
+            if i == 3:
+                raise requests.exceptions.ChunkedEncodingError('Connection broken')
+            yield message
+
+    def _execute(call):
+        if not broken and 'latest' in call.kwargs['params']:
+            broken.append(call)
+            return stream(execute(call))
+        return execute(call)
+
+    monkeypatch.setattr(client, '_execute', _execute)
+    return broken
+
+
+def test_export_resumes_after_broken_page(server, client, tmp_path, monkeypatch):
+    server.state.chunked = True
+    expected = [m['_id'] for m in server.state.history('room0')]
+    broken = break_second_page(client, monkeypatch)
+    result, = client.export_history(['room0'], str(tmp_path), count=4)
+    assert broken and not result['done'] and result['error']
+    # первая страница сохранена, начало второй записано в файл, но не в курсор
+    with open(result['path'] + '.cursor') as f:
+        cursor = json.load(f)
+    assert cursor['messages'] == 4 and os.path.getsize(result['path']) > cursor['size']
+
+    result, = client.export_history(['room0'], str(tmp_path), count=4)
+    assert result['done'] and result['error'] is None and result['messages'] == len(expected)
+    assert read_export(result['path']) == expected
+
+
+def test_export_rejects_duplicate_rooms(client, tmp_path):
+    with pytest.raises(ValueError):
+        client.export_history(['room0', {'roomId': 'room0'}], str(tmp_path))
+    assert not list(tmp_path.iterdir())
+
+
+def test_async_export_rejects_duplicate_rooms(make_async_client, tmp_path):
+    async def run():
+        client = make_async_client()
+        try:
+            await client.export_history(['room2', 'room2'], str(tmp_path))
+        finally:
+            await client.aclose()
+
+    with pytest.raises(ValueError):
+        asyncio.run(run())
+    assert not list(tmp_path.iterdir())
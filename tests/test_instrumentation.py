@@ -0,0 +1,55 @@
+import gzip
+import json
+
+import helpers
+
+
+def instrumented_client(server, registry):
+    transport = helpers.Transport(base_url=server.url, instrumentation=helpers.Instrumentation([registry]))
+    return helpers.RocketChat(transport=transport, token_cache=helpers.TokenCache(),
+                              info_cache=helpers.InfoCache(), single_flight=helpers.SingleFlight(window=0))
+
+
+def test_sample_counts_response_bytes(server):
+    registry = helpers.MetricsRegistry()
+    client = instrumented_client(server, registry)
+    assert client.channels_set_topic('room0', 'Тема') is True
+    metrics = registry.snapshot()['channels.setTopic']
+    assert metrics['count'] == 1 and metrics['statuses'] == {200: 1}
+    assert metrics['response_bytes'] == len(b'{"success": true}')
+
+
+def test_streamed_response_not_read_upfront(server):
+    server.state.chunked = True
+    registry = helpers.MetricsRegistry()
+    client = instrumented_client(server, registry)
+    resp = client.transport.request('GET', '/api/v1/channels.history', params={'roomId': 'room0'}, stream=True)
+    assert resp._content_consumed is False
+    assert 'channels.history' not in registry.snapshot()
+    body = b''.join(resp.iter_content(1024))
+    resp.close()
+    resp.close()
+    metrics = registry.snapshot()['channels.history']
+    assert metrics['count'] == 1 and metrics['response_bytes'] == len(body)
+
+
+def test_streamed_export_with_metrics(server, tmp_path):
+    server.state.chunked = True
+    registry = helpers.MetricsRegistry()
+    client = instrumented_client(server, registry)
+    result, = client.export_history(['room0'], str(tmp_path))
+    assert result['done'] and result['messages'] == 10
+    with gzip.open(result['path']) as f:
+        assert len([json.loads(line) for line in f]) == 10
+    assert registry.snapshot()['channels.history']['response_bytes'] > 0
+
+
+def test_failed_streamed_request_observed(server, tmp_path):
+    server.state.chunked = True
+    registry = helpers.MetricsRegistry()
+    client = instrumented_client(server, registry)
+    result, = client.export_history(['missing'], str(tmp_path))
+    assert not result['done']
+    metrics = registry.snapshot()['channels.history']
+    assert metrics['count'] == 1 and list(metrics['statuses']) == [400]
+    assert metrics['response_bytes'] > 0
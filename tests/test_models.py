@@ -0,0 +1,54 @@
+import json
+import pickle
+
+import helpers
+
+
+def test_about_me_returns_full_json(client):
+    me = client.about_me('user1')
+    assert isinstance(me, dict)
+    assert me['success'] is True
+    assert me['username'] == 'user1'
+    assert json.loads(json.dumps(me)) == me
+
+
+def test_info_methods_return_json(client):
+    room = client.room_info('room0')
+    assert isinstance(room, dict) and room['name'] == 'room0'
+    user = client.user_info('user1')
+    assert isinstance(user, dict) and user['emails'][0]['address'] == 'user1@example.com'
+    json.dumps([room, user, client.subscriptions_get('user1')])
+
+
+def test_cached_room_updated_in_place(client):
+    client.room_info('room0')
+    assert client.channels_set_topic('room0', 'Тема') is True
+    room = client.room_info('room0')
+    assert isinstance(room, dict) and room['topic'] == 'Тема'
+
+
+def test_iter_returns_json_by_default(client):
+    assert all(isinstance(room, dict) for room in client.iter_channels())
+    rooms = list(client.iter_channels(model=helpers.Room))
+    assert rooms and all(isinstance(room, helpers.Room) for room in rooms)
+
+
+def test_create_room_result_unpacks_like_tuple(client):
+    success, roomId, name = client.create_channels('new_room')
+    assert (success, name) == (True, 'new_room')
+    assert json.dumps(client.create_channels('other_room'))
+
+
+def test_model_mapping_access():
+    room = helpers.Room.from_json({'_id': 'r1', 'name': 'room', 'topic': None, 'customFields': {'x': 1}})
+    assert room.id == 'r1' and room['_id'] == 'r1'
+    assert room.description is None and room.get('description', '') == ''
+    assert 'topic' in room and 'description' not in room and 'customFields' not in room
+    assert dict(room) == room.to_dict() == {'_id': 'r1', 'name': 'room', 'topic': None}
+    assert room.replace(topic='t')['topic'] == 't'
+    assert pickle.loads(pickle.dumps(room)) == room
+
+
+def test_decode_without_orjson(monkeypatch):
+    monkeypatch.setattr(helpers, 'orjson', None)
+    assert helpers.decode(b'{"a": [1]}') == {'a': [1]}
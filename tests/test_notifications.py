@@ -0,0 +1,20 @@
+import helpers
+
+
+def test_removal_without_rid():
+    state = helpers.Subscriptions()
+    state.reset([{'_id': 'sub0', 'rid': 'room0', 'alert': True, 'unread': 3},
+                 {'_id': 'sub1', 'rid': 'room1', 'alert': True, 'unread': 2}])
+    state.merge((), [{'_id': 'sub0', '_deletedAt': '2030-01-01T00:00:00.000Z'}])
+    assert state.totals() == {'alert': True, 'unread': 2}
+    assert state.since == '2030-01-01T00:00:00.000Z'
+    state.merge((), [{'_id': 'unknown', '_deletedAt': '2030-01-01T00:00:01.000Z'}])
+    assert state.totals() == {'alert': True, 'unread': 2}
+
+
+def test_notifications_after_leaving_room(server, client):
+    client.notifications('user0')
+    # дельта stub-сервера: в room0 одно непрочитанное
+    assert client.notifications('user0') == {'alert': True, 'unread': 1}
+    server.state.removed.append({'_id': 'sub0', '_deletedAt': '2030-01-01T00:00:00.000Z'})
+    assert client.notifications('user0') == {'alert': False, 'unread': 0}
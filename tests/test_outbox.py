@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+import helpers
+
+
+@pytest.fixture
+def outbox(client, tmp_path):
+    outbox = helpers.Outbox(os.path.join(str(tmp_path), 'outbox.sqlite3'), client, retries=1, backoff=0,
+                            poll_interval=0.01, autostart=False)
+    yield outbox
+    outbox.close()
+
+
+def test_first_argument_left_at_default(outbox):
+    item_id = outbox.enqueue('create_channels', kwargs={'readOnly': True})
+    item, = outbox.items()
+    assert (item['id'], item['queue']) == (item_id, 'name:')
+
+
+def test_supersede_keeps_last_value(server, outbox):
+    first = outbox.channels_set_topic('room0', 'первая')
+    outbox.channels_set_topic('room0', 'вторая')
+    outbox.channels_set_topic('room2', 'другая комната')
+    assert outbox.drain(5) == {'pending': 0, 'running': 0, 'done': 2, 'failed': 0, 'superseded': 1}
+    assert [item['id'] for item in outbox.items('superseded')] == [first]
+    assert (server.state.rooms['room0']['topic'], server.state.rooms['room2']['topic']) == ('вторая',
+                                                                                           'другая комната')
+
+
+def test_merge_update_user(outbox):
+    outbox.update_user('user0', name='Новое имя')
+    outbox.update_user('user0', email='new@example.com')
+    item, = outbox.items('pending')
+    assert item['kwargs'] == {'name': 'Новое имя', 'email': 'new@example.com'}
+
+
+def test_idempotency_key(outbox):
+    item_id = outbox.enqueue('channels_invite', ('room0', 'user1'), idempotency_key='invite')
+    assert outbox.enqueue('channels_invite', ('room0', 'user1'), idempotency_key='invite') == item_id
+    assert outbox.status()['pending'] == 1
+
+
+def test_retry_then_fail(server, outbox):
+    item_id = outbox.channels_set_topic('missing', 'тема')
+    status = outbox.drain(5)
+    assert (status['failed'], status['pending']) == (1, 0)
+    item, = outbox.items('failed')
+    assert (item['id'], item['attempts'], item['error']) == (item_id, 2, 'failed')
+
+    server.state.rooms['missing'] = dict(server.state.rooms['room0'], _id='missing')
+    assert outbox.retry() == 1
+    assert outbox.drain(5)['done'] == 1
+    assert server.state.rooms['missing']['topic'] == 'тема'
+
+
+def test_not_queueable(outbox):
+    with pytest.raises(ValueError):
+        outbox.enqueue('channels_info', ('room0',))
+    with pytest.raises(AttributeError):
+        outbox.create_token
@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+import helpers
+
+
+def fail_once(client, monkeypatch, match, error):
+    """
+    Первый вызов, для которого match(call) истинно, возвращает error
+    """
+    execute = client._execute
+    failed = []
+
+    def _execute(call):
+        if not failed and match(call):
+            failed.append(call)
+            return error
+        return execute(call)
+
+    monkeypatch.setattr(client, '_execute', _execute)
+    return failed
+
+
+def page(offset):
+    return lambda call: call.kwargs['params']['offset'] == offset
+
+
+def test_iterator_resumes_after_failed_page(client, monkeypatch):
+    expected = [room['_id'] for room in client.iter_channels(sort={'_id': 1})]
+    failed = fail_once(client, monkeypatch, page(2), helpers.APIError(500, 'Internal server error'))
+    it = client.iter_channels(sort={'_id': 1}, count=2)
+    seen = [next(it)['_id'], next(it)['_id']]
+    with pytest.raises(helpers.APIError):
+        next(it)
+    assert failed and it.cursor == 2
+    seen.extend(room['_id'] for room in it)
+    assert seen == expected
+
+
+def test_new_iterator_resumes_from_cursor(client, monkeypatch):
+    expected = [room['_id'] for room in client.iter_channels(sort={'_id': 1})]
+    fail_once(client, monkeypatch, page(2), helpers.APIError(500, 'Internal server error'))
+    it = client.iter_channels(sort={'_id': 1}, count=2)
+    seen = []
+    with pytest.raises(helpers.APIError):
+        for room in it:
+            seen.append(room['_id'])
+    it.close()
+    seen.extend(room['_id'] for room in client.iter_channels(sort={'_id': 1}, count=2, cursor=it.cursor))
+    assert seen == expected
+
+
+def test_async_iterator_resumes_after_failed_page(make_async_client, monkeypatch):
+    async def run():
+        client = make_async_client()
+        try:
+            expected = [room['_id'] async for room in client.iter_channels(sort={'_id': 1})]
+            execute = client._execute
+            failed = []
+
+            async def _execute(call):
+                if not failed and call.kwargs['params']['offset'] == 2:
+                    failed.append(call)
+                    return helpers.APIError(500, 'Internal server error')
+                return await execute(call)
+
+            monkeypatch.setattr(client, '_execute', _execute)
+            it = client.iter_channels(sort={'_id': 1}, count=2)
+            seen = []
+            with pytest.raises(helpers.APIError):
+                async for room in it:
+                    seen.append(room['_id'])
+            assert it.cursor == 2
+            seen.extend([room['_id'] async for room in it])
+            return expected, seen
+        finally:
+            await client.aclose()
+
+    expected, seen = asyncio.run(run())
+    assert seen == expected
@@ -0,0 +1,126 @@
+import threading
+import time
+
+import pytest
+
+import bench
+import helpers
+
+pytest.importorskip('websocket')
+pytest.importorskip('websockets')
+
+
+def wait_for(condition, timeout=5):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+@pytest.fixture
+def ddp(server):
+    with bench.FakeDDPServer(server.state, refuse=['user9']) as ddp:
+        yield ddp
+
+
+@pytest.fixture
+def realtime(client, ddp):
+    realtime = helpers.RealtimeUnread(client, url=ddp.url, reconnect_min=0.05, reconnect_max=0.1,
+                                      ping_interval=0.2).start()
+    yield realtime
+    realtime.stop()
+
+
+def ready(realtime, userId):
+    return wait_for(lambda: userId in realtime.live and userId in realtime.table)
+
+
+def test_counts_follow_stream(client, ddp, realtime):
+    realtime.watch('user1')
+    assert ready(realtime, 'user1')
+    before = realtime.notifications('user1')
+    ddp.push('user1', 'updated', {'_id': 'sub1', 'rid': 'room1', 'alert': True, 'unread': 5,
+                                  '_updatedAt': '2030-01-01T00:00:00.000Z'})
+    assert wait_for(lambda: realtime.notifications('user1')['unread'] == before['unread'] + 5)
+    assert realtime.notifications('user1')['alert'] is True
+
+
+def test_connection_per_user(ddp, realtime):
+    realtime.watch('user1')
+    realtime.watch('user2')
+    assert ready(realtime, 'user1') and ready(realtime, 'user2')
+    assert sorted(ddp.logins.values()) == ['user1', 'user2']
+    before = realtime.notifications('user1')
+    ddp.push('user2', 'removed', {'_id': 'sub0', '_deletedAt': '2030-01-01T00:00:00.000Z'})
+    assert wait_for(lambda: 'room0' not in realtime.table['user2'].rooms)
+    assert realtime.notifications('user1') == before
+
+
+def rest_calls(client, monkeypatch):
+    calls = []
+    notifications = client.notifications
+    monkeypatch.setattr(client, 'notifications', lambda userId: calls.append(userId) or notifications(userId))
+    return calls
+
+
+def test_refused_subscription_uses_rest(client, realtime, monkeypatch):
+    calls = rest_calls(client, monkeypatch)
+    realtime.watch('user9')
+    realtime.watch('user1')
+    assert ready(realtime, 'user1')
+    assert wait_for(lambda: realtime.sessions['user9'].refused)
+    assert 'user9' not in realtime.live
+    realtime.notifications('user1')
+    assert realtime.notifications('user9')['alert'] is True
+    assert calls == ['user9']
+
+
+def test_reconnect_resubscribes(ddp, realtime):
+    realtime.watch('user1')
+    assert ready(realtime, 'user1')
+    ddp.drop()
+    assert wait_for(lambda: realtime.reconnects >= 1 and 'user1' in realtime.live)
+    ddp.push('user1', 'removed', {'_id': 'sub0', 'rid': 'room0'})
+    assert wait_for(lambda: 'user1' in realtime.table and 'room0' not in realtime.table['user1'].rooms)
+
+
+def test_revoked_token_reminted(server, ddp, realtime):
+    realtime.watch('user1')
+    assert ready(realtime, 'user1')
+    attempts = ddp.login_attempts
+    server.state.tokens['user1'].clear()
+    ddp.drop()
+    assert wait_for(lambda: realtime.reconnects >= 1 and 'user1' in realtime.live)
+    assert ddp.login_attempts == attempts + 2
+
+
+def test_silent_connection_dropped(client, ddp, realtime, monkeypatch):
+    calls = rest_calls(client, monkeypatch)
+    realtime.watch('user1')
+    assert ready(realtime, 'user1')
+    ddp.silent = True
+    assert wait_for(lambda: not realtime.is_connected('user1'), timeout=2)
+    realtime.notifications('user1')
+    assert calls == ['user1']
+    ddp.silent = False
+    assert wait_for(lambda: realtime.is_connected('user1') and 'user1' in realtime.live)
+
+
+def test_resync_does_not_block_reader(client, ddp, realtime, monkeypatch):
+    release = threading.Event()
+    subscriptions_get = client.subscriptions_get
+    monkeypatch.setattr(client, 'subscriptions_get',
+                        lambda userId: release.wait(5) and subscriptions_get(userId))
+    realtime.watch('user1')
+    assert wait_for(lambda: 'user1' in realtime.live)
+    ddp.ping()
+    assert wait_for(lambda: ddp.pongs >= 1)
+    ddp.push('user1', 'updated', {'_id': 'sub3', 'rid': 'room3', 'alert': True, 'unread': 4,
+                                  '_updatedAt': '2030-01-01T00:00:00.000Z'})
+    time.sleep(0.5)
+    assert realtime.is_connected('user1') and 'user1' not in realtime.table
+    release.set()
+    assert wait_for(lambda: 'user1' in realtime.table)
+    assert realtime.table['user1'].rooms['room3'] == (True, 4)
@@ -0,0 +1,122 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import helpers
+
+
+@pytest.fixture
+def registry(server):
+    registry = helpers.ClientRegistry({
+        'one': {'url': server.url, 'username': 'admin', 'password': 'secret', 'concurrency': 1},
+        'two': {'url': server.url, 'username': 'admin', 'password': 'secret', 'concurrency': 2},
+    }, idle_timeout=60)
+    yield registry
+    registry.close()
+
+
+def test_tenant_created_once(registry):
+    assert registry.tenant('one') is registry.tenant('one')
+    assert registry.client('one') is registry.client('one')
+    assert registry.client('one') is not registry.client('two')
+    with pytest.raises(KeyError):
+        registry.tenant('missing')
+
+
+def test_loader(server):
+    loaded = []
+
+    def loader(name):
+        loaded.append(name)
+        return {'url': server.url, 'username': 'admin', 'password': 'secret'} if name == 'db' else None
+
+    registry = helpers.ClientRegistry({}, loader=loader)
+    assert registry.tenant('db').url == server.url
+    registry.tenant('db')
+    with pytest.raises(KeyError):
+        registry.tenant('missing')
+    assert loaded == ['db', 'missing']
+
+
+def test_evict_idle(registry):
+    one = registry.tenant('one')
+    two = registry.tenant('two')
+    one.used -= 120
+    assert registry.evict_idle() == ['one']
+    assert registry.tenant('two') is two
+    assert registry.tenant('one') is not one
+
+
+def test_evicted_on_access(registry):
+    one = registry.tenant('one')
+    one.used -= 120
+    registry._swept -= 120
+    registry.tenant('two')
+    assert set(registry.metrics()) == {'two'}
+
+
+def test_concurrency_limit(server, registry):
+    server.state.latency = 0.3
+    transport = registry.client('two').transport
+    threads = [threading.Thread(target=transport.get, args=('/api/v1/channels.list',)) for _ in range(4)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # по два запроса одновременно: две волны
+    assert time.monotonic() - start >= 0.6
+
+
+def test_wait_bounded_by_deadline(server, registry):
+    server.state.latency = 1
+    transport = registry.client('one').transport
+    busy = threading.Thread(target=transport.get, args=('/api/v1/channels.list',))
+    busy.start()
+    time.sleep(0.1)
+    start = time.monotonic()
+    with pytest.raises(helpers.DeadlineExceeded):
+        with helpers.deadline(0.2):
+            transport.get('/api/v1/channels.list')
+    assert time.monotonic() - start < 0.5
+    busy.join()
+    server.state.latency = 0
+    # место освободилось
+    assert transport.get('/api/v1/channels.list').status_code == 200
+
+
+def test_streamed_response_holds_slot(registry):
+    transport = registry.client('one').transport
+    resp = transport.get('/api/v1/channels.list', stream=True)
+    with pytest.raises(helpers.DeadlineExceeded):
+        with helpers.deadline(0.1):
+            transport.get('/api/v1/channels.list')
+    resp.close()
+    resp.close()
+    with helpers.deadline(0.1):
+        assert transport.get('/api/v1/channels.list').status_code == 200
+
+
+def test_async_wait_bounded_by_deadline(server, registry):
+    server.state.latency = 1
+    transport = registry.async_client('one').transport
+
+    async def bounded():
+        await asyncio.sleep(0.1)
+        start = time.monotonic()
+        with pytest.raises(helpers.DeadlineExceeded):
+            with helpers.deadline(0.2):
+                await transport.get('/api/v1/channels.list')
+        return time.monotonic() - start
+
+    async def main():
+        try:
+            busy, elapsed = await asyncio.gather(transport.get('/api/v1/channels.list'), bounded())
+        finally:
+            await transport.aclose()
+        return busy, elapsed
+
+    busy, elapsed = asyncio.run(main())
+    assert busy.status_code == 200 and elapsed < 0.5
@@ -0,0 +1,96 @@
+import logging
+
+import pytest
+
+import bench
+import helpers
+
+LOGGER = 'rocketchat.test'
+
+
+@pytest.fixture
+def records(caplog):
+    caplog.set_level(logging.DEBUG, logger=LOGGER)
+    return lambda: [record for record in caplog.records if record.name == LOGGER]
+
+
+def call(name='channels_set_topic', path='/api/v1/channels.setTopic'):
+    return helpers.Call(name, 'POST', path, userId='user1')
+
+
+def test_sample_rate(records, monkeypatch):
+    values = iter([i / 100.0 for i in range(100)])
+    monkeypatch.setattr(helpers.random, 'random', lambda: next(values))
+    log = helpers.RequestLog(sample=0.25, name=LOGGER)
+    resp = bench.FakeResponse(200, b'{"success": true}')
+    for _ in range(100):
+        log.success(call(), resp, 0.01)
+    assert len(records()) == 25
+    assert records()[0].rocketchat == {'endpoint': 'channels_set_topic', 'method': 'POST',
+                                       'path': '/api/v1/channels.setTopic', 'status': 200, 'elapsed_ms': 10.0,
+                                       'userId': 'user1'}
+
+
+def test_per_operation_rates(records):
+    log = helpers.RequestLog(sample=0, samples={'about_me': 1, '/api/v1/me': 0, '/api/v1/users.info': 1},
+                             name=LOGGER)
+    resp = bench.FakeResponse(200, b'{}')
+    log.success(call(), resp)
+    log.success(call('about_me', '/api/v1/me'), resp)
+    log.success(call('user_info', '/api/v1/users.info'), resp)
+    assert [record.rocketchat['endpoint'] for record in records()] == ['about_me', 'user_info']
+
+
+def test_failure_always_logged(records):
+    log = helpers.RequestLog(sample=0, name=LOGGER)
+    log.failure(call(), bench.FakeResponse(400, b'{"success": false, "error": "bad"}'), 0.002)
+    record, = records()
+    assert record.levelno == logging.ERROR
+    assert record.getMessage() == ('Fail channels_set_topic POST /api/v1/channels.setTopic -> 400 in 2.0ms: '
+                                   '{"success": false, "error": "bad"}')
+
+
+def test_disabled_level_skips_formatting(records):
+    class Unreadable(object):
+        status_code = 500
+
+        @property
+        def content(self):
+            raise AssertionError('body read')
+    logging.getLogger(LOGGER).setLevel(logging.CRITICAL)
+    log = helpers.RequestLog(name=LOGGER)
+    log.success(call(), Unreadable())
+    log.failure(call(), Unreadable())
+    assert records() == []
+
+
+def test_body_truncated(records):
+    log = helpers.RequestLog(body_limit=10, name=LOGGER)
+    log.failure(call(), bench.FakeResponse(500, b'x' * 100))
+    assert records()[0].getMessage().endswith(': xxxxxxxxxx... (100 bytes)')
+
+
+def test_secrets_redacted(records):
+    log = helpers.RequestLog(name=LOGGER)
+    body = b'{"data": {"userId": "admin", "authToken": "secret-token"}, "password": "secret-password"}'
+    log.failure(call(), bench.FakeResponse(401, body))
+    message = records()[0].getMessage()
+    assert 'secret' not in message
+    assert '"authToken": "***"' in message and '"password": "***"' in message
+    log = helpers.RequestLog(body_limit=60, name=LOGGER)
+    log.failure(call(), bench.FakeResponse(401, body))
+    assert 'secret' not in records()[-1].getMessage()
+
+
+def test_auth_headers_not_logged(server, client, records):
+    client.request_log = helpers.RequestLog(name=LOGGER)
+    assert client.about_me('user1')
+    server.state.tokens['user1'].clear()
+    client.info_cache.clear()
+    assert client.about_me('user1')
+    token = client.token_cache.get('user1')
+    _, admin_token = client.auth_admin()
+    assert records()
+    for record in records():
+        text = record.getMessage() + repr(record.rocketchat)
+        assert token not in text and admin_token not in text
@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+import helpers
+
+
+@pytest.mark.parametrize('name', ['café', 'Проект 😀', 'équipe'])
+def test_normalize_room_name_does_not_raise(name):
+    assert helpers.normalize_room_name(name) == helpers.normalize_room_name(name.upper())
+
+
+def test_index_with_non_cyrillic_names(server, client):
+    server.state.add_room('équipe', 'c', [])
+    server.state.add_room('Proekt_😀', 'p', [])
+    assert client.is_unique_name('café') is True
+    assert client.is_unique_name('Équipe') is False
+    assert client.is_unique_name('Проект 😀') is False
+    assert client.is_unique_name('Отдел продаж') is True
+
+
+def test_authoritative_with_non_cyrillic_names(server, client):
+    server.state.add_room('équipe', 'c', [])
+    assert client.is_unique_name('équipe', authoritative=True) is False
+    assert client.is_unique_name('Проект 😀', authoritative=True) is True
+
+
+def test_async_index_with_non_cyrillic_names(server, make_async_client):
+    server.state.add_room('équipe', 'c', [])
+
+    async def check():
+        client = make_async_client()
+        return await client.is_unique_name('équipe'), await client.is_unique_name('café 😀')
+
+    assert asyncio.run(check()) == (False, True)
+
+
+def test_index_follows_create_and_rename(client):
+    created = client.create_channels('Отдел продаж')
+    assert client.is_unique_name('Отдел продаж') is False
+    assert client.channels_rename(created.id, 'café') is True
+    assert client.is_unique_name('Отдел продаж') is True
+    assert client.is_unique_name('café') is False
+
+
+def test_authoritative_ignores_case(server, client):
+    server.state.add_room('Otdel_prodazh', 'c', [])
+    assert client.is_unique_name('отдел продаж') is False
+    assert client.is_unique_name('отдел продаж', authoritative=True) is False
+    assert client.is_unique_name('Отдел продаж 2', authoritative=True) is True
+
+
+def test_index_drops_deleted_room(server, client):
+    created = client.create_groups('Отдел продаж')
+    assert client.is_unique_name('Отдел продаж') is False
+    assert client.groups_delete(created.id) is True
+    server.state.requests.clear()
+    assert client.is_unique_name('Отдел продаж') is True
+    assert not server.state.requests
+
+
+def test_index_drops_room_deleted_elsewhere(server, client):
+    created = client.create_channels('Отдел продаж')
+    assert client.is_unique_name('Отдел продаж') is False
+    del server.state.rooms[created.id]
+    server.state.names.pop(created.name)
+    assert client.is_unique_name('Отдел продаж') is True
+    server.state.requests.clear()
+    assert client.is_unique_name('Отдел продаж') is True
+    assert not server.state.requests
+
+
+def test_async_index_drops_room_deleted_elsewhere(server, make_async_client):
+    room = server.state.add_room('équipe', 'c', [])
+
+    async def check():
+        client = make_async_client()
+        try:
+            taken = await client.is_unique_name('équipe')
+            del server.state.rooms[room['_id']]
+            return taken, await client.is_unique_name('Équipe'), 'équipe' in client.room_index
+        finally:
+            await client.aclose()
+
+    assert asyncio.run(check()) == (False, True, False)
@@ -0,0 +1,37 @@
+import pytest
+
+
+def test_private_none_leaves_type(server, client):
+    result = client.room_settings('room1').set(topic='тема', private=None).commit()
+    assert result['success'] and list(result['steps']) == ['topic']
+    assert result['unchanged'] == ['private']
+    assert (server.state.rooms['room1']['t'], server.state.rooms['room1']['topic']) == ('p', 'тема')
+
+
+def test_none_clears_description(server, client):
+    server.state.rooms['room0']['description'] = 'описание'
+    result = client.room_settings('room0').set(description=None, topic=None, name=None).commit(refresh=True)
+    assert result['success'] and list(result['steps']) == ['description']
+    assert sorted(result['unchanged']) == ['name', 'topic']
+    assert server.state.rooms['room0']['description'] == ''
+
+
+def test_set_type_runs_last(server, client):
+    settings = client.room_settings('room0').set(topic='тема', description='описание', private=True)
+    assert [[step[:2] for step in stage] for stage in settings.stages(client.room_info('room0'))] == [
+        [('topic', 'channels_set_topic'), ('description', 'channels_set_description')],
+        [('private', 'channels_set_type')]]
+    assert settings.commit()['success']
+    assert server.state.rooms['room0']['t'] == 'p'
+
+
+def test_unchanged_fields_not_sent(client):
+    room = client.room_info('room2')
+    result = client.room_settings('room2').set(name=room['name'], private=False).commit()
+    assert result['success'] and not result['steps']
+    assert result['unchanged'] == ['name', 'private']
+
+
+def test_unknown_setting(client):
+    with pytest.raises(TypeError):
+        client.room_settings('room0').set(color='red')
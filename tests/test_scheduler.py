@@ -0,0 +1,94 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import helpers
+
+
+def wait_queued(scheduler, depth):
+    for _ in range(500):
+        if scheduler.queue_depth >= depth:
+            return
+        time.sleep(0.01)
+    raise AssertionError('queue_depth %s' % scheduler.queue_depth)
+
+
+def test_interrupted_waiter_leaves_queue():
+    scheduler = helpers.RequestScheduler(rate=1000)
+    bucket = scheduler.bucket('/api/v1/me')
+    bucket.block(0.2)
+    delay = bucket.delay
+    calls = []
+
+    def interrupted():
+        calls.append(1)
+        if len(calls) == 2:
+            raise KeyboardInterrupt
+        return delay()
+
+    bucket.delay = interrupted
+    with pytest.raises(KeyboardInterrupt):
+        scheduler.acquire('/api/v1/me')
+    bucket.delay = delay
+    assert scheduler._waiting['/api/v1/me'] == []
+    assert scheduler.queue_depth == 0
+    start = time.monotonic()
+    scheduler.acquire('/api/v1/me')
+    assert time.monotonic() - start < 1
+
+
+def test_queue_served_by_priority():
+    scheduler = helpers.RequestScheduler(rate=1000)
+    scheduler.bucket('/api/v1/me').block(0.2)
+    order = []
+
+    def acquire(priority):
+        with helpers.priority(priority):
+            scheduler.acquire('/api/v1/me')
+        order.append(priority)
+
+    threads = []
+    for value in (helpers.BATCH, helpers.INTERACTIVE):
+        threads.append(threading.Thread(target=acquire, args=(value,)))
+        threads[-1].start()
+        wait_queued(scheduler, len(threads))
+    for thread in threads:
+        thread.join(5)
+    assert order == [helpers.INTERACTIVE, helpers.BATCH]
+    assert scheduler.metrics()['waits'] == 2
+
+
+def test_acquire_respects_deadline():
+    scheduler = helpers.RequestScheduler(rate=1000)
+    scheduler.bucket('/api/v1/me').block(3)
+    start = time.monotonic()
+    with helpers.deadline(0.2):
+        with pytest.raises(helpers.DeadlineExceeded):
+            scheduler.acquire('/api/v1/me')
+    assert time.monotonic() - start < 1
+    assert scheduler._waiting['/api/v1/me'] == [] and scheduler.queue_depth == 0
+
+
+def test_aacquire_respects_deadline():
+    scheduler = helpers.RequestScheduler(rate=1000)
+    scheduler.bucket('/api/v1/me').block(3)
+
+    async def acquire():
+        with helpers.deadline(0.2):
+            await scheduler.aacquire('/api/v1/me')
+
+    start = time.monotonic()
+    with pytest.raises(helpers.DeadlineExceeded):
+        asyncio.run(acquire())
+    assert time.monotonic() - start < 1
+
+
+def test_call_under_deadline_fails_fast(client):
+    client.transport.scheduler.bucket('/api/v1/users.info').block(3)
+    start = time.monotonic()
+    with helpers.deadline(0.3):
+        with pytest.raises(helpers.DeadlineExceeded):
+            client.user_info('user1')
+    assert time.monotonic() - start < 1
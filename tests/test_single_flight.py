@@ -0,0 +1,99 @@
+import asyncio
+import threading
+
+import pytest
+
+import helpers
+
+
+def test_do_coalesces_concurrent_calls():
+    flight = helpers.SingleFlight(window=0)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'result'
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do('key', fetch)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(flight.do('key', fetch))) for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    while flight.metrics()['coalesced'] < 3:
+        threading.Event().wait(0.01)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+    assert results == ['result'] * 4
+    assert len(calls) == 1
+    assert flight.metrics() == {'calls': 4, 'executed': 1, 'coalesced': 3, 'reused': 0}
+
+
+def test_leader_cancellation_does_not_reach_followers():
+    flight = helpers.SingleFlight(window=0)
+
+    async def fetch():
+        await asyncio.sleep(0.05)
+        return 'result'
+
+    async def main():
+        leader = asyncio.ensure_future(flight.ado('key', fetch))
+        await asyncio.sleep(0)
+        followers = [asyncio.ensure_future(flight.ado('key', fetch)) for _ in range(3)]
+        await asyncio.sleep(0)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await asyncio.gather(*followers)
+
+    assert asyncio.run(main()) == ['result'] * 3
+    assert flight.metrics()['executed'] == 1
+
+
+def test_follower_cancellation_does_not_reach_leader():
+    flight = helpers.SingleFlight(window=0)
+
+    async def fetch():
+        await asyncio.sleep(0.05)
+        return 'result'
+
+    async def main():
+        leader = asyncio.ensure_future(flight.ado('key', fetch))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.ado('key', fetch))
+        await asyncio.sleep(0)
+        follower.cancel()
+        return await leader, follower
+
+    result, follower = asyncio.run(main())
+    assert result == 'result' and follower.cancelled()
+
+
+def test_error_shared_and_not_reused():
+    flight = helpers.SingleFlight(window=10)
+
+    async def fetch():
+        await asyncio.sleep(0.01)
+        raise helpers.APIError(500, 'down')
+
+    async def main():
+        return await asyncio.gather(flight.ado('key', fetch), flight.ado('key', fetch), return_exceptions=True)
+
+    errors = asyncio.run(main())
+    assert all(isinstance(error, helpers.APIError) for error in errors)
+    assert asyncio.run(main())[0].status == 500
+    assert flight.metrics()['executed'] == 2
+
+
+def test_result_reused_within_window():
+    flight = helpers.SingleFlight(window=10)
+    assert flight.do('key', lambda: 1) == 1
+    assert flight.do('key', lambda: 2) == 1
+    assert flight.do('key', lambda: False) == 1
+    assert flight.metrics()['reused'] == 2
@@ -0,0 +1,38 @@
+import pytest
+from pytils import translit
+
+import helpers
+
+NAMES = [
+    'Иван Петров',
+    'Отдел продаж №2',
+    'Щукин-Ёлкин, «Съезд» 2024!',
+    'ЖЖ Юля_Чайковская (экс-ЦУМ) 3.14%',
+    'Объявление: «ё» и ‘кавычки’ — тире…',
+    'abc 123 ABC',
+    '',
+]
+
+
+@pytest.mark.parametrize('text', NAMES + [''.join(symbol for symbol, _ in translit.TRANSTABLE)])
+def test_translify_matches_pytils(text):
+    assert helpers.translify(text) == translit.translify(text)
+
+
+@pytest.mark.parametrize('text', ['café', 'Проект 😀'])
+def test_translify_rejects_like_pytils(text):
+    with pytest.raises(ValueError):
+        translit.translify(text)
+    with pytest.raises(ValueError):
+        helpers.translify(text)
+
+
+@pytest.mark.parametrize('name', NAMES)
+def test_translify_name_matches_baseline(name):
+    assert helpers.translify_name(name) == translit.translify('_'.join(name.split(' ')))
+    assert helpers.search_name(name) == helpers.translify_name(name)
+
+
+def test_make_username_matches_baseline():
+    assert helpers.make_username('Пётр Щукин', 'p.shchukin@example.com') == 'Pyotr_Schukin_p.shchukin'
+    assert helpers.make_username('Иван Петров', 'ivan@mail.ru') == 'Ivan_Petrov_ivan'
@@ -0,0 +1,327 @@
+import asyncio
+import socket
+import threading
+import time
+
+import pytest
+import requests
+from django.conf import settings
+
+import helpers
+
+
+def spy_create_token(monkeypatch, client):
+    created = []
+    create_token = client.create_token
+
+    def spy(userId):
+        created.append(userId)
+        return create_token(userId)
+    monkeypatch.setattr(client, 'create_token', spy)
+    return created
+
+
+def test_rejected_token_is_reminted(server, client, monkeypatch):
+    created = spy_create_token(monkeypatch, client)
+    assert client.about_me('user0')['username'] == 'user0'
+    assert client.about_me('user0')['username'] == 'user0'
+    assert created == ['user0']
+
+    server.state.tokens['user0'].clear()
+    client.info_cache.clear()
+    assert client.about_me('user0')['username'] == 'user0'
+    assert created == ['user0', 'user0']
+    assert server.state.tokens['user0'] == {client.token_cache.get('user0')}
+
+
+def test_token_reminted_once(client, monkeypatch):
+    created = []
+    monkeypatch.setattr(client, 'create_token', lambda userId: created.append(userId) or 'rejected')
+    assert client.about_me('user0') is False
+    assert created == ['user0', 'user0']
+
+
+def test_request_not_sent_without_token(server, client, monkeypatch):
+    sent = []
+    request = client.transport.request
+    monkeypatch.setattr(client.transport, 'request',
+                        lambda method, path, **kwargs: sent.append(path) or request(method, path, **kwargs))
+    assert client.about_me('nobody') is False
+    assert client.notifications('nobody') is False
+    assert [path for path in sent if path != '/api/v1/login'] == ['/api/v1/users.createToken'] * 2
+    assert client.token_cache.get('nobody') is None
+
+
+def test_async_request_not_sent_without_token(server, make_async_client):
+    async def main():
+        client = make_async_client()
+        try:
+            return await client.about_me('nobody'), await client.notifications('nobody')
+        finally:
+            await client.aclose()
+    assert asyncio.run(main()) == (False, False)
+
+
+def test_async_rejected_token_is_reminted(server, make_async_client):
+    async def main():
+        client = make_async_client()
+        try:
+            assert (await client.about_me('user1'))['username'] == 'user1'
+            server.state.tokens['user1'].clear()
+            client.info_cache.clear()
+            assert (await client.about_me('user1'))['username'] == 'user1'
+            return client.token_cache.get('user1')
+        finally:
+            await client.aclose()
+    token = asyncio.run(main())
+    assert server.state.tokens['user1'] == {token}
+
+
+def test_breaker_transitions():
+    changes = []
+    breaker = helpers.CircuitBreaker('users', 2, 0.05, [lambda *change: changes.append(change)])
+    breaker.acquire()
+    breaker.failure()
+    breaker.acquire()
+    breaker.failure()
+    assert breaker.state == helpers.OPEN
+    with pytest.raises(helpers.CircuitOpen):
+        breaker.acquire()
+
+    time.sleep(0.05)
+    breaker.acquire()
+    assert breaker.state == helpers.HALF_OPEN
+    with pytest.raises(helpers.CircuitOpen):
+        breaker.acquire()
+    breaker.failure()
+    assert breaker.state == helpers.OPEN
+
+    time.sleep(0.05)
+    breaker.acquire()
+    breaker.record(200)
+    assert breaker.state == helpers.CLOSED
+    breaker.acquire()
+    assert changes == [('users', 'closed', 'open'), ('users', 'open', 'half_open'), ('users', 'half_open', 'open'),
+                       ('users', 'open', 'half_open'), ('users', 'half_open', 'closed')]
+    assert breaker.metrics() == {'state': 'closed', 'failures': 0, 'opened': 2, 'rejected': 2}
+
+
+def test_breaker_success_resets_failures():
+    breaker = helpers.CircuitBreaker('users', 2, 30)
+    breaker.failure()
+    breaker.record(404)
+    breaker.failure()
+    assert breaker.state == helpers.CLOSED
+    breaker.record(502)
+    assert breaker.state == helpers.OPEN
+
+
+def test_breaker_release_frees_probe():
+    breaker = helpers.CircuitBreaker('users', 1, 0)
+    breaker.failure()
+    breaker.acquire()
+    breaker.release()
+    breaker.acquire()
+    assert breaker.state == helpers.HALF_OPEN
+
+
+def test_transport_breaker_opens_on_timeouts(server):
+    changes = []
+    transport = helpers.Transport(base_url=server.url, retries=0, timeouts={'subscriptions': (1, 0.05)},
+                                  breakers=helpers.CircuitBreakers(failures=2, reset_timeout=0.1,
+                                                                   hooks=[lambda *change: changes.append(change)]))
+    server.state.latency = 0.3
+    try:
+        for _ in range(2):
+            with pytest.raises(requests.exceptions.RequestException):
+                transport.get('/api/v1/subscriptions.get')
+        start = time.perf_counter()
+        with pytest.raises(helpers.CircuitOpen):
+            transport.get('/api/v1/subscriptions.get')
+        assert time.perf_counter() - start < 0.05
+        assert transport.get('/api/v1/rooms.info', params={'roomId': 'room0'}).status_code == 200
+    finally:
+        server.state.latency = 0
+    time.sleep(0.1)
+    assert transport.get('/api/v1/subscriptions.get').status_code == 200
+    assert changes == [('subscriptions', 'closed', 'open'), ('subscriptions', 'open', 'half_open'),
+                       ('subscriptions', 'half_open', 'closed')]
+    transport.close()
+
+
+def test_client_errors_do_not_open_breaker(server):
+    transport = helpers.Transport(base_url=server.url, breakers=helpers.CircuitBreakers(failures=2))
+    for _ in range(3):
+        with pytest.raises(requests.exceptions.InvalidHeader):
+            transport.get('/api/v1/me', headers={'X-Auth-Token': False, 'X-User-Id': 'user0'})
+    assert transport.breakers.get('/api/v1/me').state == helpers.CLOSED
+    transport.close()
+
+
+def test_async_client_errors_do_not_open_breaker(server):
+    transport = helpers.AsyncTransport(base_url=server.url, breakers=helpers.CircuitBreakers(failures=2))
+
+    async def main():
+        for _ in range(3):
+            with pytest.raises(TypeError):
+                await transport.get('/api/v1/me', headers={'X-Auth-Token': False, 'X-User-Id': 'user0'})
+        await transport.aclose()
+    asyncio.run(main())
+    assert transport.breakers.get('/api/v1/me').state == helpers.CLOSED
+
+
+def test_half_open_probe_released_on_client_error(server):
+    transport = helpers.Transport(base_url=server.url, breakers=helpers.CircuitBreakers(failures=1, reset_timeout=0))
+    transport.breakers.get('/api/v1/me').failure()
+    with pytest.raises(requests.exceptions.InvalidHeader):
+        transport.get('/api/v1/me', headers={'X-Auth-Token': False})
+    assert transport.get('/api/v1/me').status_code == 401
+    assert transport.breakers.get('/api/v1/me').state == helpers.CLOSED
+    transport.close()
+
+
+def test_thread_sessions_share_adapter(server):
+    transport = helpers.Transport(base_url=server.url, pool_maxsize=2)
+    sessions = []
+
+    def worker():
+        sessions.append(transport.session)
+        assert transport.session is sessions[-1]
+        assert transport.get('/api/v1/rooms.info', params={'roomId': 'room0'}).status_code == 200
+    threads = [threading.Thread(target=worker) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(map(id, sessions))) == 3
+    assert all(session.get_adapter(server.url) is transport.adapter for session in sessions)
+    assert transport.session is not sessions[0]
+    transport.close()
+
+
+def test_connection_reused(server):
+    transport = helpers.Transport(base_url=server.url)
+    responses = [transport.get('/api/v1/rooms.info', params={'roomId': 'room0'}) for _ in range(2)]
+    assert [resp.connection_reused for resp in responses] == [False, True]
+    transport.close()
+
+
+def closed_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def test_retries_stop_at_deadline():
+    transport = helpers.Transport(base_url='http://127.0.0.1:%s' % closed_port(), retries=10, backoff_factor=0.2)
+    start = time.monotonic()
+    with pytest.raises((requests.exceptions.ConnectionError, helpers.DeadlineExceeded)):
+        with helpers.deadline(0.3):
+            transport.get('/api/v1/rooms.info')
+    assert time.monotonic() - start < 1
+    transport.close()
+
+
+def test_deadline_retry_backoff():
+    retry = helpers.DeadlineRetry(total=5, backoff_factor=10).increment().increment()
+    assert retry.get_backoff_time() == 20
+    assert not retry.is_exhausted()
+    with helpers.deadline(0.5):
+        assert 0 < retry.get_backoff_time() <= 0.5
+        assert not retry.is_exhausted()
+    with helpers.deadline(0):
+        assert retry.get_backoff_time() == 0
+        assert retry.is_exhausted()
+
+
+def test_transport_settings(server, monkeypatch):
+    for name, value in (('ROCKETCHAT_RETRIES', 7), ('ROCKETCHAT_BACKOFF_FACTOR', 0.1), ('ROCKETCHAT_TIMEOUT', (1, 2)),
+                        ('ROCKETCHAT_POOL_MAXSIZE', 3), ('ROCKETCHAT_POOL_BLOCK', True)):
+        monkeypatch.setattr(settings, name, value, raising=False)
+    transport = helpers.Transport()
+    assert transport.base_url == server.url
+    retry = transport.adapter.max_retries
+    assert isinstance(retry, helpers.DeadlineRetry) and (retry.total, retry.backoff_factor) == (7, 0.1)
+    assert transport.timeout == (1, 2)
+    assert (transport.adapter._pool_maxsize, transport.adapter._pool_block) == (3, True)
+    assert helpers.Transport(retries=0, timeout=(5, 5)).adapter.max_retries.total == 0
+
+
+def admin_client(server):
+    transport = helpers.Transport(base_url=server.url, pool_maxsize=8)
+    return helpers.RocketChat(transport=transport, token_cache=helpers.TokenCache(),
+                              admin_session=helpers.AdminSession('admin', 'password'), info_cache=helpers.InfoCache(),
+                              single_flight=helpers.SingleFlight(window=0))
+
+
+def test_concurrent_admin_login_once(server):
+    client = admin_client(server)
+    server.state.latency = 0.05
+    try:
+        barrier = threading.Barrier(8)
+        results = []
+
+        def worker():
+            barrier.wait()
+            results.append(client.auth_admin())
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        server.state.latency = 0
+    assert server.state.logins == 1
+    assert results == [('admin', 'admin-token-1')] * 8
+    assert client.admin_session.metrics() == {'logins': 1, 'login_failures': 0, 'invalidations': 0}
+
+
+def test_async_concurrent_admin_login_once(server):
+    session = helpers.AdminSession('admin', 'password')
+
+    async def main():
+        transport = helpers.AsyncTransport(base_url=server.url)
+        results = await asyncio.gather(*[session.aget(transport) for _ in range(8)])
+        await transport.aclose()
+        return results
+    assert asyncio.run(main()) == [('admin', 'admin-token-1')] * 8
+    assert server.state.logins == 1 and session.logins == 1
+
+
+def test_admin_relogin_on_401(server):
+    client = admin_client(server)
+    assert client.channels_set_topic('room0', 'тема') is True
+    server.state.admin_tokens.clear()
+    assert client.channels_set_topic('room0', 'новая тема') is True
+    assert server.state.rooms['room0']['topic'] == 'новая тема'
+    assert server.state.logins == 2
+    assert client.admin_session.metrics() == {'logins': 2, 'login_failures': 0, 'invalidations': 1}
+
+
+def test_async_admin_relogin_on_401(server):
+    session = helpers.AdminSession('admin', 'password')
+
+    async def main():
+        client = helpers.AsyncRocketChat(
+            transport=helpers.AsyncTransport(base_url=server.url), token_cache=helpers.TokenCache(),
+            admin_session=session, info_cache=helpers.InfoCache(), single_flight=helpers.SingleFlight(window=0))
+        await client.auth_admin()
+        server.state.admin_tokens.clear()
+        try:
+            return await client.channels_set_topic('room0', 'тема')
+        finally:
+            await client.aclose()
+    assert asyncio.run(main()) is True
+    assert session.metrics() == {'logins': 2, 'login_failures': 0, 'invalidations': 1}
+
+
+def test_admin_login_failure_counted(server):
+    server.state.admin_password = 'secret'
+    client = admin_client(server)
+    assert client.auth_admin() == (None, None)
+    assert client.auth_admin() == (None, None)
+    server.state.admin_password = 'password'
+    assert client.auth_admin() == ('admin', 'admin-token-1')
+    assert client.admin_session.metrics() == {'logins': 1, 'login_failures': 2, 'invalidations': 0}